@@ -10,9 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import hashlib
 import os
 from pathlib import Path
-import time
 from decouple import config
 import django
 
@@ -189,6 +189,8 @@ SOCIALACCOUNT_PROVIDERS = {
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'store.middleware.PrecompressedStaticMiddleware',
+    'store.middleware.ImmutableMediaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -227,11 +229,9 @@ AUTHENTICATION_BACKENDS = [
     'allauth.account.auth_backends.AuthenticationBackend',
 ]
 
-STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'
+STATICFILES_STORAGE = 'store.storage.LenientManifestStaticFilesStorage'
 STATICFILES_MANIFEST = True
 
-STATIC_VERSION = int(time.time())
-
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 # Add your email configuration settings here
 
@@ -251,6 +251,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'store.context_processors.header_counters',
+                'store.context_processors.static_version',
             ],
         },
     },
@@ -277,6 +279,28 @@ DATABASES = {
 
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Homepage blocks and other shared fragments live here (see store/caching.py).
+# Use a shared backend such as Memcached or Redis when running several workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'kenstech',
+    }
+}
+
+# Where live carts are kept (see store/cart.py): 'database' writes every change to
+# Cart/CartItem, 'cache' keeps them in the cache above and writes them behind with
+# manage.py flush_carts, which needs a persistent shared cache such as Redis.
+CART_BACKEND = config('CART_BACKEND', default='database')
+
+# Bearer tokens partners send to api/products/ (comma separated); when empty the export is
+# public, like the storefront listing it mirrors
+CATALOG_EXPORT_TOKENS = [token for token in config('CATALOG_EXPORT_TOKENS', default='').split(',') if token]
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -318,6 +342,17 @@ MEDIA_URL = '/media/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static_in_env')]
 VENV_PATH = os.path.dirname(BASE_DIR)
 STATIC_ROOT = os.path.join(VENV_PATH, 'static_root')
+
+# Changes when manage.py build_static collects different files, not when a worker restarts
+def static_version():
+    try:
+        with open(os.path.join(STATIC_ROOT, 'staticfiles.json'), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()[:12]
+    except OSError:
+        return 'dev'
+
+
+STATIC_VERSION = config('STATIC_VERSION', default=None) or static_version()
 MEDIA_ROOT = os.path.join(VENV_PATH, 'media_root')
 
 # Default primary key field type
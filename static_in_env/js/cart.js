@@ -0,0 +1,55 @@
+(function($) {
+	"use strict"
+
+	// Forms with a data-cart-url post to the JSON cart API (store.views.CartApiView)
+	// instead of reloading the page. Without JavaScript, or if the request fails,
+	// the form is submitted normally.
+
+	function formatPrice(value) {
+		return Number(value).toLocaleString('en-US', {minimumFractionDigits: 2, maximumFractionDigits: 2});
+	}
+
+	function updateCart(data) {
+		$('[data-cart-count]').text(data.cart_items_count);
+		$('[data-wishlist-count]').text(data.wishlist_items_count);
+		$('[data-cart-subtotal]').text(formatPrice(data.subtotal));
+		$('[data-cart-shipping]').text(formatPrice(data.shipping));
+		$('[data-cart-total]').text(formatPrice(data.total_price));
+		$('#amount').val(formatPrice(data.total_price));
+	}
+
+	$(document).on('submit', 'form[data-cart-url]', function(event) {
+		var form = this;
+		var $button = $(event.originalEvent && event.originalEvent.submitter);
+		var formData = new FormData(form);
+		if ($button.data('product-id')) {
+			// Cart page: the button names the line to remove
+			formData.set('product_id', $button.data('product-id'));
+		}
+		if (!formData.get('product_id')) {
+			return;
+		}
+		event.preventDefault();
+
+		$.ajax({
+			url: $(form).data('cart-url'),
+			method: 'POST',
+			data: formData,
+			processData: false,
+			contentType: false,
+			dataType: 'json'
+		}).done(function(data) {
+			updateCart(data);
+			if (data.line === null) {
+				$('[data-cart-line="' + formData.get('product_id') + '"]').remove();
+			}
+		}).fail(function() {
+			if ($button.attr('name')) {
+				// form.submit() leaves out the clicked button
+				$('<input type="hidden">').attr('name', $button.attr('name')).val($button.val()).appendTo(form);
+			}
+			form.submit();
+		});
+	});
+
+})(jQuery);
@@ -1,9 +1,59 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
 from .models import *
+from .pricing import apply_discount, change_price, clear_discount
 
 # Register your models here.
+class RepricingActionForm(ActionForm):
+    percent = forms.IntegerField(required=False, help_text='For the discount and price change actions')
+
+
 class ProductAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('name',)}
+    # Counted from the orders, see Order.record_sales() and manage.py rebuild_sales_counts
+    readonly_fields = ['sales']
+    action_form = RepricingActionForm
+    actions = ['apply_discount', 'clear_discount', 'change_price']
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            return super().save_model(request, obj, form, change)
+        # Only the edited columns: writing back the whole row would reset sales, which
+        # Order.record_sales() may have counted up since the form was loaded
+        columns = {field.name for field in obj._meta.concrete_fields}
+        fields = [name for name in form.changed_data if name in columns]
+        # Plus what Product.save derives from them
+        obj.save(update_fields=[*fields, 'discount_price', 'slug', 'updated_at'])
+
+    def get_percent(self, request, minimum, maximum):
+        try:
+            percent = int(request.POST.get('percent', ''))
+        except ValueError:
+            percent = None
+        if percent is None or not minimum <= percent <= maximum:
+            self.message_user(request, f"Enter a percent between {minimum} and {maximum}.", messages.ERROR)
+            return None
+        return percent
+
+    @admin.action(description='Apply a percent discount to selected products')
+    def apply_discount(self, request, queryset):
+        percent = self.get_percent(request, 0, 100)
+        if percent is not None:
+            count = apply_discount(queryset, percent)
+            self.message_user(request, f"Discounted {count} products by {percent}%.")
+
+    @admin.action(description='Clear the discount of selected products')
+    def clear_discount(self, request, queryset):
+        count = clear_discount(queryset)
+        self.message_user(request, f"Cleared the discount of {count} products.")
+
+    @admin.action(description='Change the price of selected products by a percent')
+    def change_price(self, request, queryset):
+        percent = self.get_percent(request, -99, 1000)
+        if percent is not None:
+            count = change_price(queryset, percent)
+            self.message_user(request, f"Changed the price of {count} products by {percent}%.")
 
 admin.site.register(Product, ProductAdmin)
 
@@ -14,5 +64,5 @@ admin.site.register(Wishlist)
 admin.site.register(WishlistItem)
 admin.site.register(CartItem)
 admin.site.register(Cart)
+admin.site.register(PaymentEvent)
 admin.site.register(NewsletterSubscriber)
-
@@ -0,0 +1,211 @@
+import hashlib
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Product
+
+
+KEY_PREFIX = 'store'
+# How long one worker may spend rebuilding an entry before others stop waiting for it
+REBUILD_LOCK_TIMEOUT = 10
+REBUILD_POLL_INTERVAL = 0.05
+LOCK_POLL_INTERVAL = 0.005
+
+PRODUCT_PAGE_NAMESPACE = 'product-page'
+PRODUCT_PAGE_TIMEOUT = 60 * 10
+# Per-visitor values rendered into cached pages as placeholders and filled in per request
+PAGE_PLACEHOLDERS = {
+    'csrf_token': '__STORE_CSRF_TOKEN__',
+    'cart_items_count': '__STORE_CART_ITEMS_COUNT__',
+    'wishlist_items_count': '__STORE_WISHLIST_ITEMS_COUNT__',
+    'quantity': '__STORE_QUANTITY__',
+}
+
+HOMEPAGE_NAMESPACE = 'homepage'
+HOMEPAGE_TIMEOUT = 60 * 15
+HOMEPAGE_BLOCK_SIZE = 3
+HOT_DEALS_LIMIT = 12
+
+CART_SUMMARY_NAMESPACE = 'cart-summary'
+CART_SUMMARY_TIMEOUT = 60 * 60
+EMPTY_CART_SUMMARY = {'items': 0, 'total_quantity': 0, 'subtotal': 0, 'shipping': 0}
+
+HEADER_COUNTERS_NAMESPACE = 'header-counters'
+HEADER_COUNTERS_TIMEOUT = 60 * 60
+
+
+def get_version(namespace):
+    key = f'{KEY_PREFIX}:{namespace}:version'
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, timeout=None)
+        version = cache.get(key, 1)
+    return version
+
+
+def bump_version(namespace):
+    # Every key built from the old version becomes unreachable and simply expires
+    key = f'{KEY_PREFIX}:{namespace}:version'
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+        cache.incr(key)
+
+
+def versioned_key(namespace, *parts):
+    return ':'.join([KEY_PREFIX, namespace, f'v{get_version(namespace)}', *map(str, parts)])
+
+
+def get_or_build(key, builder, timeout, stale_key=None):
+    """
+    Return the cached value for key, building it on a miss.
+
+    Only the worker that wins the rebuild lock runs builder(); the others
+    serve the last good copy under stale_key if there is one, or wait for
+    the winner instead of all hitting the database at once.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, timeout=REBUILD_LOCK_TIMEOUT):
+        try:
+            value = builder()
+            cache.set(key, value, timeout)
+            if stale_key:
+                # Kept without expiry, it is overwritten by every rebuild
+                cache.set(stale_key, value, timeout=None)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    if stale_key:
+        value = cache.get(stale_key)
+        if value is not None:
+            return value
+
+    deadline = time.monotonic() + REBUILD_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(REBUILD_POLL_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    # The rebuilding worker died or is too slow, do the work ourselves
+    return builder()
+
+
+@contextmanager
+def cache_lock(key, timeout=REBUILD_LOCK_TIMEOUT):
+    # Serialize read-modify-write cycles on a cache entry across workers
+    lock_key = f'{key}:lock'
+    deadline = time.monotonic() + timeout
+    while not cache.add(lock_key, 1, timeout=timeout):
+        if time.monotonic() > deadline:
+            # The holder died without releasing it, the lock expires by now
+            break
+        time.sleep(LOCK_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        cache.delete(lock_key)
+
+
+def build_homepage_blocks():
+    products = Product.objects.for_cards()
+    return {
+        'recent_products': list(products.order_by('-timestamp', '-pk')[:HOMEPAGE_BLOCK_SIZE]),
+        'new_products': list(products.filter(is_new=True).order_by('-pk')[:HOMEPAGE_BLOCK_SIZE]),
+        'top_selling': list(products.order_by('-sales', '-pk')[:HOMEPAGE_BLOCK_SIZE]),
+        'hot_deals': list(products.filter(hot_deal=True).order_by('-pk')[:HOT_DEALS_LIMIT]),
+    }
+
+
+def get_homepage_blocks():
+    # The homepage product blocks are the same for every visitor
+    return get_or_build(
+        versioned_key(HOMEPAGE_NAMESPACE, 'blocks'),
+        build_homepage_blocks,
+        HOMEPAGE_TIMEOUT,
+        stale_key=f'{KEY_PREFIX}:{HOMEPAGE_NAMESPACE}:blocks:stale',
+    )
+
+
+def invalidate_homepage_blocks():
+    bump_version(HOMEPAGE_NAMESPACE)
+
+
+def product_page_version(product):
+    """
+    What a product page shows besides per-visitor values, in one value:
+    product.updated_at, the latest updated_at of its related products
+    (product.related_updated_at, annotated by the view) and
+    settings.STATIC_VERSION. A change to the product, to a product in its
+    related block or a deploy with new static files retires cached pages
+    and ETags.
+    """
+    related_updated_at = getattr(product, 'related_updated_at', None)
+    return (
+        int(product.updated_at.timestamp() * 1000000),
+        int(related_updated_at.timestamp() * 1000000) if related_updated_at else 0,
+        settings.STATIC_VERSION,
+    )
+
+
+def get_product_page(product, query_string, render):
+    """
+    Shared HTML of a product page for anonymous visitors, with
+    PAGE_PLACEHOLDERS where the per-visitor values go. The key carries
+    product_page_version(), so any change to what the page shows retires it.
+    """
+    key = versioned_key(
+        PRODUCT_PAGE_NAMESPACE,
+        product.pk,
+        *product_page_version(product),
+        hashlib.md5(query_string.encode()).hexdigest(),
+    )
+    return get_or_build(key, render, PRODUCT_PAGE_TIMEOUT)
+
+
+def fill_page(html, values):
+    for name, placeholder in PAGE_PLACEHOLDERS.items():
+        html = html.replace(placeholder, str(values[name]))
+    return html
+
+
+def cart_summary_key(cart_id):
+    return versioned_key(CART_SUMMARY_NAMESPACE, cart_id)
+
+
+def get_cart_summary(cart):
+    # Cart.get_summary() for the header and cart page, deleted whenever the cart's items change
+    if cart is None:
+        return EMPTY_CART_SUMMARY
+    key = cart_summary_key(cart.pk)
+    summary = cache.get(key)
+    if summary is None:
+        summary = cart.get_summary()
+        cache.set(key, summary, CART_SUMMARY_TIMEOUT)
+    return summary
+
+
+def invalidate_cart_summaries(cart_ids):
+    cache.delete_many([cart_summary_key(cart_id) for cart_id in cart_ids])
+
+
+def invalidate_all_cart_summaries():
+    # Prices or shipping fees changed, which can be in any cart
+    bump_version(CART_SUMMARY_NAMESPACE)
+
+
+def header_counter_key(counter, owner):
+    # owner is ('user', pk) for signed-in visitors, ('cart', pk) or ('wishlist', pk) otherwise
+    return ':'.join([KEY_PREFIX, HEADER_COUNTERS_NAMESPACE, counter, *map(str, owner)])
+
+
+def invalidate_header_counters(counter, owners):
+    cache.delete_many([header_counter_key(counter, owner) for owner in owners])
@@ -0,0 +1,436 @@
+import secrets
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import cached_property
+
+from .caching import KEY_PREFIX, cache_lock, get_cart_summary, invalidate_header_counters
+from .models import Cart, CartItem, Product
+
+
+# Cache backend: how long an untouched cart is kept, and how many dirty lists the flusher drains
+CART_STATE_TIMEOUT = 60 * 60 * 24 * 30
+DIRTY_SHARDS = 16
+
+
+class LazyCart:
+    """
+    The visitor's cart, looked up on first use and never created by reads:
+    a visitor without a cart reads as an empty one, and the Cart row (and
+    the session entry of an anonymous visitor) is only written by
+    get_or_create() on the first add to cart.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    @cached_property
+    def cart(self):
+        # The existing Cart row or None, without writing anything
+        if self.request.user.is_authenticated:
+            return Cart.objects.active().filter(user=self.request.user).first()
+        cart_id = self.request.session.get('cart_id')
+        if cart_id:
+            return Cart.objects.active().filter(id=cart_id).first()
+        return None
+
+    def get_or_create(self):
+        if self.cart is None:
+            if self.request.user.is_authenticated:
+                self.cart = Cart.objects.get_or_create_active(self.request.user.pk)[0]
+            else:
+                self.cart = Cart.objects.create()
+                self.request.session['cart_id'] = self.cart.id
+        return self.cart
+
+    @property
+    def id(self):
+        return self.cart.id if self.cart else None
+
+    @property
+    def items(self):
+        return self.cart.items.all() if self.cart else CartItem.objects.none()
+
+    @cached_property
+    def summary(self):
+        # Counts and totals from the per-cart cache, see Cart.get_summary()
+        return get_cart_summary(self.cart)
+
+    def get_total_items(self):
+        return self.summary['items']
+
+    def get_subtotal(self):
+        return self.summary['subtotal']
+
+    def get_total_price(self):
+        return self.summary['subtotal'] + self.summary['shipping']
+
+
+def get_cart(request):
+    # One LazyCart per request, shared by the view and anything it calls
+    if not hasattr(request, '_lazy_cart'):
+        request._lazy_cart = LazyCart(request)
+    return request._lazy_cart
+
+
+class DatabaseCartStore:
+    """
+    Every cart change is written to the Cart and CartItem rows right away.
+    """
+    # The header counter is worth caching, see store/context_processors.py
+    live_counts = False
+
+    def __init__(self, request):
+        self.request = request
+        self.cart = get_cart(request)
+
+    def has_cart(self):
+        return self.request.user.is_authenticated or bool(self.request.session.get('cart_id'))
+
+    def count_items(self):
+        return self.cart.get_total_items()
+
+    def get_quantity(self, product):
+        cart_item = self.cart.items.filter(product=product).first()
+        return cart_item.quantity if cart_item else None
+
+    def get_lines(self):
+        # {product_id: quantity}
+        return dict(self.cart.items.values_list('product_id', 'quantity'))
+
+    def add(self, product, quantity):
+        self.set_quantity(product, (self.get_quantity(product) or 0) + quantity)
+
+    def set_quantity(self, product, quantity):
+        user = self.request.user
+        cart = self.cart.get_or_create()
+
+        # One transaction, purge_stale never sees the new item before it is in the cart
+        with transaction.atomic():
+            # Check if the item is already in the cart
+            if user.is_authenticated:
+                cart_item, item_created = CartItem.objects.get_or_create(cart=cart, user=user, product=product)
+            else:
+                cart_item, item_created = CartItem.objects.get_or_create(cart=cart, product=product)
+
+            cart_item.quantity = quantity
+            cart_item.save()
+            if item_created:
+                cart.items.add(cart_item)
+
+    def remove(self, product_id):
+        self.cart.items.filter(product_id=product_id).delete()
+
+    def flush(self):
+        # Nothing is pending, return the cart to read the rows from
+        return self.cart
+
+    def clear(self):
+        if self.cart.cart:
+            self.cart.cart.items.clear()
+
+    def checkout(self, reference):
+        """
+        Set the cart aside for the payment reference and return it (None
+        without a cart). The order is made from it in the background; the
+        next add to cart starts a new cart.
+        """
+        cart = self.cart.cart
+        if cart is None:
+            return None
+        Cart.objects.filter(pk=cart.pk, is_active=True).update(is_active=None, reference=reference)
+        # The header counts the new, empty cart
+        owners = [('cart', cart.pk), ('user', cart.user_id)] if cart.user_id else [('cart', cart.pk)]
+        transaction.on_commit(lambda: invalidate_header_counters('cart', owners))
+        self.request.__dict__.pop('_lazy_cart', None)
+        self.cart = get_cart(self.request)
+        return cart
+
+
+def state_key(token):
+    return f'{KEY_PREFIX}:cart-state:{token}'
+
+
+def dirty_key(shard):
+    return f'{KEY_PREFIX}:cart-dirty:{shard}'
+
+
+def mark_dirty(token):
+    key = dirty_key(zlib.crc32(token.encode()) % DIRTY_SHARDS)
+    with cache_lock(key):
+        tokens = cache.get(key) or set()
+        tokens.add(token)
+        cache.set(key, tokens, timeout=None)
+
+
+def take_dirty():
+    # Empty every dirty list, returning the tokens of the carts that have unflushed changes
+    tokens = set()
+    for shard in range(DIRTY_SHARDS):
+        key = dirty_key(shard)
+        with cache_lock(key):
+            tokens.update(cache.get(key) or ())
+            cache.delete(key)
+    return tokens
+
+
+def sync_cart_items(cart, lines, user_id):
+    # Make the cart's CartItem rows match {product_id: quantity}
+    items = {item.product_id: item for item in cart.items.all()}
+    stale = [item.pk for product_id, item in items.items() if product_id not in lines]
+    if stale:
+        CartItem.objects.filter(pk__in=stale).delete()
+
+    changed = []
+    for product_id, quantity in lines.items():
+        if product_id in items and items[product_id].quantity != quantity:
+            items[product_id].quantity = quantity
+            changed.append(items[product_id])
+    CartItem.objects.bulk_update(changed, ['quantity'])
+
+    # Products deleted since they were added are dropped
+    new_ids = Product.objects.filter(pk__in=[pk for pk in lines if pk not in items]).values_list('pk', flat=True)
+    # One by one, MySQL does not return the primary keys of a bulk insert
+    new_items = [CartItem.objects.create(user_id=user_id, product_id=pk, quantity=lines[pk]) for pk in new_ids]
+    if new_items:
+        cart.items.add(*new_items)
+
+
+def flush_cart(token):
+    """
+    Write the cached state of one cart to its Cart and CartItem rows and
+    return the cart id (None if there is nothing to write). Changes made
+    while the flush runs stay pending for the next one.
+    """
+    key = state_key(token)
+    with cache_lock(f'{key}:flush', timeout=60):
+        state = cache.get(key)
+        if state is None:
+            return None
+        if state['version'] == state['flushed']:
+            return state['cart_id']
+
+        with transaction.atomic():
+            # Not a cart that has been paid for since
+            cart = Cart.objects.active().filter(pk=state['cart_id']).first() if state['cart_id'] else None
+            if cart is None and state['user_id']:
+                cart = Cart.objects.get_or_create_active(state['user_id'])[0]
+            if cart is None:
+                cart = Cart.objects.create()
+            sync_cart_items(cart, state['lines'], state['user_id'])
+
+        with cache_lock(key):
+            current = cache.get(key) or state
+            current['cart_id'] = cart.pk
+            current['flushed'] = max(current['flushed'], state['version'])
+            cache.set(key, current, CART_STATE_TIMEOUT)
+        return cart.pk
+
+
+class CacheCartStore:
+    """
+    The live cart is a cache entry, so adding to cart costs cache round
+    trips only. Changed carts are listed in DIRTY_SHARDS cache entries and
+    written to the database by manage.py flush_carts, or right away where
+    the rows are needed: the cart page and payment (flush()).
+
+    Needs a cache shared by all workers that survives restarts (Redis,
+    memcached with persistence) outside of development.
+    """
+    live_counts = True
+
+    def __init__(self, request):
+        self.request = request
+
+    @property
+    def token(self):
+        if self.request.user.is_authenticated:
+            return f'user-{self.request.user.pk}'
+        return self.request.session.get('cart_token')
+
+    def get_state(self):
+        token = self.token
+        return cache.get(state_key(token)) if token else None
+
+    def new_state(self):
+        # Start from the database cart, if any, so switching backends keeps carts
+        cart = get_cart(self.request).cart
+        return {
+            'lines': {item.product_id: item.quantity for item in cart.items.all()} if cart else {},
+            'version': 0,
+            'flushed': 0,
+            'cart_id': cart.pk if cart else None,
+            'user_id': self.request.user.pk if self.request.user.is_authenticated else None,
+        }
+
+    def update(self, change, flushed=False):
+        token = self.token
+        if token is None:
+            token = self.request.session['cart_token'] = secrets.token_urlsafe(16)
+        key = state_key(token)
+        with cache_lock(key):
+            state = cache.get(key) or self.new_state()
+            was_clean = state['version'] == state['flushed']
+            change(state['lines'])
+            state['version'] += 1
+            if flushed:
+                state['flushed'] = state['version']
+            cache.set(key, state, CART_STATE_TIMEOUT)
+        if was_clean and not flushed:
+            mark_dirty(token)
+
+    def has_cart(self):
+        return self.token is not None or bool(self.request.session.get('cart_id'))
+
+    def count_items(self):
+        state = self.get_state()
+        return len(state['lines']) if state else get_cart(self.request).get_total_items()
+
+    def get_quantity(self, product):
+        state = self.get_state()
+        if state is None:
+            return DatabaseCartStore(self.request).get_quantity(product)
+        return state['lines'].get(product.pk)
+
+    def get_lines(self):
+        state = self.get_state()
+        if state is None:
+            return DatabaseCartStore(self.request).get_lines()
+        return dict(state['lines'])
+
+    def add(self, product, quantity):
+        self.update(lambda lines: lines.__setitem__(product.pk, lines.get(product.pk, 0) + quantity))
+
+    def set_quantity(self, product, quantity):
+        self.update(lambda lines: lines.__setitem__(product.pk, quantity))
+
+    def remove(self, product_id):
+        self.update(lambda lines: lines.pop(product_id, None))
+
+    def flush(self):
+        token = self.token
+        cart_id = flush_cart(token) if token else None
+        if cart_id and not self.request.user.is_authenticated and self.request.session.get('cart_id') != cart_id:
+            self.request.session['cart_id'] = cart_id
+            self.request.__dict__.pop('_lazy_cart', None)
+        return get_cart(self.request)
+
+    def clear(self):
+        # After payment: empty the rows and the state without a flush in between
+        self.update(lambda lines: lines.clear(), flushed=True)
+        DatabaseCartStore(self.request).clear()
+
+    def checkout(self, reference):
+        # The rows the order is made from must be complete, then the state starts over empty
+        self.flush()
+        cart = DatabaseCartStore(self.request).checkout(reference)
+        self.update(lambda lines: lines.clear(), flushed=True)
+        return cart
+
+
+def merge_carts(cart, others):
+    """
+    Move the lines of the carts in others into cart, adding up the
+    quantities of products that are in both, and delete the emptied carts.
+    The number of queries does not grow with the number of lines.
+    """
+    other_ids = [other.pk for other in others if other.pk != cart.pk]
+    if not other_ids:
+        return
+    lines = {item.product_id: item for item in cart.items.all()}
+    own_ids = {item.pk for item in lines.values()}
+
+    changed, moved, merged = {}, [], []
+    for item in CartItem.objects.filter(cart__in=other_ids).distinct().order_by('pk'):
+        if item.pk in own_ids:
+            continue
+        line = lines.get(item.product_id)
+        if line is None:
+            lines[item.product_id] = item
+            moved.append(item)
+        else:
+            line.quantity += item.quantity
+            changed[line.pk] = line
+            merged.append(item.pk)
+
+    with transaction.atomic():
+        CartItem.objects.bulk_update(changed.values(), ['quantity'])
+        CartItem.objects.filter(pk__in=[item.pk for item in moved]).update(user_id=cart.user_id)
+        # Deleting the carts drops their links to the moved lines too
+        Cart.objects.filter(pk__in=other_ids).delete()
+        CartItem.objects.filter(pk__in=merged).delete()
+        if moved:
+            cart.items.add(*moved)
+
+
+def merge_session_cart(request, user):
+    """
+    Fold the cart a visitor filled before logging in into the user's
+    active cart. Returns the id of the user's cart, None if there was
+    nothing to merge.
+    """
+    token = request.session.pop('cart_token', None)
+    if token:
+        # The cache backend's unwritten changes first, the cart is rebuilt from the rows next time
+        cart_id = flush_cart(token)
+        cache.delete(state_key(token))
+        if cart_id:
+            request.session['cart_id'] = cart_id
+
+    cart_id = request.session.pop('cart_id', None)
+    anonymous = Cart.objects.active().filter(pk=cart_id, user__isnull=True).first() if cart_id else None
+    if anonymous is None:
+        return None
+
+    user_token = f'user-{user.pk}'
+    flush_cart(user_token)
+    cache.delete(state_key(user_token))
+    with transaction.atomic():
+        cart = Cart.objects.get_or_create_active(user.pk)[0]
+        merge_carts(cart, [anonymous])
+
+    # Whatever this request looked up before the login is stale
+    request.__dict__.pop('_lazy_cart', None)
+    request.__dict__.pop('_cart_store', None)
+    return cart.pk
+
+
+def summarize_lines(lines):
+    """
+    The same figures as Cart.get_summary() plus per-line totals for
+    {product_id: quantity}, with one query for the prices.
+    """
+    products = Product.objects.filter(pk__in=lines).only(
+        'pk', 'price', 'discount', 'discount_price', 'shipping_fee',
+    ).order_by('pk')
+    rows = [
+        {
+            'product_id': product.pk,
+            'quantity': lines[product.pk],
+            'unit_price': product.effective_price,
+            'line_total': product.effective_price * lines[product.pk],
+        }
+        for product in products
+    ]
+    summary = {
+        'items': len(rows),
+        'total_quantity': sum(row['quantity'] for row in rows),
+        'subtotal': sum(row['line_total'] for row in rows),
+        'shipping': sum(product.shipping_fee for product in products),
+    }
+    return summary, rows
+
+
+CART_STORES = {
+    'database': DatabaseCartStore,
+    'cache': CacheCartStore,
+}
+
+
+def get_cart_store(request):
+    # The backend chosen by settings.CART_BACKEND, one per request
+    if not hasattr(request, '_cart_store'):
+        request._cart_store = CART_STORES[getattr(settings, 'CART_BACKEND', 'database')](request)
+    return request._cart_store
@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import HEADER_COUNTERS_TIMEOUT, header_counter_key
+from .cart import get_cart_store
+from .models import WishlistItem
+
+
+def count_cart_items(request):
+    return get_cart_store(request).count_items()
+
+
+def count_wishlist_items(request):
+    if request.user.is_authenticated:
+        return WishlistItem.objects.filter(wishlist__user=request.user).count()
+    return WishlistItem.objects.filter(wishlist_id=request.session.get('wishlist_id')).count()
+
+
+def get_header_counters(request):
+    """
+    The cart and wishlist counters of the header, one cache entry each per
+    user (or per anonymous cart and wishlist). Signals delete the entries
+    when the items change, see store/signals.py.
+    """
+    if hasattr(request, '_header_counters'):
+        return request._header_counters
+
+    user = request.user
+    if user.is_authenticated:
+        owners = {'cart': ('user', user.pk), 'wishlist': ('user', user.pk)}
+    else:
+        # A visitor without a cart or wishlist in the session has nothing to count
+        owners = {
+            counter: (counter, request.session[f'{counter}_id'])
+            for counter in ('cart', 'wishlist') if request.session.get(f'{counter}_id')
+        }
+
+    counters = {'cart': 0, 'wishlist': 0}
+    if get_cart_store(request).live_counts:
+        # The cache backend counts from its own cache entry
+        counters['cart'] = count_cart_items(request)
+        owners.pop('cart', None)
+    keys = {counter: header_counter_key(counter, owner) for counter, owner in owners.items()}
+    cached = cache.get_many(keys.values())
+    for counter, key in keys.items():
+        if key in cached:
+            counters[counter] = cached[key]
+        else:
+            counters[counter] = count_cart_items(request) if counter == 'cart' else count_wishlist_items(request)
+            cache.set(key, counters[counter], HEADER_COUNTERS_TIMEOUT)
+
+    request._header_counters = {
+        'cart_items_count': counters['cart'],
+        'wishlist_items_count': counters['wishlist'],
+    }
+    return request._header_counters
+
+
+def header_counters(request):
+    # Registered in TEMPLATES, so every page's header.html has its counters
+    return get_header_counters(request)
+
+
+def static_version(request):
+    # The ?v= of the asset links in head.html and script.html
+    return {'STATIC_VERSION': settings.STATIC_VERSION}
@@ -0,0 +1,103 @@
+import json
+import secrets
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Product
+from .pagination import CursorPaginator
+
+
+# Products loaded (with their images and categories) per database round trip
+EXPORT_BATCH_SIZE = 500
+# Export cursors are not interchangeable with the storefront's page cursors
+EXPORT_CURSOR_SALT = 'store.export.cursor'
+
+
+def serialize_product(product, request):
+    return {
+        'id': product.pk,
+        'slug': product.slug,
+        'name': product.name,
+        'url': request.build_absolute_uri(product.get_absolute_url()),
+        'description': product.description,
+        'details': product.details,
+        'price': product.price,
+        'effective_price': product.effective_price,
+        'discount': product.discount,
+        'discount_value': product.discount_value,
+        'discount_price': product.discount_price,
+        'shipping_fee': product.shipping_fee,
+        'is_new': product.is_new,
+        'hot_deal': product.hot_deal,
+        'categories': [category.name for category in product.categories.all()],
+        'images': [
+            request.build_absolute_uri(image.image.url)
+            for image in product.images.all() if image.image
+        ],
+        'updated_at': product.updated_at,
+    }
+
+
+def is_authorized(request):
+    # An "Authorization: Bearer <token>" header with one of settings.CATALOG_EXPORT_TOKENS, if any are set
+    if not settings.CATALOG_EXPORT_TOKENS:
+        return True
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and any(
+        secrets.compare_digest(token.strip(), allowed) for allowed in settings.CATALOG_EXPORT_TOKENS
+    )
+
+
+def export_paginator(queryset):
+    return CursorPaginator(queryset, 'updated_at', EXPORT_BATCH_SIZE, descending=False, salt=EXPORT_CURSOR_SALT)
+
+
+def check_cursor(cursor):
+    # Raises InvalidCursor; call it before the response starts streaming
+    export_paginator(Product.objects.all()).decode_cursor(cursor)
+
+
+def iter_products(updated_since=None, cursor=None, limit=None):
+    """
+    Yield (product, resume_cursor) in (updated_at, id) order. Every batch
+    is a keyset query, so memory stays flat however big the catalog is,
+    and an export can be resumed from the cursor of the last row received.
+    """
+    queryset = Product.objects.for_cards()
+    if updated_since is not None:
+        queryset = queryset.filter(updated_at__gte=updated_since)
+    paginator = export_paginator(queryset)
+
+    sent = 0
+    while True:
+        page = paginator.get_page(cursor)
+        for product in page:
+            yield product, paginator.encode_cursor(product, 'next')
+            sent += 1
+            if limit is not None and sent >= limit:
+                return
+        if not page.has_next():
+            return
+        cursor = page.next_cursor
+
+
+def encode(data):
+    return json.dumps(data, cls=DjangoJSONEncoder)
+
+
+def stream_ndjson(request, products):
+    # One product per line, each carrying the cursor to resume after it
+    for product, cursor in products:
+        yield encode(dict(serialize_product(product, request), cursor=cursor)) + '\n'
+
+
+def stream_json(request, products, limit=None):
+    yield '{"products": ['
+    count, cursor = 0, None
+    for product, cursor in products:
+        yield (',' if count else '') + encode(serialize_product(product, request))
+        count += 1
+    # Only a response cut short by limit has anything left to resume
+    next_cursor = cursor if limit is not None and count >= limit else None
+    yield '], "next_cursor": ' + encode(next_cursor) + '}'
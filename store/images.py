@@ -0,0 +1,301 @@
+import base64
+import functools
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+
+import django
+from django.core.files.base import ContentFile
+from django.db import connections
+from PIL import Image, ImageOps
+
+from .models import Product, ProductImage
+from .storage import ContentAddressedStorage
+
+
+# Longest side of each rendition, in pixels; smaller originals are never scaled up
+RENDITION_SIZES = {'card': 300, 'gallery': 600, 'zoom': 1200}
+RENDITION_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 6}),
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+RENDITION_DIR = 'renditions'
+# Longest side of the inline placeholder
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_FORMAT = ('WEBP', {'quality': 40})
+
+# Where the templates show an image: the rendition used as src, and the sizes attribute telling the
+# browser how wide the slot is so it picks from the srcset (breakpoints of static_in_env/css/style.css)
+IMAGE_SLOTS = {
+    'card': ('card', '(max-width: 480px) 100vw, (max-width: 991px) 50vw, 263px'),
+    'thumb': ('card', '100px'),
+    'gallery': ('gallery', '(max-width: 991px) 100vw, 458px'),
+}
+
+
+def rendition_name(name, size, extension):
+    # products/shoe.jpg -> renditions/products/shoe-card.webp
+    return f"{RENDITION_DIR}/{os.path.splitext(name)[0]}-{size}.{extension}"
+
+
+# Images a rebuild renders between two checkpoints
+REBUILD_BATCH_SIZE = 200
+
+
+def read_source(image):
+    # Returns (bytes of the original, their hash); the hash covers the rendition settings too, so
+    # changing a size or quality above makes manage.py rebuild_images render every image again
+    with image.image.storage.open(image.image.name) as f:
+        data = f.read()
+    settings = repr((
+        sorted(RENDITION_SIZES.items()), sorted(RENDITION_FORMATS.items()), PLACEHOLDER_SIZE, PLACEHOLDER_FORMAT,
+    ))
+    return data, hashlib.sha256(data + settings.encode()).hexdigest()
+
+
+def open_source(data):
+    source = Image.open(io.BytesIO(data))
+    source = ImageOps.exif_transpose(source)
+    source.load()
+    if source.mode in ('RGBA', 'LA', 'P'):
+        # JPEG has no transparency: flatten on white, as the pages' background
+        source = source.convert('RGBA')
+        flattened = Image.new('RGB', source.size, (255, 255, 255))
+        flattened.paste(source, mask=source.getchannel('A'))
+        return flattened
+    return source.convert('RGB')
+
+
+def make_placeholder(source):
+    # A data: URI small enough to inline in every card, shown scaled up until a rendition loads
+    copy = source.copy()
+    copy.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    buffer = io.BytesIO()
+    format, options = PLACEHOLDER_FORMAT
+    copy.save(buffer, format, **options)
+    return f"data:image/{format.lower()};base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+
+def rendition_files(renditions):
+    return {
+        rendition[extension] for rendition in renditions.values() for extension in RENDITION_FORMATS
+        if extension in rendition
+    }
+
+
+def write_renditions(image, source):
+    # Returns ({size: rendition}, bytes written)
+    storage = image.image.storage
+    renditions, written, previous = {}, 0, None
+    for size, longest in sorted(RENDITION_SIZES.items(), key=lambda item: item[1]):
+        copy = source.copy()
+        copy.thumbnail((longest, longest), Image.LANCZOS)
+        if previous is not None and copy.size == (previous['width'], previous['height']):
+            # The original is smaller than this size: same files as the size below
+            renditions[size] = previous
+            continue
+        rendition = {'width': copy.width, 'height': copy.height}
+        for extension, (format, options) in RENDITION_FORMATS.items():
+            buffer = io.BytesIO()
+            copy.save(buffer, format, **options)
+            name = rendition_name(image.image.name, size, extension)
+            if not isinstance(storage, ContentAddressedStorage):
+                # Overwrite instead of letting the storage pick a new name
+                storage.delete(name)
+            rendition[extension] = storage.save(name, ContentFile(buffer.getvalue()))
+            written += buffer.tell()
+        renditions[size] = previous = rendition
+    return renditions, written
+
+
+def render_image(pk, force=False):
+    """
+    Generate the renditions of ProductImage pk and record them on its row,
+    unless they were made from the same original with the same settings
+    (force renders them anyway). Returns (status, bytes written, bytes of
+    the renditions replaced or None if there were none). An original that
+    cannot be read is marked 'failed' and rendered without renditions, so
+    the templates fall back to it.
+    """
+    image = ProductImage.objects.filter(pk=pk).first()
+    if image is None or not image.image:
+        return 'skipped', 0, None
+    name, storage = image.image.name, image.image.storage
+    try:
+        data, source_hash = read_source(image)
+    except OSError:
+        data, source_hash = None, ''
+    if not force and source_hash and source_hash == image.source_hash and image.rendered_from == name:
+        return 'skipped', 0, None
+
+    old_files = rendition_files(image.renditions)
+    replaced = sum(storage.size(file) for file in old_files if storage.exists(file)) if old_files else None
+    # The same upload for another product (see store/storage.py) may have been rendered already
+    shared = None if force or not source_hash else (
+        ProductImage.objects.filter(rendered_from=name, source_hash=source_hash).exclude(pk=pk)
+        .exclude(renditions={}).values('renditions', 'placeholder', 'width', 'height').first()
+    )
+    try:
+        if data is None:
+            raise OSError("Unreadable original")
+        if shared:
+            fields, written = shared, 0
+        else:
+            source = open_source(data)
+            renditions, written = write_renditions(image, source)
+            fields = {
+                'renditions': renditions, 'placeholder': make_placeholder(source),
+                'width': source.width, 'height': source.height,
+            }
+        status = 'rendered'
+    except OSError:
+        fields, written, status = {'renditions': {}, 'placeholder': '', 'width': None, 'height': None}, 0, 'failed'
+    renditions = fields['renditions']
+
+    # Only if the image was not replaced meanwhile; the replacement is pending again
+    updated = ProductImage.objects.filter(pk=pk, image=name).update(
+        rendered_from=name, source_hash=source_hash, **fields,
+    )
+    if updated:
+        Product.objects.filter(pk=image.product_id).touch()
+        # Except those other images of the same upload still show
+        shown = set(rendition_files(renditions))
+        for other in ProductImage.objects.filter(rendered_from=image.rendered_from).exclude(pk=pk).values_list(
+            'renditions', flat=True,
+        ):
+            shown |= rendition_files(other)
+        for file in old_files - shown:
+            storage.delete(file)
+    return status, written, replaced
+
+
+def init_worker():
+    # Spawned (not forked) workers start without Django
+    django.setup()
+
+
+def default_processes():
+    # The cores this process may use, fewer than os.cpu_count() under a CPU affinity limit
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@contextmanager
+def image_pool(processes=None):
+    """
+    Yield a map(function, pks) that runs function over pks in a pool of
+    processes, one per core by default; with 1 it runs in this process.
+    """
+    processes = processes or default_processes()
+    if processes == 1:
+        yield lambda function, pks: [function(pk) for pk in pks]
+        return
+    # Forked workers must not share this process's database connections
+    connections.close_all()
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        yield lambda function, pks: pool.map(function, pks, chunksize=max(len(pks) // (processes * 4), 1))
+
+
+def tally(results, totals=None):
+    # Adds render_image results up: {'rendered', 'skipped', 'failed', 'written', 'saved'}
+    totals = totals or {'rendered': 0, 'skipped': 0, 'failed': 0, 'written': 0, 'saved': 0}
+    for status, written, replaced in results:
+        totals[status] += 1
+        totals['written'] += written
+        if replaced is not None and status == 'rendered':
+            # Smaller renditions than the ones they replace, e.g. after lowering the quality
+            totals['saved'] += replaced - written
+    return totals
+
+
+def render_pending(processes=None):
+    # Render new and replaced images; returns (totals, seconds)
+    started = time.monotonic()
+    pks = list(ProductImage.objects.pending().order_by('pk').values_list('pk', flat=True))
+    with image_pool(1 if len(pks) <= 1 else processes) as map:
+        results = map(render_image, pks)
+    return tally(results), time.monotonic() - started
+
+
+def read_checkpoint(path, key):
+    # The pk a rebuild stopped after, if path holds a checkpoint of the same rebuild
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return checkpoint.get('last') if checkpoint.get('key') == key else None
+
+
+def write_checkpoint(path, key, last):
+    # Renamed into place, so an interrupted write never leaves half a checkpoint
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'key': key, 'last': last}, f)
+    os.replace(path + '.tmp', path)
+
+
+def rebuild_images(queryset, processes=None, batch_size=REBUILD_BATCH_SIZE, force=False, checkpoint=None, log=None):
+    """
+    Render the images of queryset again in batches of batch_size, walking
+    the primary key, skipping those whose source hash has not changed
+    unless force. After every batch the last pk is written to the file
+    checkpoint, and a rebuild of the same queryset started later resumes
+    after it. Returns (totals, seconds) of this run.
+    """
+    started = time.monotonic()
+    key = hashlib.sha256(f"{queryset.query}|{force}".encode()).hexdigest()
+    last = read_checkpoint(checkpoint, key) if checkpoint else None
+    if last is not None and log:
+        log(f"Resuming after image {last}")
+    totals = tally([])
+    render = functools.partial(render_image, force=force)
+    with image_pool(processes) as map:
+        while True:
+            batch = queryset.order_by('pk')
+            if last is not None:
+                batch = batch.filter(pk__gt=last)
+            pks = list(batch.values_list('pk', flat=True).distinct()[:batch_size])
+            if not pks:
+                break
+            tally(map(render, pks), totals)
+            last = pks[-1]
+            if checkpoint:
+                write_checkpoint(checkpoint, key, last)
+            if log:
+                log(f"{totals['rendered']} rendered, {totals['skipped']} skipped, up to image {last}")
+    if checkpoint and os.path.exists(checkpoint):
+        # Done: the next rebuild starts from the beginning
+        os.remove(checkpoint)
+    return totals, time.monotonic() - started
+
+
+def slot_image(image, slot):
+    """
+    What the store_images template tags render for image in slot: src,
+    the WebP and JPEG srcsets, the intrinsic size (so the page reserves the
+    space before the image loads) and the placeholder shown meanwhile. The
+    original is the src until the renditions exist.
+    """
+    size, sizes = IMAGE_SLOTS[slot]
+    renditions = image.renditions if image.rendered_from == image.image.name else {}
+    if not renditions:
+        return {'src': image.image.url, 'sizes': sizes}
+    url = image.image.storage.url
+    srcsets = {}
+    for extension in RENDITION_FORMATS:
+        widths = {}
+        for rendition in renditions.values():
+            widths[rendition['width']] = url(rendition[extension])
+        srcsets[extension] = ', '.join(f"{widths[width]} {width}w" for width in sorted(widths))
+    return {
+        'src': url(renditions[size]['jpeg']), 'sizes': sizes,
+        'width': renditions[size]['width'], 'height': renditions[size]['height'],
+        'placeholder': image.placeholder,
+        'webp_srcset': srcsets['webp'], 'jpeg_srcset': srcsets['jpeg'],
+        'zoom': url(renditions['zoom']['jpeg']),
+    }
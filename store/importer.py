@@ -0,0 +1,297 @@
+import csv
+import json
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+from django.utils.text import slugify
+
+from .caching import invalidate_all_cart_summaries, invalidate_homepage_blocks
+from .models import Category, Product
+from .related import rebuild_related_products
+from .search import index_products
+
+
+# Rows imported per second; store/tests.py benchmarks it with STORE_BENCHMARKS=1
+TARGET_ROWS_PER_SECOND = 500
+
+ProductCategory = Product.categories.through
+ProductRelation = Product.related_products.through
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'on')
+SLUG_MAX_LENGTH = Product._meta.get_field('slug').max_length
+NAME_MAX_LENGTH = Product._meta.get_field('name').max_length
+
+# Columns copied onto Product; discount_price and slug are derived like Product.save does
+PRODUCT_FIELDS = (
+    'name', 'price', 'description', 'details', 'discount', 'discount_value',
+    'is_new', 'hot_deal', 'shipping_fee',
+)
+PRODUCT_DEFAULTS = {
+    'description': '',
+    'details': '',
+    'discount': False,
+    'discount_value': 0,
+    'is_new': True,
+    'hot_deal': False,
+    'shipping_fee': 0,
+}
+
+
+class RowError(ValueError):
+    pass
+
+
+def read_rows(path, file_format=None):
+    # Yield (line number, raw row dict) from a CSV or JSON Lines file
+    file_format = file_format or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    with open(path, newline='', encoding='utf-8') as handle:
+        if file_format == 'csv':
+            for line, row in enumerate(csv.DictReader(handle), start=2):
+                yield line, row
+        else:
+            for line, text in enumerate(handle, start=1):
+                if text.strip():
+                    try:
+                        yield line, json.loads(text)
+                    except ValueError as e:
+                        yield line, RowError(f"invalid JSON: {e}")
+
+
+def split_list(value):
+    # CSV cells hold lists as "a|b|c"; JSON rows can use real lists
+    if value is None or value == '':
+        return []
+    if isinstance(value, str):
+        return [item.strip() for item in value.split('|') if item.strip()]
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def to_int(value, name):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise RowError(f"{name} must be a whole number")
+    if number < 0:
+        raise RowError(f"{name} must not be negative")
+    return number
+
+
+def clean_row(raw):
+    if isinstance(raw, RowError):
+        raise raw
+    if not isinstance(raw, dict):
+        raise RowError("row must be an object")
+
+    name = str(raw.get('name') or '').strip()
+    if not name:
+        raise RowError("name is required")
+    try:
+        price = Decimal(str(raw.get('price'))).quantize(Decimal('0.01'))
+    except (InvalidOperation, ValueError):
+        raise RowError("price must be a number")
+    if price < 0 or price >= Decimal('1000000'):
+        raise RowError("price is out of range")
+
+    row = {'name': name[:NAME_MAX_LENGTH], 'price': price}
+    if len(name) > NAME_MAX_LENGTH:
+        # Imported anyway, CatalogImporter reports it
+        row['truncated'] = True
+    for field, default in PRODUCT_DEFAULTS.items():
+        value = raw.get(field)
+        if value is None or value == '':
+            row[field] = default
+        elif isinstance(default, bool):
+            row[field] = to_bool(value)
+        elif isinstance(default, int):
+            row[field] = to_int(value, field)
+        else:
+            row[field] = str(value)
+    if row['discount_value'] > 100:
+        raise RowError("discount_value must be at most 100")
+
+    row['slug'] = (slugify(raw.get('slug') or '') or slugify(name))[:SLUG_MAX_LENGTH]
+    if not row['slug']:
+        raise RowError("could not derive a slug")
+    # Only touch categories / related products when the row mentions them
+    if 'categories' in raw:
+        row['categories'] = split_list(raw['categories'])
+    if 'related' in raw:
+        row['related'] = [slugify(slug)[:SLUG_MAX_LENGTH] for slug in split_list(raw['related'])]
+    return row
+
+
+class CatalogImporter:
+    """
+    Upsert products by slug in batches: one bulk_create and one
+    bulk_update per batch, category links and related products written
+    as bulk inserts into the M2M tables. Signals do not fire for bulk
+    writes, so the derived data they normally maintain (search index,
+    related lists, homepage cache) is refreshed here explicitly.
+    """
+
+    def __init__(self, batch_size=1000, dry_run=False, rebuild_related=True, log=None):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.rebuild_related = rebuild_related
+        self.log = log or (lambda message: None)
+        self.category_ids = {}
+        self.pending_relations = []
+        self.imported_ids = set()
+        self.stats = {'rows': 0, 'created': 0, 'updated': 0, 'skipped': 0, 'duplicates': 0, 'truncated': 0}
+        # (line, message) of rows that were skipped, and of rows imported other than as written
+        self.errors = []
+        self.warnings = []
+
+    def run(self, rows):
+        started = time.monotonic()
+        batch = {}
+        for line, raw in rows:
+            self.stats['rows'] += 1
+            try:
+                row = clean_row(raw)
+            except RowError as e:
+                self.stats['skipped'] += 1
+                self.errors.append((line, str(e)))
+                continue
+            if row.pop('truncated', False):
+                self.stats['truncated'] += 1
+                self.warnings.append((line, f"name cut to {NAME_MAX_LENGTH} characters"))
+            # A slug repeated in one batch: the last row wins, as it would across batches
+            if row['slug'] in batch:
+                self.stats['duplicates'] += 1
+                dropped = batch.pop(row['slug'])['line']
+                self.warnings.append((dropped, f"replaced by line {line}, which has the same slug '{row['slug']}'"))
+            batch[row['slug']] = dict(row, line=line)
+            if len(batch) >= self.batch_size:
+                self.import_batch(list(batch.values()))
+                batch = {}
+                self.report(started)
+        if batch:
+            self.import_batch(list(batch.values()))
+            self.report(started)
+
+        # Throughput of the row import itself; the related lists below scale with the catalog instead
+        elapsed = time.monotonic() - started
+        self.stats['rows_per_second'] = self.stats['rows'] / elapsed if elapsed else 0
+
+        if not self.dry_run:
+            self.import_relations()
+            if self.rebuild_related:
+                self.log(f"Rebuilding related product lists of {len(self.imported_ids)} products")
+                ids = sorted(self.imported_ids)
+                for start in range(0, len(ids), self.batch_size):
+                    rebuild_related_products(ids[start:start + self.batch_size])
+            invalidate_homepage_blocks()
+            if self.stats['updated']:
+                # Re-imported products can change the prices in carts
+                invalidate_all_cart_summaries()
+
+        self.stats['seconds'] = time.monotonic() - started
+        return self.stats
+
+    def report(self, started):
+        elapsed = time.monotonic() - started
+        rate = self.stats['rows'] / elapsed if elapsed else 0
+        self.log(
+            f"{self.stats['rows']} rows: {self.stats['created']} created, {self.stats['updated']} updated, "
+            f"{self.stats['skipped']} skipped ({rate:.0f} rows/s)"
+        )
+
+    def import_batch(self, rows):
+        existing = set(Product.objects.filter(slug__in=[row['slug'] for row in rows]).values_list('slug', flat=True))
+        if self.dry_run:
+            self.stats['updated'] += len(existing)
+            self.stats['created'] += len(rows) - len(existing)
+            return
+
+        products = []
+        for row in rows:
+            product = Product(**{field: row[field] for field in PRODUCT_FIELDS}, slug=row['slug'])
+            # The same side effects as Product.save
+            product.update_discount_price()
+            product.update_slug()
+            products.append(product)
+
+        with transaction.atomic():
+            # One INSERT ... ON CONFLICT/ON DUPLICATE KEY UPDATE per batch, keyed on the unique slug
+            Product.objects.bulk_create(
+                products,
+                update_conflicts=True,
+                unique_fields=['slug'] if connection.features.supports_update_conflicts_with_target else None,
+                update_fields=[*PRODUCT_FIELDS, 'discount_price', 'updated_at'],
+            )
+            # MySQL does not return primary keys from bulk inserts, look them up by slug
+            product_ids = dict(
+                Product.objects.filter(slug__in=[row['slug'] for row in rows]).values_list('slug', 'pk')
+            )
+            self.import_categories(rows, product_ids)
+            index_products(Product.objects.filter(pk__in=product_ids.values()), batch_size=self.batch_size)
+
+        self.stats['created'] += len(rows) - len(existing)
+        self.stats['updated'] += len(existing)
+        self.imported_ids.update(product_ids.values())
+        for row in rows:
+            if 'related' in row:
+                self.pending_relations.append((product_ids[row['slug']], row['related']))
+
+    def resolve_categories(self, names):
+        missing = {name for name in names if name not in self.category_ids}
+        if missing:
+            for pk, name in Category.objects.filter(name__in=missing).order_by('-pk').values_list('pk', 'name'):
+                self.category_ids[name] = pk
+            new = [Category(name=name) for name in missing if name not in self.category_ids]
+            if new:
+                Category.objects.bulk_create(new)
+                for pk, name in Category.objects.filter(name__in=[c.name for c in new]).values_list('pk', 'name'):
+                    self.category_ids[name] = pk
+
+    def import_categories(self, rows, product_ids):
+        rows = [row for row in rows if 'categories' in row]
+        if not rows:
+            return
+        self.resolve_categories({name for row in rows for name in row['categories']})
+
+        # The row's list replaces whatever the product was filed under before
+        ProductCategory.objects.filter(product_id__in=[product_ids[row['slug']] for row in rows]).delete()
+        links = {
+            (product_ids[row['slug']], self.category_ids[name])
+            for row in rows for name in row['categories']
+        }
+        ProductCategory.objects.bulk_create(
+            [ProductCategory(product_id=product_id, category_id=category_id) for product_id, category_id in links],
+            batch_size=self.batch_size,
+        )
+
+    def import_relations(self):
+        # Related slugs can point at rows further down the file, so they are linked last
+        for start in range(0, len(self.pending_relations), self.batch_size):
+            chunk = self.pending_relations[start:start + self.batch_size]
+            slugs = {slug for _, related in chunk for slug in related}
+            related_ids = dict(Product.objects.filter(slug__in=slugs).values_list('slug', 'pk'))
+            source_ids = [product_id for product_id, _ in chunk]
+
+            pairs = set()
+            for product_id, related in chunk:
+                for slug in related:
+                    related_id = related_ids.get(slug)
+                    if related_id and related_id != product_id:
+                        # related_products is symmetrical, store both directions
+                        pairs.add((product_id, related_id))
+                        pairs.add((related_id, product_id))
+
+            with transaction.atomic():
+                ProductRelation.objects.filter(from_product_id__in=source_ids).delete()
+                ProductRelation.objects.filter(to_product_id__in=source_ids).delete()
+                ProductRelation.objects.bulk_create(
+                    [ProductRelation(from_product_id=a, to_product_id=b) for a, b in pairs],
+                    batch_size=self.batch_size,
+                    ignore_conflicts=True,
+                )
+            self.imported_ids.update(related_ids.values())
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from store.static_assets import brotli, precompress
+
+
+class Command(BaseCommand):
+    help = (
+        'Build STATIC_ROOT for production: collect and hash the static files, compile LESS/SASS, '
+        'run the offline compressor and write gzip and Brotli variants of every text file'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear', action='store_true', help='Empty STATIC_ROOT first')
+
+    def handle(self, *args, **options):
+        verbosity = max(options['verbosity'] - 1, 0)
+        self.stdout.write('Collecting static files')
+        call_command('collectstatic', interactive=False, clear=options['clear'], verbosity=verbosity)
+        if 'static_precompiler' in settings.INSTALLED_APPS:
+            # Ahead of time, instead of on the first request for each file
+            self.stdout.write('Compiling LESS/SASS')
+            call_command('compilestatic', verbosity=verbosity)
+        if 'compressor' in settings.INSTALLED_APPS and settings.COMPRESS_ENABLED and settings.COMPRESS_OFFLINE:
+            self.stdout.write('Compressing the {% compress %} blocks')
+            call_command('compress', force=True, verbosity=verbosity)
+
+        if brotli is None:
+            self.stderr.write('The brotli package is not installed: writing gzip variants only')
+        files, written, saved = precompress(settings.STATIC_ROOT)
+        self.stdout.write(self.style.SUCCESS(
+            f"Precompressed {files} files: {written} variants written, {saved / 1024:.0f} KiB saved"
+        ))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.cart import merge_carts
+from store.models import Cart
+from store.signals import expire_cart_summaries
+
+
+class Command(BaseCommand):
+    help = "Merge users' duplicate carts (left inactive by migration 0010) into their active cart"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Users handled per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the duplicate carts')
+
+    def handle(self, *args, **options):
+        # Unpaid carts that are not active and not checked out (no reference): duplicates from
+        # before the one-active-cart constraint
+        duplicates = Cart.objects.filter(
+            user__isnull=False, is_active__isnull=True, is_paid=False, reference__isnull=True,
+        )
+        if options['dry_run']:
+            self.stdout.write(f"{duplicates.count()} duplicate carts")
+            return
+
+        batch_size = options['batch_size']
+        user_ids = list(duplicates.order_by('user').values_list('user', flat=True).distinct())
+        merged = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            carts = {}
+            for cart in duplicates.filter(user__in=batch).order_by('pk'):
+                carts.setdefault(cart.user_id, []).append(cart)
+            active = {cart.user_id: cart for cart in Cart.objects.active().filter(user__in=batch)}
+
+            with transaction.atomic():
+                for user_id, others in carts.items():
+                    if user_id not in active:
+                        active[user_id] = Cart.objects.get_or_create_active(user_id)[0]
+                    merge_carts(active[user_id], others)
+                    merged += len(others)
+                expire_cart_summaries([cart.pk for cart in active.values()])
+            self.stdout.write(f"{min(start + batch_size, len(user_ids))}/{len(user_ids)} users")
+
+        self.stdout.write(self.style.SUCCESS(f"Merged {merged} duplicate carts"))
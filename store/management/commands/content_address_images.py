@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from store.caching import invalidate_homepage_blocks
+from store.models import Order, Product, ProductImage
+from store.storage import is_content_addressed
+
+
+class Command(BaseCommand):
+    help = 'Move product images saved under their upload name to content-addressed names, merging duplicates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Images moved per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the images to move')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        storage = ProductImage._meta.get_field('image').storage
+        images = ProductImage.objects.exclude(image='').exclude(image__isnull=True).order_by('pk')
+        moved, merged, missing, last = 0, 0, 0, 0
+        while True:
+            batch = list(images.filter(pk__gt=last)[:options['batch_size']])
+            if not batch:
+                break
+            last = batch[-1].pk
+            legacy = [image for image in batch if not is_content_addressed(image.image.name)]
+            if options['dry_run']:
+                moved += len(legacy)
+                continue
+
+            # Copy the files first; the rows point at them only once they exist
+            names = {}
+            for image in legacy:
+                old = image.image.name
+                if old not in names:
+                    if not storage.exists(old):
+                        missing += 1
+                        continue
+                    with storage.open(old) as f:
+                        new = storage.save(old, f)
+                    merged += new in names.values() or ProductImage.objects.filter(image=new).exists()
+                    names[old] = new
+
+            with transaction.atomic():
+                for image in legacy:
+                    old = image.image.name
+                    if old not in names:
+                        continue
+                    fields = {'image': names[old]}
+                    if image.rendered_from == old:
+                        # The renditions stay shown; a cleared hash has manage.py rebuild_images move them too
+                        fields.update(rendered_from=names[old], source_hash='')
+                    moved += ProductImage.objects.filter(pk=image.pk, image=old).update(**fields)
+                for old, new in names.items():
+                    # Orders keep a copy of the name of their first product's image
+                    Order.objects.filter(image=old).update(image=new)
+                Product.objects.filter(pk__in={image.product_id for image in legacy}).touch()
+
+            for old in names:
+                if not ProductImage.objects.filter(image=old).exists() and not Order.objects.filter(image=old).exists():
+                    storage.delete(old)
+            self.stdout.write(f"{moved} images moved, up to image {last}")
+
+        if options['dry_run']:
+            self.stdout.write(f"{moved} images to move")
+            return
+        invalidate_homepage_blocks()
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {moved} images ({merged} duplicates merged, {missing} missing files left as they were); "
+            f"run manage.py rebuild_images to move their renditions too"
+        ))
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.cart import flush_cart, mark_dirty, take_dirty
+
+
+class Command(BaseCommand):
+    help = 'Write carts changed in the cache (CART_BACKEND = "cache") to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help='Keep running, flushing every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            flushed = failed = 0
+            for token in take_dirty():
+                try:
+                    flush_cart(token)
+                    flushed += 1
+                except Exception as e:
+                    # Keep it listed for the next run
+                    mark_dirty(token)
+                    failed += 1
+                    self.stderr.write(f"{token}: {e}")
+
+            elapsed = time.monotonic() - started
+            self.stdout.write(f"Flushed {flushed} carts, {failed} failed in {elapsed:.1f}s")
+            if not options['loop']:
+                break
+            time.sleep(max(options['loop'] - elapsed, 0))
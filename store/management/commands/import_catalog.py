@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.importer import CatalogImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Create or update products from a CSV or JSON Lines file, matched by slug'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV with a header row, or one JSON object per line')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Validate and count, write nothing')
+        parser.add_argument(
+            '--skip-related', action='store_true',
+            help='Leave the related product lists to manage.py rebuild_related_products',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        importer = CatalogImporter(
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            rebuild_related=not options['skip_related'],
+            log=self.stdout.write,
+        )
+        try:
+            stats = importer.run(read_rows(options['path'], options['format']))
+        except OSError as e:
+            raise CommandError(e)
+
+        for line, error in importer.errors:
+            self.stderr.write(f"line {line}: {error}")
+        for line, warning in sorted(importer.warnings):
+            self.stderr.write(f"line {line}: warning: {warning}")
+        prefix = 'Dry run: would have ' if options['dry_run'] else ''
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}{stats['created']} created, {stats['updated']} updated, {stats['skipped']} skipped "
+            f"of {stats['rows']} rows in {stats['seconds']:.1f}s (imported at {stats['rows_per_second']:.0f} rows/s)"
+        ))
+        if stats['duplicates'] or stats['truncated']:
+            self.stdout.write(self.style.WARNING(
+                f"{stats['duplicates']} rows replaced by a later row with the same slug, "
+                f"{stats['truncated']} names cut to fit"
+            ))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.payments import EVENT_BATCH_SIZE, process_payment_events
+
+
+class Command(BaseCommand):
+    help = 'Turn the payment callbacks stored by api/payment/ into orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Events processed side by side')
+        parser.add_argument('--batch-size', type=int, default=EVENT_BATCH_SIZE, help='Events a worker claims at a time')
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help='Keep running, polling every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            counts, seconds = process_payment_events(options['workers'], options['batch_size'])
+            processed = sum(counts.values())
+            if processed or not options['loop']:
+                summary = ', '.join(f"{count} {status}" for status, count in sorted(counts.items())) or 'nothing to do'
+                rate = processed / seconds if seconds else 0
+                self.stdout.write(f"Processed {processed} events: {summary} in {seconds:.1f}s ({rate:.0f} events/s)")
+            if not options['loop']:
+                break
+            time.sleep(max(options['loop'] - seconds, 0))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.purge import PURGE_CHUNK_SIZE, STALE_CART_DAYS, purge_stale
+
+
+class Command(BaseCommand):
+    help = 'Delete abandoned anonymous carts, orphaned cart items, empty anonymous wishlists and expired sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=STALE_CART_DAYS, help='Age of an abandoned anonymous cart')
+        parser.add_argument('--chunk-size', type=int, default=PURGE_CHUNK_SIZE, help='Rows deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0, metavar='SECONDS', help='Sleep between chunks')
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help='Keep running, purging every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            results = purge_stale(options['chunk_size'], options['pause'], options['days'])
+            for name, (deleted, seconds) in results.items():
+                rate = deleted / seconds if seconds else 0
+                self.stdout.write(f"{name}: {deleted} deleted in {seconds:.1f}s ({rate:.0f} rows/s)")
+
+            if not options['loop']:
+                break
+            time.sleep(max(options['loop'] - (time.monotonic() - started), 0))
@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.caching import invalidate_homepage_blocks
+from store.images import REBUILD_BATCH_SIZE, default_processes, rebuild_images
+from store.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = 'Generate the renditions of all or some product images again, e.g. after changing their sizes or quality'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', action='append', metavar='SLUG', help='Only the images of this product')
+        parser.add_argument('--category', action='append', metavar='NAME', help='Only the images of products in this category')
+        parser.add_argument('--force', action='store_true', help='Render images whose source hash has not changed too')
+        parser.add_argument('--processes', type=int, help=f'Images rendered side by side (default: {default_processes()}, one per core)')
+        parser.add_argument('--batch-size', type=int, default=REBUILD_BATCH_SIZE, help='Images rendered between checkpoints')
+        parser.add_argument(
+            '--checkpoint', default=os.path.join(tempfile.gettempdir(), 'store-rebuild-images.json'),
+            help='File recording the progress, an interrupted rebuild with the same options resumes from it',
+        )
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from the beginning')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        images = ProductImage.objects.exclude(image='').exclude(image__isnull=True)
+        if options['product']:
+            images = images.filter(product__slug__in=options['product'])
+        if options['category']:
+            images = images.filter(product__categories__name__in=options['category'])
+        if options['restart'] and os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
+
+        totals, seconds = rebuild_images(
+            images, options['processes'], options['batch_size'], options['force'], options['checkpoint'],
+            log=self.stdout.write,
+        )
+        if totals['rendered'] or totals['failed']:
+            # The homepage blocks are cached with the image URLs in them
+            invalidate_homepage_blocks()
+
+        processed = totals['rendered'] + totals['skipped'] + totals['failed']
+        rate = processed / seconds if seconds else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"{totals['rendered']} rendered, {totals['skipped']} unchanged, {totals['failed']} unreadable "
+            f"in {seconds:.1f}s ({rate:.1f} images/s); {totals['written'] / 1024:.0f} KiB written, "
+            f"{totals['saved'] / 1024:.0f} KiB saved on the renditions replaced"
+        ))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+from store.related import rebuild_related_products
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the precomputed related products of every product'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Products rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        product_ids = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+
+        rows = 0
+        for start in range(0, len(product_ids), batch_size):
+            rows += rebuild_related_products(product_ids[start:start + batch_size])
+            self.stdout.write(f"{min(start + batch_size, len(product_ids))}/{len(product_ids)} products")
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {rows} related products for {len(product_ids)} products in {elapsed:.1f}s"
+        ))
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from store.caching import invalidate_homepage_blocks
+from store.models import OrderItem, Product
+
+
+class Command(BaseCommand):
+    help = 'Recompute Product.sales from existing order items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Products updated per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        product_ids = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+
+        changed = 0
+        for start in range(0, len(product_ids), batch_size):
+            batch_ids = product_ids[start:start + batch_size]
+
+            with transaction.atomic():
+                # Lock first so an order recorded meanwhile is not overwritten by a stale sum
+                products = list(Product.objects.filter(pk__in=batch_ids).only('pk', 'sales').select_for_update())
+                sold = dict(
+                    OrderItem.objects.filter(product_id__in=batch_ids)
+                    .values_list('product')
+                    .annotate(quantity=Sum('quantity'))
+                )
+                stale = []
+                for product in products:
+                    sales = sold.get(product.pk, 0)
+                    if product.sales != sales:
+                        product.sales = sales
+                        stale.append(product)
+                Product.objects.bulk_update(stale, ['sales'])
+            changed += len(stale)
+
+        if changed:
+            invalidate_homepage_blocks()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {len(product_ids)} products, updated {changed} sales counts in {elapsed:.1f}s"
+        ))
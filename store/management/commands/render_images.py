@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.caching import invalidate_homepage_blocks
+from store.images import render_pending
+
+
+class Command(BaseCommand):
+    help = 'Generate the card, gallery and zoom renditions of new or replaced product images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, help='Images rendered side by side (default: one per core)')
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help='Keep running, polling every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            totals, seconds = render_pending(options['processes'])
+            rendered, failed = totals['rendered'], totals['failed']
+            if rendered or failed:
+                # The homepage blocks are cached with the image URLs in them
+                invalidate_homepage_blocks()
+            if rendered or failed or not options['loop']:
+                rate = rendered / seconds if seconds else 0
+                self.stdout.write(
+                    f"Rendered {rendered} images ({totals['written'] / 1024:.0f} KiB), {failed} unreadable, "
+                    f"in {seconds:.1f}s ({rate:.1f} images/s)"
+                )
+            if not options['loop']:
+                break
+            time.sleep(max(options['loop'] - seconds, 0))
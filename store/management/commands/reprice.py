@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.models import Product
+from store.pricing import REPRICE_BATCH_SIZE, apply_discount, change_price, clear_discount
+
+
+class Command(BaseCommand):
+    help = 'Discount, clear the discount of, or change the price of a set of products'
+
+    def add_arguments(self, parser):
+        action = parser.add_mutually_exclusive_group(required=True)
+        action.add_argument('--discount', type=int, metavar='PERCENT', help='Apply a percent discount')
+        action.add_argument('--clear-discount', action='store_true', help='Remove the discount')
+        action.add_argument('--change-price', type=int, metavar='PERCENT', help='Raise prices by PERCENT, lower them with a negative one')
+        parser.add_argument('--category', action='append', default=[], help='Only products in this category (repeatable)')
+        parser.add_argument('--slug', action='append', default=[], help='Only this product (repeatable)')
+        parser.add_argument('--hot-deals', action='store_true', help='Only hot deals')
+        parser.add_argument('--batch-size', type=int, default=REPRICE_BATCH_SIZE, help='Products updated per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the matching products')
+
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options['category']:
+            products = products.filter(categories__name__in=options['category'])
+        if options['slug']:
+            products = products.filter(slug__in=options['slug'])
+        if options['hot_deals']:
+            products = products.filter(hot_deal=True)
+
+        if options['dry_run']:
+            self.stdout.write(f"{products.distinct().count()} products match")
+            return
+
+        batch_size = options['batch_size']
+        if options['clear_discount']:
+            count = clear_discount(products, batch_size=batch_size)
+        elif options['discount'] is not None:
+            if not 0 <= options['discount'] <= 100:
+                raise CommandError('--discount must be between 0 and 100')
+            count = apply_discount(products, options['discount'], batch_size=batch_size)
+        else:
+            if options['change_price'] <= -100:
+                raise CommandError('--change-price must be above -100')
+            count = change_price(products, options['change_price'], batch_size=batch_size)
+
+        self.stdout.write(self.style.SUCCESS(f"Repriced {count} products"))
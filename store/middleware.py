@@ -0,0 +1,47 @@
+import os
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .static_assets import static_response
+from .storage import IMMUTABLE_CACHE_CONTROL, is_immutable_media
+
+
+class ImmutableMediaMiddleware:
+    """
+    Far-future Cache-Control on content-addressed media (product images
+    and their renditions, see store/storage.py) when Django serves
+    MEDIA_URL. A web server or CDN in front of MEDIA_ROOT should send the
+    same header for the paths store.storage.CONTENT_ADDRESSED_NAME matches.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.status_code in (200, 304) and is_immutable_media(request.path):
+            response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+
+class PrecompressedStaticMiddleware:
+    """
+    Serve STATIC_URL from STATIC_ROOT as manage.py build_static leaves it:
+    the precompressed Brotli or gzip variant of a file when the client
+    accepts it, with far-future immutable caching for hashed names. Off
+    in DEBUG, where django.contrib.staticfiles serves the source files.
+    """
+
+    def __init__(self, get_response):
+        if settings.DEBUG or not settings.STATIC_ROOT:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.root = os.path.realpath(settings.STATIC_ROOT)
+
+    def __call__(self, request):
+        if request.method in ('GET', 'HEAD') and request.path.startswith(settings.STATIC_URL):
+            response = static_response(request, request.path[len(settings.STATIC_URL):], self.root)
+            if response is not None:
+                return response
+        return self.get_response(request)
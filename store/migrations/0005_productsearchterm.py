@@ -0,0 +1,27 @@
+# Generated by Django 4.2.3 on 2026-10-18 12:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0004_order_cart_is_paid_cart_reference_orderitem_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.PositiveIntegerField(default=1)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='store.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'product'], name='store_searchterm_term_idx')],
+                'unique_together': {('product', 'term')},
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.3 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0005_productsearchterm'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['sales', 'id'], name='store_product_sales_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['timestamp', 'id'], name='store_product_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:08
+
+from django.db import migrations, models
+
+
+def deactivate_duplicate_carts(apps, schema_editor):
+    # Paid carts are retired; left active, a paid cart is the one the views read and no payment can claim
+    Cart = apps.get_model('store', 'Cart')
+    Cart.objects.filter(is_paid=True).update(is_active=None)
+    # Of the unpaid ones, keep the cart the views used to read (the first one) active; the
+    # others stay as they are until manage.py consolidate_carts merges them into it
+    first_carts = (
+        Cart.objects.filter(user__isnull=False, is_paid=False).values('user')
+        .annotate(first=models.Min('pk'), count=models.Count('pk')).filter(count__gt=1)
+    )
+    for row in first_carts.iterator():
+        Cart.objects.filter(user=row['user'], is_paid=False).exclude(pk=row['first']).update(is_active=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_product_updated_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='is_active',
+            field=models.BooleanField(default=True, null=True),
+        ),
+        migrations.RunPython(deactivate_duplicate_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user', 'is_active'), name='store_cart_one_active_per_user'),
+        ),
+    ]
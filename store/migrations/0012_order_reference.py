@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_cart_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='reference',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
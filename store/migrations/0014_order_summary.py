@@ -0,0 +1,44 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:17
+
+import secrets
+
+from django.db import migrations, models
+
+
+def write_order_summaries(apps, schema_editor):
+    Order = apps.get_model('store', 'Order')
+    ProductImage = apps.get_model('store', 'ProductImage')
+    orders = list(Order.objects.annotate(lines=models.Count('orderitem')).order_by('pk'))
+    for order in orders:
+        order.item_count = order.lines
+        first_item = order.orderitem_set.order_by('pk').first()
+        image = ProductImage.objects.filter(product_id=first_item.product_id).order_by('pk').first() if first_item else None
+        order.image = image.image.name if image and image.image else ''
+        # No slug before Order.save stopped failing on it
+        order.slug = order.slug or secrets.token_hex(8)
+    Order.objects.bulk_update(orders, ['item_count', 'image', 'slug'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_paymentevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='image',
+            field=models.ImageField(blank=True, upload_to='products'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(write_order_summaries, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='store_order_history_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_order_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='rendered_from',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='productimage',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0015_productimage_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='source_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:26
+
+from django.db import migrations, models
+import store.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0016_productimage_source_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=store.storage.ContentAddressedStorage(), upload_to='products'),
+        ),
+    ]
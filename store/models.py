@@ -1,8 +1,12 @@
-from django.db import models
+import secrets
+
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.text import slugify
-from PIL import Image
+
+from .storage import ContentAddressedStorage
 
 
 
@@ -12,6 +16,25 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+class ProductQuerySet(models.QuerySet):
+    def for_cards(self):
+        # Everything a product card renders, loaded in bulk for the whole list
+        return self.prefetch_related(*card_prefetches())
+
+    def touch(self):
+        # Mark products as changed (page caches, ETag/Last-Modified) without running save()
+        return self.update(updated_at=timezone.now())
+
+
+def card_prefetches(prefix=''):
+    # Ordered prefetches, so images.first / categories.first are served from cache too;
+    # prefix lets related lists reuse them, e.g. card_prefetches('product__')
+    return [
+        models.Prefetch(prefix + 'images', queryset=ProductImage.objects.order_by('pk')),
+        models.Prefetch(prefix + 'categories', queryset=Category.objects.order_by('pk')),
+    ]
+
+
 class Product(models.Model):
     name = models.CharField(max_length=100)
     price = models.DecimalField(max_digits=8, decimal_places=2)
@@ -21,6 +44,8 @@ class Product(models.Model):
     categories = models.ManyToManyField(Category)
     related_products = models.ManyToManyField('self', blank=True)
     timestamp = models.TimeField(auto_now=False, auto_now_add=True)
+    # Last change to anything shown on the product page
+    updated_at = models.DateTimeField(auto_now=True)
     description = models.TextField()
     details = models.TextField()
     # size = models.CharField(max_length=20, blank=True, null=True)
@@ -35,56 +60,113 @@ class Product(models.Model):
     # Add user session relationship
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
 
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the listing sort modes, see store/pagination.py
+            models.Index(fields=['sales', 'id'], name='store_product_sales_idx'),
+            models.Index(fields=['timestamp', 'id'], name='store_product_timestamp_idx'),
+            # Incremental catalog exports, see store/export.py
+            models.Index(fields=['updated_at', 'id'], name='store_product_updated_idx'),
+        ]
+
     def __str__(self):
         return self.name
     
     def get_absolute_url(self):
         return reverse('product_detail', kwargs={'slug': self.slug})
-    
-    # def save(self, *args, **kwargs):
-    #     self.sales = self.cartitem_set.aggregate(total_count=models.Sum('quantity'))['total_count'] or 0
-    #     super().save(*args, **kwargs)
+
+    @property
+    def effective_price(self):
+        # What a customer pays per unit
+        return self.discount_price if self.discount else self.price
+
+    @property
+    def primary_image(self):
+        # Uses the for_cards() prefetch when present instead of a query per card
+        return next(iter(self.images.all()), None)
+
+    @property
+    def primary_category(self):
+        return next(iter(self.categories.all()), None)
     
 
-    def save(self, *args, **kwargs):
+    def update_discount_price(self):
         if self.discount:
             discount_amount = self.price * self.discount_value / 100
             self.discount_price = self.price - discount_amount
         else:
             self.discount_price = self.price
 
+    def update_slug(self):
         if not self.slug:
             self.slug = slugify(self.name)
 
+    def save(self, *args, **kwargs):
+        # Bulk writers (store/importer.py) call these two directly
+        self.update_discount_price()
+        self.update_slug()
+
         super().save(*args, **kwargs)
 
         
 
-class ProductImage(models.Model):
-    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
-    image = models.ImageField(upload_to='products', blank=True, null=True)
-
-    def optimize_image(self):
-        if self.image:
-            img = Image.open(self.image.path)
-            img.thumbnail((250, 250))  # Resize the image to a maximum size of 800x800 pixels
-            img.save(self.image.path, optimize=True, quality=90)  # Optimize and save the image
+class ProductImageQuerySet(models.QuerySet):
+    def pending(self):
+        # Images whose renditions are missing or were made from a previous upload, see store/images.py
+        return self.exclude(image='').exclude(image__isnull=True).exclude(rendered_from=models.F('image'))
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
 
-        if self.image:
-            # Optimize the product image after saving
-            self.optimize_image()
+class ProductImage(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
+    # Stored under the hash of its content, see store/storage.py
+    image = models.ImageField(upload_to='products', storage=ContentAddressedStorage(), blank=True, null=True)
+    # The original upload is kept; manage.py render_images fills these in the background:
+    # {size: {'width': ..., 'height': ..., 'webp': name, 'jpeg': name}}
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+    # The image name the renditions were made from
+    rendered_from = models.CharField(max_length=255, blank=True, editable=False)
+    # Hash of the original and the rendition settings, unchanged images are skipped by manage.py rebuild_images
+    source_hash = models.CharField(max_length=64, blank=True, editable=False)
+    # Size of the original, and a tiny data: URI of it shown until the image loads; set with the renditions
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    placeholder = models.TextField(blank=True, editable=False)
+
+    objects = ProductImageQuerySet.as_manager()
+
+
+class ProductSearchTerm(models.Model):
+    # Inverted index row: one weighted term per product, see store/search.py
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=64)
+    weight = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = ('product', 'term')
+        indexes = [
+            models.Index(fields=['term', 'product'], name='store_searchterm_term_idx'),
+        ]
 
-        super().save(*args, **kwargs)
+    def __str__(self):
+        return f"{self.term} -> {self.product_id} ({self.weight})"
 
-        # # Optimize the product image after saving
-        # self.optimize_image()
 
-    
+class RelatedProduct(models.Model):
+    # Precomputed "related products" list of a product, see store/related.py
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_entries')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_to')
+    score = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        unique_together = ('product', 'related')
+        indexes = [
+            models.Index(fields=['product', '-score', '-related'], name='store_related_rank_idx'),
+        ]
 
+    def __str__(self):
+        return f"{self.product_id} -> {self.related_id} ({self.score})"
 
 
     
@@ -105,6 +187,14 @@ class Review(models.Model):
     def __str__(self):
         return f"Review for {self.product.name}"
 
+def unit_price(prefix='product__'):
+    # Product.effective_price as an expression, read through the relation named by prefix
+    return models.Case(
+        models.When(**{prefix + 'discount': True}, then=models.F(prefix + 'discount_price')),
+        default=models.F(prefix + 'price'),
+    )
+
+
 class CartItem(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -116,26 +206,58 @@ class CartItem(models.Model):
 
 
 
+class CartQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(is_active=True)
+
+    def get_or_create_active(self, user_id):
+        # An upsert on the one-active-cart constraint: concurrent requests end up with the same cart
+        return self.get_or_create(user_id=user_id, is_active=True)
+
+
 class Cart(models.Model):
     items = models.ManyToManyField(CartItem)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     reference = models.CharField(max_length=100, blank=True, null=True)
     is_paid = models.BooleanField(default=False)
+    # True for the cart in use, None once it is paid; NULLs never clash in the unique
+    # constraint below, so this works on MySQL, which has no conditional unique indexes
+    is_active = models.BooleanField(null=True, default=True)
+    # Last change to the cart's lines; anonymous carts left alone for long are purged, see store/purge.py
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'is_active'], name='store_cart_one_active_per_user'),
+        ]
+
+    def get_summary(self):
+        """
+        Line count, quantity, subtotal and shipping of the cart in one
+        aggregate query. Shipping is each product's shipping_fee, once per
+        line. Views read the cached copy, see store/caching.py.
+        """
+        summary = self.items.aggregate(
+            items=models.Count('pk'),
+            total_quantity=models.Sum('quantity'),
+            subtotal=models.Sum(
+                unit_price() * models.F('quantity'), output_field=models.DecimalField(max_digits=12, decimal_places=2)
+            ),
+            shipping=models.Sum('product__shipping_fee'),
+        )
+        return {name: value or 0 for name, value in summary.items()}
 
     def get_total_items(self):
         return self.items.count()
 
     def get_subtotal(self):
-        subtotal = sum(
-            item.product.discount_price * item.quantity if item.product.discount else item.product.price * item.quantity
-            for item in self.items.all()
-        )
-        # subtotal = sum(item.product.price * item.quantity for item in self.items.all())
-        return subtotal
+        return self.get_summary()['subtotal']
 
     def get_total_price(self):
-        total_price = self.get_subtotal()
-        return total_price
+        summary = self.get_summary()
+        return summary['subtotal'] + summary['shipping']
 
 
 class Wishlist(models.Model):
@@ -173,12 +295,62 @@ class Order(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
     slug = models.SlugField(unique=True, null=True, blank=True)
+    # The payment's reference, so a callback delivered twice cannot create a second order
+    reference = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    # Summary written with the order, so the order history reads no items
+    item_count = models.PositiveIntegerField(default=0)
+    image = models.ImageField(upload_to='products', blank=True)
+
+    TRACKING_ICONS = {
+        'pending': 'fa-check',
+        'processing': 'fa-cog',
+        'shipped': 'fa-truck',
+        'delivered': 'fa-home',
+    }
+
+    class Meta:
+        indexes = [
+            # The order history, see OrderHistoryView
+            models.Index(fields=['user', 'created_at', 'id'], name='store_order_history_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
-            self.slug = slugify(self.product.name)
+            # Unguessable, the slug names the order in URLs
+            self.slug = secrets.token_hex(8)
         super().save(*args, **kwargs)
 
+    def get_absolute_url(self):
+        return reverse('order_detail', kwargs={'slug': self.slug})
+
+    def get_tracking_steps(self):
+        # The delivery steps up to the current status marked active; a canceled order has none
+        steps, active = [], self.status in self.TRACKING_ICONS
+        for status, text in self.STATUS_CHOICES:
+            if status in self.TRACKING_ICONS:
+                steps.append({'text': text, 'icon': self.TRACKING_ICONS[status], 'active': active})
+                if status == self.status:
+                    active = False
+        return steps
+
+    def record_sales(self):
+        # Add this order's quantities to the maintained Product.sales counters, in one UPDATE
+        quantities = dict(
+            self.orderitem_set.values_list('product').annotate(quantity=models.Sum('quantity'))
+        )
+        if not quantities:
+            return
+        Product.objects.filter(pk__in=quantities).update(
+            sales=models.F('sales') + models.Case(
+                *[models.When(pk=pk, then=models.Value(quantity)) for pk, quantity in quantities.items()],
+                default=models.Value(0),
+            )
+        )
+
+        # Top selling is part of the cached homepage blocks
+        from .caching import invalidate_homepage_blocks
+        transaction.on_commit(invalidate_homepage_blocks)
+
 
     def __str__(self):
         return f"Order #{self.id} - {self.user.username}"
@@ -190,4 +362,40 @@ class OrderItem(models.Model):
     unit_price = models.DecimalField(max_digits=8, decimal_places=2)
 
     def __str__(self):
-        return f"{self.quantity} x {self.product.name} ({self.unit_price})"
\ No newline at end of file
+        return f"{self.quantity} x {self.product.name} ({self.unit_price})"
+
+class PaymentEvent(models.Model):
+    """
+    A payment callback as it was received. PaymentStatusView only stores
+    it; manage.py process_payment_events turns it into an order, see
+    store/payments.py.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    payload = models.TextField()
+    reference = models.CharField(max_length=100, blank=True)
+    # The cart that was checked out for it
+    cart = models.ForeignKey(Cart, on_delete=models.SET_NULL, null=True, blank=True)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    # Not tried again before this, the retry backoff
+    available_at = models.DateTimeField(default=timezone.now)
+    # The worker processing it, and until when; past that another worker may take over
+    claimed_by = models.CharField(max_length=32, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='store_paymentevent_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.reference or 'Payment event'} ({self.status})"
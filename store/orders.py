@@ -0,0 +1,91 @@
+import time
+
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import OuterRef, Subquery
+
+from .models import Cart, Order, OrderItem, ProductImage, unit_price
+
+
+# Tries at a transaction that loses a lock race (MySQL deadlock, SQLite "database is locked")
+LOCK_RETRY_ATTEMPTS = 5
+LOCK_RETRY_BACKOFF = 0.05
+
+
+class CheckoutError(ValueError):
+    pass
+
+
+def paid_order(cart_id):
+    # The order an already paid cart turned into
+    reference = Cart.objects.filter(pk=cart_id).values_list('reference', flat=True).first()
+    return Order.objects.filter(reference=reference).first() if reference else None
+
+
+def create_order(cart_id, reference):
+    with transaction.atomic():
+        # Claim the cart: the conditional UPDATE locks its row (on SQLite, the database), so a
+        # concurrent callback for the same cart waits here and then finds it paid
+        claimed = Cart.objects.filter(pk=cart_id, is_paid=False).update(
+            is_paid=True, is_active=None, reference=reference,
+        )
+        if not claimed:
+            order = paid_order(cart_id)
+            if order is None:
+                raise CheckoutError("Unknown cart")
+            return order, False
+
+        cart = Cart.objects.get(pk=cart_id)
+        if cart.user_id is None:
+            raise CheckoutError("The cart has no user")
+        # Prices (and the order history's image) snapshotted in one read
+        first_image = ProductImage.objects.filter(product=OuterRef('product')).order_by('pk').values('image')[:1]
+        lines = list(cart.items.order_by('pk').values(
+            'product_id', 'quantity', 'product__shipping_fee', price=unit_price(), image=Subquery(first_image),
+        ))
+        if not lines:
+            raise CheckoutError("The cart is empty")
+
+        total = sum(line['price'] * line['quantity'] + line['product__shipping_fee'] for line in lines)
+        order = Order.objects.create(
+            user_id=cart.user_id, total_price=total, status='pending', reference=reference,
+            item_count=len(lines), image=next((line['image'] for line in lines if line['image']), ''),
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_id=line['product_id'], quantity=line['quantity'], unit_price=line['price'])
+            for line in lines
+        ])
+        order.record_sales()
+        cart.items.clear()
+    return order, True
+
+
+def retry_on_lock(function, *args):
+    # Call function, again after a backoff if it loses a lock race
+    for attempt in range(LOCK_RETRY_ATTEMPTS):
+        try:
+            return function(*args)
+        except OperationalError:
+            if attempt == LOCK_RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(LOCK_RETRY_BACKOFF * 2 ** attempt)
+
+
+def place_order(cart_id, reference):
+    """
+    Turn a cart into an order for the payment reference, all or nothing.
+    Safe to call again for the same payment, or concurrently: the second
+    call returns the first call's order. Returns (order, created).
+    """
+    def attempt():
+        order = Order.objects.filter(reference=reference).first()
+        if order is not None:
+            return order, False
+        try:
+            return create_order(cart_id, reference)
+        except IntegrityError:
+            # The same reference paid for another cart
+            order = Order.objects.filter(reference=reference).first()
+            if order is None:
+                raise
+            return order, False
+    return retry_on_lock(attempt)
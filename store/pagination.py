@@ -0,0 +1,109 @@
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+CURSOR_SALT = 'store.pagination.cursor'
+
+
+class InvalidCursor(ValueError):
+    # Tampered with, or made by a paginator over another ordering
+    pass
+
+
+class CursorPage:
+    # Quacks like django.core.paginator.Page for the bits the templates use
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Keyset pagination over a single ordering field with a primary key
+    tiebreak. Each page is a range scan that starts from the last row
+    seen, so there is no COUNT(*) and no OFFSET, and deep pages cost the
+    same as the first one.
+    """
+
+    def __init__(self, queryset, field, per_page, descending=True, salt=CURSOR_SALT):
+        self.queryset = queryset
+        self.field = field
+        self.per_page = int(per_page)
+        self.descending = descending
+        self.salt = salt
+        self.model_field = queryset.model._meta.get_field(field)
+        # A cursor is only valid for the ordering it was made for
+        self.ordering_key = [queryset.model._meta.label, field, descending]
+
+    def _ordering(self, reverse=False):
+        descending = self.descending != reverse
+        prefix = '-' if descending else ''
+        return (prefix + self.field, prefix + 'pk')
+
+    def _seek(self, value, pk, reverse=False):
+        # Rows strictly after (value, pk) in the given direction
+        lookup = 'lt' if self.descending != reverse else 'gt'
+        return (
+            Q(**{f'{self.field}__{lookup}': value}) |
+            Q(**{self.field: value, f'pk__{lookup}': pk})
+        )
+
+    def encode_cursor(self, obj, direction):
+        payload = [direction, *self.ordering_key, self.model_field.value_to_string(obj), obj.pk]
+        return signing.dumps(payload, salt=self.salt, compress=True)
+
+    def decode_cursor(self, cursor):
+        # Returns (direction, value, pk); raises InvalidCursor
+        try:
+            direction, *ordering_key, value, pk = signing.loads(cursor, salt=self.salt)
+            if direction not in ('next', 'prev') or ordering_key != self.ordering_key:
+                raise ValueError(direction)
+            return direction, self.model_field.to_python(value), int(pk)
+        except (signing.BadSignature, TypeError, ValueError, ValidationError) as e:
+            raise InvalidCursor("Invalid page cursor") from e
+
+    def get_page(self, cursor=None):
+        queryset = self.queryset
+        direction = 'next'
+        if cursor:
+            direction, value, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(self._seek(value, pk, reverse=direction == 'prev'))
+
+        # Fetch one extra row to learn whether there is anything beyond this page
+        rows = list(queryset.order_by(*self._ordering(reverse=direction == 'prev'))[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if direction == 'prev':
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, bool(cursor)
+
+        if not rows:
+            return CursorPage(rows)
+        return CursorPage(
+            rows,
+            next_cursor=self.encode_cursor(rows[-1], 'next') if has_next else None,
+            previous_cursor=self.encode_cursor(rows[0], 'prev') if has_previous else None,
+        )
@@ -0,0 +1,120 @@
+import json
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import PaymentEvent
+from .orders import CheckoutError, place_order, retry_on_lock
+
+
+# Events a worker claims at a time, and how long it has to process them before another worker may
+EVENT_BATCH_SIZE = 10
+CLAIM_TIMEOUT = timedelta(minutes=5)
+# Retries of an event that fails, after 1, 2, 4, ... times RETRY_BACKOFF
+MAX_ATTEMPTS = 6
+RETRY_BACKOFF = timedelta(seconds=30)
+
+
+def claimable_events():
+    now = timezone.now()
+    return PaymentEvent.objects.filter(
+        Q(status='pending', available_at__lte=now) | Q(status='processing', claimed_until__lt=now)
+    )
+
+
+def claim_events(worker, batch_size=EVENT_BATCH_SIZE):
+    """
+    Mark up to batch_size events as being processed by worker and return
+    them. SKIP LOCKED lets workers claim side by side without waiting on
+    each other's rows; where it is not supported (SQLite) the UPDATE's
+    condition keeps two workers from claiming the same event.
+    """
+    def claim():
+        with transaction.atomic():
+            ids = list(
+                claimable_events().select_for_update(skip_locked=True)
+                .order_by('available_at', 'pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                return []
+            claimable_events().filter(pk__in=ids).update(
+                status='processing', claimed_by=worker, claimed_until=timezone.now() + CLAIM_TIMEOUT,
+            )
+        return list(PaymentEvent.objects.filter(pk__in=ids, claimed_by=worker, status='processing'))
+    return retry_on_lock(claim)
+
+
+def process_event(event):
+    # Returns (status, order or None); raises for a failure worth retrying
+    try:
+        payload = json.loads(event.payload)
+    except ValueError:
+        return 'failed', None
+    if not isinstance(payload, dict) or payload.get('status') != 'success':
+        # A failed payment, kept for the record only
+        return 'done', None
+    if event.cart_id is None:
+        raise CheckoutError("No cart was checked out for it")
+    return 'done', place_order(event.cart_id, event.reference)[0]
+
+
+def finish_event(event, worker):
+    event.attempts += 1
+    try:
+        event.status, event.order = process_event(event)
+        event.last_error = ''
+    except CheckoutError as e:
+        # Nothing a retry would change
+        event.status, event.last_error = 'failed', str(e)
+    except Exception as e:
+        event.last_error = f"{type(e).__name__}: {e}"
+        if event.attempts >= MAX_ATTEMPTS:
+            event.status = 'failed'
+        else:
+            event.status = 'pending'
+            event.available_at = timezone.now() + RETRY_BACKOFF * 2 ** (event.attempts - 1)
+    event.processed_at = timezone.now()
+    event.claimed_until = None
+
+    # Only while the claim is still ours, a worker that took too long must not overwrite another's result
+    fields = {name: getattr(event, name) for name in (
+        'attempts', 'status', 'order', 'last_error', 'available_at', 'processed_at', 'claimed_until',
+    )}
+    retry_on_lock(lambda: PaymentEvent.objects.filter(pk=event.pk, claimed_by=worker).update(**fields))
+    return event.status
+
+
+def drain(batch_size=EVENT_BATCH_SIZE):
+    # One worker: process events until there are none left to claim; returns {status: count}
+    worker = secrets.token_hex(8)
+    counts = {}
+    try:
+        while True:
+            events = claim_events(worker, batch_size)
+            if not events:
+                return counts
+            for event in events:
+                status = finish_event(event, worker)
+                counts[status] = counts.get(status, 0) + 1
+    finally:
+        # Worker threads have their own connection
+        connection.close()
+
+
+def process_payment_events(workers=1, batch_size=EVENT_BATCH_SIZE):
+    """
+    Drain the event inbox with workers threads side by side. Returns
+    ({status: count}, seconds).
+    """
+    started = time.monotonic()
+    totals = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for counts in executor.map(drain, [batch_size] * workers):
+            for status, count in counts.items():
+                totals[status] = totals.get(status, 0) + count
+    return totals, time.monotonic() - started
@@ -0,0 +1,108 @@
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Case, DecimalField, ExpressionWrapper, F, Value, When
+from django.db.models.functions import Mod, Round
+from django.db.models.lookups import Exact, GreaterThan
+from django.utils import timezone
+
+from .caching import invalidate_all_cart_summaries, invalidate_homepage_blocks
+from .models import Product
+
+
+# Products updated per transaction (and per homepage cache invalidation)
+REPRICE_BATCH_SIZE = 1000
+
+PRICE_FIELD = Product._meta.get_field('price')
+
+
+def as_price(expression):
+    return ExpressionWrapper(
+        expression,
+        output_field=DecimalField(max_digits=PRICE_FIELD.max_digits, decimal_places=PRICE_FIELD.decimal_places),
+    )
+
+
+def quantized_before_saving():
+    """
+    Whether Django rounds a Decimal to the column's places in Python
+    (half-even) before it reaches the database, as the base backend does,
+    e.g. on SQLite, and PostgreSQL before Django 4.2. MySQL, and PostgreSQL
+    since 4.2, are sent the exact value and their DECIMAL column rounds it
+    half up.
+    """
+    probe = Decimal('0.005')
+    adapted = connection.ops.adapt_decimalfield_value(probe, PRICE_FIELD.max_digits, PRICE_FIELD.decimal_places)
+    return Decimal(str(adapted)) != probe
+
+
+def scaled_price(price, percent):
+    # price * percent / 100 rounded to cents the way a save() of that value would store it
+    if not quantized_before_saving():
+        return as_price(Round(price * percent / 100, 2))
+
+    # Half-even in integer arithmetic on hundredths of a cent, exact on every backend (SQLite stores
+    # decimals as floats)
+    hundredths = Round(price * 100) * percent
+    remainder = Mod(hundredths, 100)
+    cents = (hundredths - remainder) / 100
+    cents = cents + Case(
+        When(GreaterThan(remainder, 50), then=Value(1)),
+        When(Exact(remainder, 50), then=Mod(cents, 2)),
+        default=Value(0),
+        output_field=DecimalField(),
+    )
+    return as_price(cents / 100)
+
+
+def discount_price_for(price, discount, discount_value):
+    # Product.update_discount_price as an expression
+    return Case(
+        When(Exact(discount, True), then=scaled_price(price, 100 - discount_value)),
+        default=price,
+        output_field=PRICE_FIELD,
+    )
+
+
+def reprice(queryset, batch_size=REPRICE_BATCH_SIZE, **values):
+    """
+    Set values on every product in queryset with one UPDATE per batch and
+    recompute discount_price from the new values in the same statement.
+    Values may be expressions over the product's current fields.
+    """
+    price = values.pop('price', None)
+    fields = {name: values.get(name, F(name)) for name in ('discount', 'discount_value')}
+    values['discount_price'] = discount_price_for(
+        F('price'),
+        Value(fields['discount']) if isinstance(fields['discount'], bool) else fields['discount'],
+        fields['discount_value'],
+    )
+
+    product_ids = list(queryset.order_by('pk').values_list('pk', flat=True).distinct())
+    updated = 0
+    for start in range(0, len(product_ids), batch_size):
+        batch = Product.objects.filter(pk__in=product_ids[start:start + batch_size])
+        with transaction.atomic():
+            if price is not None:
+                # A second statement, the discount price is computed from the rounded new price
+                batch.update(price=price)
+            # updated_at retires the cached product pages of the batch
+            updated += batch.update(updated_at=timezone.now(), **values)
+            transaction.on_commit(invalidate_homepage_blocks)
+    if updated:
+        # Cart totals use the new prices
+        transaction.on_commit(invalidate_all_cart_summaries)
+    return updated
+
+
+def apply_discount(queryset, percent, **kwargs):
+    return reprice(queryset, discount=True, discount_value=percent, **kwargs)
+
+
+def clear_discount(queryset, **kwargs):
+    return reprice(queryset, discount=False, discount_value=0, **kwargs)
+
+
+def change_price(queryset, percent, **kwargs):
+    # Raise (or with a negative percent, lower) prices by percent
+    return reprice(queryset, price=scaled_price(F('price'), 100 + percent), **kwargs)
@@ -0,0 +1,84 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Cart, CartItem, Wishlist
+
+
+# Rows deleted per transaction; small enough that no lock is held for long on a live database
+PURGE_CHUNK_SIZE = 1000
+# Anonymous carts nobody has changed for this long are abandoned
+STALE_CART_DAYS = 30
+
+
+def stale_carts(days=STALE_CART_DAYS):
+    return Cart.objects.filter(
+        user__isnull=True, is_paid=False, updated_at__lt=timezone.now() - timedelta(days=days),
+    )
+
+
+def orphaned_cart_items():
+    # Lines of deleted carts, and of paid carts, which are emptied at payment
+    return CartItem.objects.filter(cart__isnull=True)
+
+
+def empty_wishlists():
+    # Anonymous ones only: a signed-in user's wishlist stays theirs, even when empty
+    return Wishlist.objects.filter(user__isnull=True, items__isnull=True)
+
+
+def expired_sessions():
+    return Session.objects.filter(expire_date__lt=timezone.now())
+
+
+def delete_cart_items(queryset):
+    # One DELETE, without the per-item pre_delete receiver, whose only job is expiring the summaries
+    # of the item's carts: these are in no cart. Nothing else references a CartItem, so there is no
+    # cascade to collect either, and the DELETE checks cart__isnull again itself.
+    return queryset._raw_delete(queryset.db)
+
+
+def purge(queryset, chunk_size=PURGE_CHUNK_SIZE, pause=0, delete=None):
+    """
+    Delete the rows of queryset in chunks of chunk_size, one short
+    transaction each, walking the primary key so every chunk is an index
+    range scan. Returns (rows deleted, seconds taken).
+    """
+    # By default the rows of the model itself, not what the delete cascaded to
+    delete = delete or (lambda chunk: chunk.delete()[1].get(queryset.model._meta.label, 0))
+    started = time.monotonic()
+    deleted, last = 0, None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        pks = list(chunk.values_list('pk', flat=True).distinct()[:chunk_size])
+        if not pks:
+            break
+        with transaction.atomic():
+            # Checked again inside the transaction, a row may have been picked up since
+            deleted += delete(queryset.filter(pk__in=pks))
+        last = pks[-1]
+        if pause:
+            time.sleep(pause)
+    return deleted, time.monotonic() - started
+
+
+def purge_stale(chunk_size=PURGE_CHUNK_SIZE, pause=0, days=STALE_CART_DAYS):
+    """
+    Purge abandoned anonymous carts, then the cart items that leaves in
+    no cart, empty anonymous wishlists and expired sessions. Returns
+    {name: (rows deleted, seconds)}.
+    """
+    results = {
+        'carts': purge(stale_carts(days), chunk_size, pause),
+        'cart items': purge(orphaned_cart_items(), chunk_size, pause, delete_cart_items),
+        'wishlists': purge(empty_wishlists(), chunk_size, pause),
+    }
+    if settings.SESSION_ENGINE == 'django.contrib.sessions.backends.db':
+        results['sessions'] = purge(expired_sessions(), chunk_size, pause)
+    return results
@@ -0,0 +1,84 @@
+from django.db import transaction
+from django.db.models import Count, Q
+
+from .models import Product, RelatedProduct
+
+
+# Length of the stored list per product
+RELATED_PRODUCTS_LIMIT = 24
+# Score per category two products share
+SHARED_CATEGORY_WEIGHT = 1
+# Hand-picked related_products always rank above category matches
+EXPLICIT_RELATION_WEIGHT = 100
+
+ProductCategory = Product.categories.through
+ProductRelation = Product.related_products.through
+
+
+def compute_related(product_id):
+    # Return [(related_id, score)] best first for one product
+    category_ids = list(
+        ProductCategory.objects.filter(product_id=product_id).values_list('category_id', flat=True)
+    )
+    scores = {}
+    if category_ids:
+        shared = (
+            ProductCategory.objects.filter(category_id__in=category_ids)
+            .exclude(product_id=product_id)
+            .values_list('product_id')
+            .annotate(shared=Count('id'))
+            .order_by('-shared', '-product_id')[:RELATED_PRODUCTS_LIMIT]
+        )
+        for related_id, count in shared:
+            scores[related_id] = count * SHARED_CATEGORY_WEIGHT
+
+    # Both directions: m2m_changed fires for add() before the mirror row is written
+    explicit = set()
+    pairs = ProductRelation.objects.filter(
+        Q(from_product_id=product_id) | Q(to_product_id=product_id)
+    ).values_list('from_product_id', 'to_product_id')
+    for from_id, to_id in pairs:
+        explicit.add(to_id if from_id == product_id else from_id)
+    explicit.discard(product_id)
+    for related_id in explicit:
+        scores[related_id] = scores.get(related_id, 0) + EXPLICIT_RELATION_WEIGHT
+
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+    return ranked[:RELATED_PRODUCTS_LIMIT]
+
+
+def rebuild_related_products(product_ids):
+    # Recompute the stored lists of the given products, in one transaction
+    product_ids = list(product_ids)
+    rows = [
+        RelatedProduct(product_id=product_id, related_id=related_id, score=score)
+        for product_id in product_ids
+        for related_id, score in compute_related(product_id)
+    ]
+    with transaction.atomic():
+        RelatedProduct.objects.filter(product_id__in=product_ids).delete()
+        RelatedProduct.objects.bulk_create(rows)
+        # The related block is part of each product page
+        Product.objects.filter(pk__in=product_ids).touch()
+    return len(rows)
+
+
+def refresh_related_products(product_ids):
+    """
+    Incremental update after the categories or hand-picked relations of
+    some products changed: rebuild their own lists, then the lists that
+    mention them now or should mention them after the change. Lists of
+    products further away are left for manage.py rebuild_related_products.
+    """
+    product_ids = set(product_ids)
+    rebuild_related_products(product_ids)
+
+    affected = set(
+        RelatedProduct.objects.filter(related_id__in=product_ids).values_list('product_id', flat=True)
+    )
+    affected.update(
+        RelatedProduct.objects.filter(product_id__in=product_ids).values_list('related_id', flat=True)
+    )
+    affected -= product_ids
+    if affected:
+        rebuild_related_products(affected)
@@ -0,0 +1,132 @@
+import re
+import unicodedata
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Q, Sum, Value
+
+from .models import Product, ProductSearchTerm
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Terms shorter than this are ignored, both when indexing and when searching
+MIN_TERM_LENGTH = 2
+# Must match ProductSearchTerm.term max_length
+MAX_TERM_LENGTH = 64
+# Query terms at least this long also match indexed terms they prefix ("lap" -> "laptop")
+PREFIX_MIN_LENGTH = 3
+MAX_QUERY_TERMS = 8
+# A term repeated many times in one field should not drown out the name
+MAX_TERM_FREQUENCY = 3
+
+FIELD_WEIGHTS = {
+    'name': 10,
+    'categories': 5,
+    'description': 2,
+    'details': 1,
+}
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is',
+    'it', 'of', 'on', 'or', 'the', 'to', 'with',
+])
+
+
+def normalize(text):
+    # Casefolded and without accents, "Café" -> "cafe": the database collation compares terms that way
+    # (MySQL's unique_together would reject "cafe" next to "café"), and searches should too
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    # Normalized word tokens, without stop words and very short terms
+    if not text:
+        return []
+    return [
+        token[:MAX_TERM_LENGTH]
+        for token in TOKEN_RE.findall(normalize(text))
+        if len(token) >= MIN_TERM_LENGTH and token not in STOP_WORDS
+    ]
+
+
+def product_terms(product, category_names=None):
+    # Build the {term: weight} postings for a single product
+    if category_names is None:
+        category_names = [category.name for category in product.categories.all()]
+
+    fields = {
+        'name': product.name,
+        'categories': ' '.join(category_names),
+        'description': product.description,
+        'details': product.details,
+    }
+
+    weights = Counter()
+    for field, text in fields.items():
+        frequencies = Counter(tokenize(text))
+        for term, frequency in frequencies.items():
+            weights[term] += FIELD_WEIGHTS[field] * min(frequency, MAX_TERM_FREQUENCY)
+    return weights
+
+
+def _build_rows(product, category_names=None):
+    return [
+        ProductSearchTerm(product=product, term=term, weight=weight)
+        for term, weight in product_terms(product, category_names).items()
+    ]
+
+
+def index_product(product):
+    # Replace the postings of one product; called from the save/delete signals
+    with transaction.atomic():
+        ProductSearchTerm.objects.filter(product=product).delete()
+        ProductSearchTerm.objects.bulk_create(_build_rows(product))
+
+
+def index_products(queryset=None, batch_size=500):
+    # Rebuild postings for many products, one batch per transaction
+    if queryset is None:
+        queryset = Product.objects.all()
+
+    product_ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+    indexed = 0
+    for start in range(0, len(product_ids), batch_size):
+        batch_ids = product_ids[start:start + batch_size]
+        products = Product.objects.filter(pk__in=batch_ids).prefetch_related('categories')
+
+        rows = []
+        for product in products:
+            rows.extend(_build_rows(product, [category.name for category in product.categories.all()]))
+
+        with transaction.atomic():
+            ProductSearchTerm.objects.filter(product_id__in=batch_ids).delete()
+            ProductSearchTerm.objects.bulk_create(rows, batch_size=batch_size)
+        indexed += len(batch_ids)
+    return indexed
+
+
+def search_products(queryset, query):
+    # Filter queryset down to products matching query, ranked by search_score
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        # Only stop words or single characters ("the", "x"), which are not indexed: match names instead
+        query = ' '.join(query.split())
+        if not query:
+            return queryset.none()
+        return queryset.filter(name__icontains=query).annotate(
+            search_score=Value(FIELD_WEIGHTS['name'])
+        ).order_by('-sales', '-pk')
+
+    match = Q()
+    for term in terms:
+        if len(term) >= PREFIX_MIN_LENGTH:
+            match |= Q(search_terms__term__startswith=term)
+        else:
+            match |= Q(search_terms__term=term)
+
+    # filter() before annotate() so only the matching postings are summed
+    return queryset.filter(match).annotate(
+        search_score=Sum('search_terms__weight')
+    ).order_by('-search_score', '-pk')
@@ -0,0 +1,210 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .caching import (
+    invalidate_all_cart_summaries, invalidate_cart_summaries, invalidate_header_counters, invalidate_homepage_blocks,
+)
+from .cart import merge_session_cart
+from .models import Cart, CartItem, Category, Product, ProductImage, Review, Wishlist, WishlistItem
+from .related import refresh_related_products
+from .search import index_product, index_products
+
+
+@receiver(post_save, sender=Product)
+def reindex_saved_product(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    index_product(instance)
+
+
+def changed_category_products(instance, action, reverse, pk_set):
+    # Ids of the products whose categories changed, or None if there is nothing to do yet
+    if reverse and action == 'pre_clear':
+        # The cleared product ids are gone by post_clear, remember them now
+        instance._cleared_product_ids = list(instance.product_set.values_list('pk', flat=True))
+        return None
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return None
+
+    if not reverse:
+        return [instance.pk]
+    if action == 'post_clear':
+        return getattr(instance, '_cleared_product_ids', [])
+    return list(pk_set)
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def reindex_product_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    product_ids = changed_category_products(instance, action, reverse, pk_set)
+    if product_ids is None:
+        return
+    if not reverse:
+        index_product(instance)
+    else:
+        index_products(Product.objects.filter(pk__in=product_ids))
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def refresh_related_for_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    product_ids = changed_category_products(instance, action, reverse, pk_set)
+    if product_ids:
+        refresh_related_products(product_ids)
+
+
+@receiver(m2m_changed, sender=Product.related_products.through)
+def refresh_related_for_relations(sender, instance, action, pk_set, **kwargs):
+    # related_products is symmetrical, both ends of every pair change
+    if action == 'pre_clear':
+        instance._cleared_related_ids = list(instance.related_products.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_related_ids', [])
+    refresh_related_products({instance.pk, *pk_set})
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, raw=False, **kwargs):
+    # A renamed category changes the terms of every product filed under it
+    if raw or created:
+        return
+    index_products(instance.product_set.all())
+
+
+@receiver(pre_delete, sender=Category)
+def remember_category_products(sender, instance, **kwargs):
+    instance._deleted_product_ids = list(instance.product_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def reindex_deleted_category_products(sender, instance, **kwargs):
+    product_ids = getattr(instance, '_deleted_product_ids', [])
+    index_products(Product.objects.filter(pk__in=product_ids))
+    if product_ids:
+        refresh_related_products(product_ids)
+        Product.objects.filter(pk__in=product_ids).touch()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def expire_homepage_blocks(sender, raw=False, **kwargs):
+    if raw:
+        return
+    # After commit, so a concurrent rebuild cannot cache the old rows again
+    transaction.on_commit(invalidate_homepage_blocks)
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def expire_homepage_blocks_on_categories(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(invalidate_homepage_blocks)
+
+
+# Product.updated_at drives the product page cache and its ETag/Last-Modified,
+# so changes to anything shown on the page touch the product
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def touch_product(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    Product.objects.filter(pk=instance.product_id).touch()
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def touch_products_for_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    product_ids = changed_category_products(instance, action, reverse, pk_set)
+    if product_ids:
+        Product.objects.filter(pk__in=product_ids).touch()
+
+
+@receiver(post_save, sender=Category)
+def touch_category_products(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    instance.product_set.touch()
+
+
+# Cached cart summaries and header counters, see store/caching.py and store/context_processors.py
+
+def expire_cart_summaries(cart_ids):
+    cart_ids = list(cart_ids)
+    if not cart_ids:
+        return
+    # The carts are in use, whatever purge_stale thinks of their age
+    Cart.objects.filter(pk__in=cart_ids).update(updated_at=timezone.now())
+    owners = [('cart', cart_id) for cart_id in cart_ids]
+    owners += [
+        ('user', user_id)
+        for user_id in Cart.objects.filter(pk__in=cart_ids, user__isnull=False).values_list('user_id', flat=True)
+    ]
+
+    def expire():
+        invalidate_cart_summaries(cart_ids)
+        invalidate_header_counters('cart', owners)
+    transaction.on_commit(expire)
+
+
+@receiver(post_save, sender=CartItem)
+@receiver(pre_delete, sender=CartItem)
+def expire_cart_summaries_for_item(sender, instance, raw=False, **kwargs):
+    # pre_delete, the item's cart links are deleted along with it
+    if raw:
+        return
+    expire_cart_summaries(Cart.objects.filter(items=instance).values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Cart.items.through)
+def expire_cart_summaries_for_items(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        instance._cleared_cart_ids = list(instance.cart_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        expire_cart_summaries([instance.pk])
+    elif action == 'post_clear':
+        expire_cart_summaries(getattr(instance, '_cleared_cart_ids', []))
+    else:
+        expire_cart_summaries(pk_set)
+
+
+@receiver(user_logged_in)
+def merge_cart_at_login(sender, request, user, **kwargs):
+    if request is None or not hasattr(request, 'session'):
+        return
+    cart_id = merge_session_cart(request, user)
+    if cart_id:
+        expire_cart_summaries([cart_id])
+
+
+@receiver(post_save, sender=WishlistItem)
+@receiver(post_delete, sender=WishlistItem)
+def expire_wishlist_counter(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    owners = [('wishlist', instance.wishlist_id)]
+    user_id = Wishlist.objects.filter(pk=instance.wishlist_id).values_list('user_id', flat=True).first()
+    if user_id:
+        owners.append(('user', user_id))
+    transaction.on_commit(lambda: invalidate_header_counters('wishlist', owners))
+
+
+@receiver(post_save, sender=Product)
+def expire_all_cart_summaries(sender, created, raw=False, **kwargs):
+    # A new product is in no cart yet
+    if raw or created:
+        return
+    transaction.on_commit(invalidate_all_cart_summaries)
@@ -0,0 +1,123 @@
+import gzip
+import mimetypes
+import os
+import re
+
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils.http import http_date
+
+from .storage import IMMUTABLE_CACHE_CONTROL
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without it manage.py build_static writes gzip variants only
+    brotli = None
+
+
+# Files worth compressing; images and woff fonts are compressed already
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.map', '.json', '.svg', '.txt', '.xml', '.html', '.ico', '.eot', '.ttf', '.otf'}
+COMPRESS_MIN_SIZE = 256
+# The variants written next to a file, in the order they are served
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+# Names ManifestStaticFilesStorage and django-compressor give files, e.g. style.3f2a1b4c5d6e.css: their
+# content never changes, so clients may cache them for good
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.\w+$')
+# Other files are checked with the server on every use (If-None-Match)
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    # mtime=0 so a rebuild of the same file gives the same bytes
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def precompress_file(path):
+    """
+    Write the variants of path that are worth it (smaller by a twentieth)
+    and not already up to date. Returns (variants written, bytes saved).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    written, saved = 0, 0
+    for encoding, suffix in ENCODINGS:
+        if encoding == 'br' and brotli is None:
+            continue
+        target = path + suffix
+        if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+            continue
+        compressed = compress(data, encoding)
+        if len(compressed) > len(data) * 0.95:
+            continue
+        # Renamed into place, a request never gets half a file
+        with open(target + '.tmp', 'wb') as f:
+            f.write(compressed)
+        os.replace(target + '.tmp', target)
+        written += 1
+        saved += len(data) - len(compressed)
+    return written, saved
+
+
+def precompress(root):
+    # Precompress every compressible file under root; returns (files, variants written, bytes saved)
+    files, written, saved = 0, 0, 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            if os.path.getsize(path) < COMPRESS_MIN_SIZE:
+                continue
+            files += 1
+            variants, bytes_saved = precompress_file(path)
+            written += variants
+            saved += bytes_saved
+    return files, written, saved
+
+
+def accepted_encodings(header):
+    # Accept-Encoding: "gzip, deflate, br;q=0.5" -> {'gzip', 'deflate', 'br'}
+    encodings = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = re.search(r'q=([0-9.]+)', params)
+        if coding and not (q and float(q.group(1)) == 0):
+            encodings.add(coding.strip().lower())
+    return encodings
+
+
+def static_response(request, name, root):
+    """
+    A response for the file name under root, or None if there is none:
+    the Brotli or gzip variant when the client accepts it, immutable
+    caching for hashed names and ETag revalidation for the others.
+    """
+    path = os.path.realpath(os.path.join(root, name))
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        return None
+    served, encoding, variants = path, None, False
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    for candidate, suffix in ENCODINGS:
+        if os.path.isfile(path + suffix):
+            variants = True
+            if encoding is None and candidate in accepted:
+                served, encoding = path + suffix, candidate
+
+    stat = os.stat(served)
+    etag = f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        content_type, _ = mimetypes.guess_type(path)
+        response = FileResponse(open(served, 'rb'), content_type=content_type or 'application/octet-stream')
+        response.headers.pop('Content-Disposition', None)
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if encoding:
+            response['Content-Encoding'] = encoding
+    response['ETag'] = etag
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if HASHED_NAME.search(name) else REVALIDATE_CACHE_CONTROL
+    if variants:
+        response['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+# products/3f/3f9c...e1.jpg: the name is the SHA-256 of the content, so the file at a name never changes
+CONTENT_ADDRESSED_NAME = re.compile(r'^[\w-]+/(?P<prefix>[0-9a-f]{2})/(?P=prefix)[0-9a-f]{62}\.\w+$')
+# Cache-Control for a content-addressed file: browsers and CDNs may keep it for good
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def content_name(name, content):
+    # products/shoe.JPG + its content -> products/3f/3f9c...e1.jpg
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    digest = digest.hexdigest()
+    root = name.replace('\\', '/').split('/')[0]
+    return f"{root}/{digest[:2]}/{digest}{os.path.splitext(name)[1].lower()}"
+
+
+def is_content_addressed(name):
+    return bool(CONTENT_ADDRESSED_NAME.match(name))
+
+
+def is_immutable_media(path):
+    # Whether a request path is a content-addressed file under MEDIA_URL
+    return path.startswith(settings.MEDIA_URL) and is_content_addressed(path[len(settings.MEDIA_URL):])
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Saves a file under the hash of its content in the directory of the
+    name it is given, instead of the uploaded filename. Uploading the same
+    image twice (e.g. for product variants) stores it once: the second save
+    finds the file there and returns its name.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = content_name(name, content)
+        if self.exists(name):
+            return name
+        try:
+            return super().save(name, content, max_length)
+        except FileExistsError:
+            # Saved meanwhile by another upload of the same content
+            return name
+
+    def get_available_name(self, name, max_length=None):
+        if is_content_addressed(name) and self.exists(name):
+            # Instead of saving a copy under a suffixed name, see save()
+            raise FileExistsError(name)
+        return super().get_available_name(name, max_length)
+
+
+class LenientManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ManifestStaticFilesStorage that leaves a url() in a stylesheet as it
+    is when the file it points to is not in the project (the vendored
+    bootstrap.min.css and slick-theme.css refer to a few), instead of
+    failing collectstatic.
+    """
+
+    def hashed_name(self, name, content=None, filename=None):
+        try:
+            return super().hashed_name(name, content, filename)
+        except ValueError:
+            if content is not None:
+                raise
+            return name
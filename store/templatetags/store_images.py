@@ -0,0 +1,12 @@
+from django import template
+
+from store.images import slot_image
+
+
+register = template.Library()
+
+
+@register.inclusion_tag('store/product-image.html')
+def product_image(image, slot='card', alt='', css_class='', loading='lazy'):
+    # {% product_image image 'card' product.name %}: a <picture> with WebP and JPEG srcsets sized to the slot
+    return {**slot_image(image, slot), 'alt': alt, 'css_class': css_class, 'loading': loading}
@@ -1,3 +1,1358 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import admin
+from django.core import signing
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .caching import (
+    HOMEPAGE_NAMESPACE, PRODUCT_PAGE_NAMESPACE, bump_version, get_cart_summary, get_homepage_blocks, get_version,
+)
+from .context_processors import get_header_counters
+from .images import RENDITION_FORMATS, rebuild_images, render_pending
+from .importer import TARGET_ROWS_PER_SECOND, CatalogImporter, read_rows
+from .middleware import ImmutableMediaMiddleware, PrecompressedStaticMiddleware
+from .models import *
+from .orders import place_order
+from .pagination import CURSOR_SALT, CursorPaginator, InvalidCursor
+from .payments import claim_events, finish_event
+from .pricing import change_price, quantized_before_saving
+from .purge import STALE_CART_DAYS, delete_cart_items, orphaned_cart_items, purge, stale_carts
+from .related import EXPLICIT_RELATION_WEIGHT, compute_related
+from .search import search_products
+from .static_assets import brotli, precompress
+from .storage import is_content_addressed
+
+
+# Pages render without the offline compressor manifest or collected static files
+TEST_PAGE_SETTINGS = {
+    'COMPRESS_ENABLED': False,
+    # settings.py configures the manifest storage with STATICFILES_STORAGE, which Django 4.2 still reads
+    'STATICFILES_STORAGE': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+}
+
+# Query budgets for a full page render (warm cache); they must not grow with the number of products
+INDEX_PAGE_QUERIES = 3
+PRODUCT_PAGE_QUERIES = 1
+# The same page rendered for a page cache miss, related product cards included
+PRODUCT_PAGE_RENDER_QUERIES = 8
+CART_PAGE_QUERIES = 5
+# One chunk of manage.py purge_stale, however many rows it deletes
+PURGE_CHUNK_QUERIES = 4
+
+# Duplicate payment callbacks handled per second when they race each other
+TARGET_CALLBACKS_PER_SECOND = 20
+
+# Wall-clock targets depend on the machine, they are checked on request: STORE_BENCHMARKS=1 manage.py test store
+benchmark = skipUnless(os.environ.get('STORE_BENCHMARKS'), 'set STORE_BENCHMARKS=1 to run the benchmarks')
+
+
+def create_catalog(count, category=None):
+    category = category or Category.objects.create(name='Laptops')
+    products = []
+    for i in range(count):
+        product = Product.objects.create(
+            name=f'Product {i}', price=100 + i, description='A product', details='Details',
+            is_new=True, hot_deal=i % 2 == 0, sales=i,
+        )
+        product.categories.add(category)
+        products.append(product)
+    # bulk_create skips ProductImage.save, which would try to open the file
+    ProductImage.objects.bulk_create(
+        ProductImage(product=product, image=f'products/{product.pk}-{n}.png')
+        for product in products for n in range(2)
+    )
+    return products
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class ProductCardQueryBudgetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_index_page(self):
+        create_catalog(12)
+        self.client.get(reverse('product_list'))  # builds the homepage blocks
+        with self.assertNumQueries(INDEX_PAGE_QUERIES):
+            response = self.client.get(reverse('product_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['products']), 12)
+
+    def test_product_page(self):
+        products = create_catalog(12)
+        url = products[0].get_absolute_url()
+        self.client.get(url)
+        with self.assertNumQueries(PRODUCT_PAGE_QUERIES):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # Served from the page cache, so count the rendered related product cards
+        self.assertEqual(response.content.decode().count('<h3 class="product-name"><a'), 4)
+
+    def test_product_page_render(self):
+        products = create_catalog(12)
+        url = products[0].get_absolute_url()
+        self.client.get(url)  # caches the header counters
+        bump_version(PRODUCT_PAGE_NAMESPACE)  # retires the cached page
+        with self.assertNumQueries(PRODUCT_PAGE_RENDER_QUERIES):
+            response = self.client.get(url)
+        self.assertEqual(response.content.decode().count('<h3 class="product-name"><a'), 4)
+
+    def test_cart_page(self):
+        products = create_catalog(6)
+        for product in products:
+            self.client.post(reverse('product_list'), {'product_id': product.pk, 'quantity': 2})
+        self.client.get(reverse('cart'))  # caches the cart summary
+        with self.assertNumQueries(CART_PAGE_QUERIES):
+            response = self.client.get(reverse('cart'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cart_items']), 6)
+
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class CursorPaginationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        products = create_catalog(7)
+        # Ties on the sort value, broken by the primary key
+        Product.objects.filter(pk__in=[product.pk for product in products[:4]]).update(sales=5)
+        self.expected = list(Product.objects.order_by('-sales', '-pk').values_list('pk', flat=True))
+
+    def paginator(self, field='sales', descending=True):
+        return CursorPaginator(Product.objects.all(), field, 3, descending=descending)
+
+    def test_next_and_previous_pages(self):
+        paginator = self.paginator()
+        pages = [paginator.get_page()]
+        while pages[-1].has_next():
+            pages.append(paginator.get_page(pages[-1].next_cursor))
+        self.assertEqual([[product.pk for product in page] for page in pages], [self.expected[:3], self.expected[3:6], self.expected[6:]])
+        self.assertFalse(pages[0].has_previous())
+
+        back = paginator.get_page(pages[-1].previous_cursor)
+        self.assertEqual([product.pk for product in back], self.expected[3:6])
+        back = paginator.get_page(back.previous_cursor)
+        self.assertEqual([product.pk for product in back], self.expected[:3])
+        self.assertFalse(back.has_previous())
+
+    def test_tampered_cursor_is_invalid(self):
+        cursor = self.paginator().get_page().next_cursor
+        for bad in (cursor[:-2], 'nonsense', signing.dumps(['up', 'store.Product', 'sales', True, '5', 1], salt=CURSOR_SALT)):
+            with self.assertRaises(InvalidCursor):
+                self.paginator().get_page(bad)
+
+    def test_cursor_of_another_ordering_is_invalid(self):
+        cursor = self.paginator().get_page().next_cursor
+        with self.assertRaises(InvalidCursor):
+            self.paginator('timestamp', descending=False).get_page(cursor)
+        with self.assertRaises(InvalidCursor):
+            self.paginator(descending=False).get_page(cursor)
+
+        # The listing starts over instead of failing
+        response = self.client.get(reverse('product_list'), {'sort': 'position', 'cursor': cursor, 'show': 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class LazyCartTests(TestCase):
+
+    def test_browsing_writes_nothing(self):
+        product = create_catalog(2)[0]
+        for url in (reverse('product_list'), product.get_absolute_url(), reverse('cart'), reverse('wishlist')):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(Wishlist.objects.exists())
+        self.assertNotIn('sessionid', self.client.cookies)
+
+    def test_first_add_creates_the_cart(self):
+        product = create_catalog(1)[0]
+        self.client.post(product.get_absolute_url(), {'quantity': 2})
+        self.client.post(reverse('product_list'), {'product_id': product.pk, 'quantity': 3})
+
+        cart = Cart.objects.get()
+        self.assertEqual(self.client.session['cart_id'], cart.pk)
+        self.assertEqual(cart.get_total_items(), 1)
+        self.assertEqual(cart.items.get().quantity, 3)
+
+
+class CartSummaryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.cart = Cart.objects.create()
+        self.phone = Product.objects.create(
+            name='Phone', price=100, discount=True, discount_value=10, shipping_fee=5, description='', details='',
+        )
+        self.case = Product.objects.create(name='Case', price=20, shipping_fee=1, description='', details='')
+        for product, quantity in ((self.phone, 2), (self.case, 3)):
+            self.cart.items.add(CartItem.objects.create(product=product, quantity=quantity))
+
+    def test_summary_is_one_query(self):
+        with self.assertNumQueries(1):
+            summary = self.cart.get_summary()
+        self.assertEqual(summary, {'items': 2, 'total_quantity': 5, 'subtotal': Decimal('240'), 'shipping': 6})
+        self.assertEqual(self.cart.get_total_price(), Decimal('246'))
+
+    def test_cached_summary_follows_changes(self):
+        get_cart_summary(self.cart)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_summary(self.cart)['items'], 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cart.items.get(product=self.case).delete()
+        self.assertEqual(get_cart_summary(self.cart)['subtotal'], Decimal('180'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.phone.discount = False
+            self.phone.save()
+        self.assertEqual(get_cart_summary(self.cart)['subtotal'], Decimal('200'))
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class HeaderCountersTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def make_request(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        request.session = self.client.session
+        request.session.keys()  # loads the session outside the counted queries
+        return request
+
+    def test_counters_are_cached_until_the_cart_changes(self):
+        first, second = create_catalog(2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(first.get_absolute_url(), {'quantity': 1})
+        self.assertEqual(get_header_counters(self.make_request())['cart_items_count'], 1)
+        request = self.make_request()
+        with self.assertNumQueries(0):
+            counters = get_header_counters(request)
+        self.assertEqual(counters, {'cart_items_count': 1, 'wishlist_items_count': 0})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(second.get_absolute_url(), {'quantity': 1})
+        self.assertEqual(get_header_counters(self.make_request())['cart_items_count'], 2)
+
+
+@override_settings(CART_BACKEND='cache', **TEST_PAGE_SETTINGS)
+class CacheCartStoreTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.phone, self.case = create_catalog(2)
+
+    def test_add_to_cart_is_written_behind(self):
+        self.client.post(self.phone.get_absolute_url(), {'quantity': 2})
+        self.client.post(reverse('product_list'), {'product_id': self.case.pk, 'quantity': 1})
+        self.assertFalse(CartItem.objects.exists())
+        self.assertContains(self.client.get(self.phone.get_absolute_url()), 'name="quantity" value="2"')
+
+        call_command('flush_carts', stdout=io.StringIO())
+        cart = Cart.objects.get()
+        self.assertEqual(sorted(cart.items.values_list('product_id', 'quantity')), [(self.phone.pk, 2), (self.case.pk, 1)])
+
+        # Changed again, and read by the cart page before the flusher runs
+        self.client.post(self.phone.get_absolute_url(), {'quantity': 5})
+        response = self.client.get(reverse('cart'))
+        self.assertEqual(len(response.context['cart_items']), 2)
+        self.assertEqual(cart.items.get(product=self.phone).quantity, 5)
+        self.assertEqual(self.client.session['cart_id'], cart.pk)
+
+    def test_remove_from_cart_page(self):
+        self.client.post(self.phone.get_absolute_url(), {'quantity': 1})
+        item = self.client.get(reverse('cart')).context['cart_items'][0]
+        self.client.post(reverse('cart'), {'item_id': item.pk})
+
+        self.assertEqual(len(self.client.get(reverse('cart')).context['cart_items']), 0)
+        self.assertFalse(CartItem.objects.exists())
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class CartApiTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.phone, self.case = create_catalog(2)
+
+    def post(self, action, **data):
+        return self.client.post(reverse('cart_api_action', args=[action]), data)
+
+    def test_add_set_and_remove(self):
+        data = self.post('add', product_id=self.phone.pk, quantity=2).json()
+        self.assertEqual(data['cart_items_count'], 1)
+        self.assertEqual(data['line'], {
+            'product_id': self.phone.pk, 'quantity': 2, 'unit_price': '100.00', 'line_total': '200.00',
+        })
+
+        self.post('add', product_id=self.phone.pk, quantity=1)
+        data = self.post('add', product_id=self.case.pk, quantity=1).json()
+        self.assertEqual(data['cart_items_count'], 2)
+        self.assertEqual([line['quantity'] for line in data['lines']], [3, 1])
+        self.assertEqual(Decimal(data['subtotal']), Decimal('401.00'))
+
+        data = self.post('set', product_id=self.phone.pk, quantity=0).json()
+        self.assertIsNone(data['line'])
+        data = self.post('remove', product_id=self.case.pk).json()
+        self.assertEqual(data['cart_items_count'], 0)
+        self.assertFalse(CartItem.objects.exists())
+
+        # The header counters follow the API
+        self.post('add', product_id=self.case.pk, quantity=1)
+        self.assertEqual(self.client.get(reverse('cart_api')).json()['cart_items_count'], 1)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post('add', product_id='x').status_code, 400)
+        self.assertEqual(self.post('add', product_id=self.phone.pk, quantity=0).status_code, 400)
+        self.assertEqual(self.post('add', product_id=0).status_code, 404)
+        self.assertEqual(self.post('empty', product_id=self.phone.pk).status_code, 404)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_summary_of_a_visitor_without_a_cart(self):
+        with self.assertNumQueries(0):
+            data = self.client.get(reverse('cart_api')).json()
+        self.assertEqual((data['cart_items_count'], data['lines']), (0, []))
+        self.assertFalse(Cart.objects.exists())
+
+    @override_settings(CART_BACKEND='cache')
+    def test_cache_backend(self):
+        self.post('add', product_id=self.phone.pk, quantity=2)
+        data = self.post('set', product_id=self.phone.pk, quantity=4).json()
+        self.assertEqual((data['cart_items_count'], data['line']['quantity']), (1, 4))
+        self.assertFalse(CartItem.objects.exists())
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class CartIdentityTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.phone, self.case, self.charger = create_catalog(3)
+        self.user = User.objects.create_user('ada', 'ada@example.com', 'secret-password')
+
+    def add(self, product, quantity):
+        self.client.post(reverse('cart_api_action', args=['add']), {'product_id': product.pk, 'quantity': quantity})
+
+    def log_in(self):
+        self.client.post(reverse('account_login'), {'login': 'ada', 'password': 'secret-password'})
+
+    def test_one_active_cart_per_user(self):
+        cart, created = Cart.objects.get_or_create_active(self.user.pk)
+        self.assertEqual(Cart.objects.get_or_create_active(self.user.pk), (cart, False))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Cart.objects.create(user=self.user)
+
+        # A paid cart is retired, it does not count against the constraint
+        cart.is_paid, cart.is_active = True, None
+        cart.save()
+        self.assertNotEqual(Cart.objects.get_or_create_active(self.user.pk)[0], cart)
+
+    def test_session_cart_is_merged_at_login(self):
+        self.client.force_login(self.user)
+        self.add(self.phone, 1)
+        self.client.logout()
+
+        self.add(self.phone, 2)
+        self.add(self.case, 1)
+        self.log_in()
+
+        cart = Cart.objects.get()
+        self.assertEqual(cart.user, self.user)
+        self.assertEqual(sorted(cart.items.values_list('product_id', 'quantity')), [(self.phone.pk, 3), (self.case.pk, 1)])
+        self.assertEqual(CartItem.objects.count(), 2)
+        self.assertNotIn('cart_id', self.client.session)
+        self.assertEqual(self.client.get(reverse('cart_api')).json()['cart_items_count'], 2)
+
+    @override_settings(CART_BACKEND='cache')
+    def test_cache_backend_cart_is_merged_at_login(self):
+        self.add(self.phone, 2)
+        self.log_in()
+
+        self.assertEqual(Cart.objects.get().user, self.user)
+        self.add(self.case, 1)
+        data = self.client.get(reverse('cart_api')).json()
+        self.assertEqual([(line['product_id'], line['quantity']) for line in data['lines']], [(self.phone.pk, 2), (self.case.pk, 1)])
+
+    def test_consolidate_duplicate_carts(self):
+        active = Cart.objects.get_or_create_active(self.user.pk)[0]
+        active.items.add(CartItem.objects.create(user=self.user, product=self.phone, quantity=1))
+        # Duplicates as migration 0010 leaves them
+        for product in (self.phone, self.case):
+            duplicate = Cart.objects.create(user=self.user, is_active=None)
+            duplicate.items.add(CartItem.objects.create(user=self.user, product=product, quantity=2))
+        paid = Cart.objects.create(user=self.user, is_active=None, is_paid=True)
+
+        call_command('consolidate_carts', batch_size=1, stdout=io.StringIO())
+        self.assertEqual(set(Cart.objects.all()), {active, paid})
+        self.assertEqual(sorted(active.items.values_list('product_id', 'quantity')), [(self.phone.pk, 3), (self.case.pk, 2)])
+        self.assertEqual(CartItem.objects.count(), 2)
+
+
+class CartIsActiveMigrationTests(TransactionTestCase):
+    before = [('store', '0009_product_updated_index')]
+    after = [('store', '0010_cart_is_active')]
+
+    def tearDown(self):
+        # Back to the latest schema for the tests that follow
+        call_command('migrate', 'store', verbosity=0)
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_oldest_paid_cart_is_not_kept_active(self):
+        apps = self.migrate(self.before)
+        user = apps.get_model('auth', 'User').objects.create(username='ada')
+        OldCart = apps.get_model('store', 'Cart')
+        paid = OldCart.objects.create(user_id=user.pk, is_paid=True)
+        first_unpaid = OldCart.objects.create(user_id=user.pk)
+        second_unpaid = OldCart.objects.create(user_id=user.pk)
+
+        apps = self.migrate(self.after)
+        is_active = dict(apps.get_model('store', 'Cart').objects.values_list('pk', 'is_active'))
+        self.assertEqual(is_active, {paid.pk: None, first_unpaid.pk: True, second_unpaid.pk: None})
+
+
+class PurgeStaleTests(TestCase):
+
+    def test_purge_stale(self):
+        phone, case = create_catalog(2)
+        user = User.objects.create_user('ada')
+        old = timezone.now() - timedelta(days=STALE_CART_DAYS + 1)
+
+        carts = {}
+        for name, owner in (('abandoned', None), ('recent', None), ('user', user)):
+            carts[name] = Cart.objects.create(user=owner)
+            carts[name].items.add(CartItem.objects.create(product=phone))
+        Cart.objects.filter(pk__in=[carts['abandoned'].pk, carts['user'].pk]).update(updated_at=old)
+        # Emptied at payment, the item is left in no cart
+        carts['recent'].items.add(CartItem.objects.create(product=case))
+        carts['recent'].items.remove(CartItem.objects.get(product=case))
+
+        kept_wishlist = Wishlist.objects.create()
+        WishlistItem.objects.create(wishlist=kept_wishlist, product=phone)
+        Wishlist.objects.create()
+        user_wishlist = Wishlist.objects.create(user=user)
+        Session.objects.create(session_key='expired', session_data='', expire_date=old)
+        Session.objects.create(session_key='live', session_data='', expire_date=timezone.now() + timedelta(days=1))
+
+        out = io.StringIO()
+        call_command('purge_stale', chunk_size=1, stdout=out)
+        self.assertIn('cart items: 2 deleted', out.getvalue())
+        self.assertEqual(set(Cart.objects.all()), {carts['recent'], carts['user']})
+        self.assertEqual(CartItem.objects.count(), 2)
+        self.assertEqual(set(Wishlist.objects.all()), {kept_wishlist, user_wishlist})
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['live'])
+
+    def test_orphaned_cart_items_are_deleted_in_bulk(self):
+        phone, = create_catalog(1)
+        cart = Cart.objects.create()
+        cart.items.add(CartItem.objects.create(product=phone))
+        CartItem.objects.bulk_create(CartItem(product=phone) for _ in range(20))
+        # Per chunk: its primary keys, then one DELETE in a savepoint; and the empty last chunk
+        with self.assertNumQueries(PURGE_CHUNK_QUERIES * 2 + 1):
+            self.assertEqual(purge(orphaned_cart_items(), 10, delete=delete_cart_items)[0], 20)
+        self.assertEqual(list(CartItem.objects.all()), list(cart.items.all()))
+
+    def test_cart_changes_keep_a_cart(self):
+        phone, = create_catalog(1)
+        cart = Cart.objects.create()
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now() - timedelta(days=STALE_CART_DAYS + 1))
+        cart.items.add(CartItem.objects.create(product=phone))
+        self.assertFalse(stale_carts().exists())
+
+
+def pay(client, reference):
+    return client.post(
+        reverse('payment_status'), json.dumps({'status': 'success', 'reference': reference}),
+        content_type='application/json',
+    )
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class PaymentTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.phone, self.case = create_catalog(2)
+        Product.objects.filter(pk=self.case.pk).update(shipping_fee=5)
+        self.user = User.objects.create_user('ada')
+        self.client.force_login(self.user)
+        for product, quantity in ((self.phone, 2), (self.case, 1)):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('cart_api_action', args=['add']), {'product_id': product.pk, 'quantity': quantity})
+
+    def process_events(self):
+        return [finish_event(event, 'test') for event in claim_events('test')]
+
+    def test_callback_is_stored_then_made_into_an_order(self):
+        # Stored and answered without making the order
+        self.assertEqual(self.client.get(reverse('product_list')).context['cart_items_count'], 2)
+        with self.assertNumQueries(6), self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(pay(self.client, 'ref-1').json(), {'status': 'success'})
+        self.assertFalse(Order.objects.exists())
+        # Set aside for the order, later adds go to a new cart
+        cart = Cart.objects.get()
+        self.assertEqual((cart.is_active, cart.reference, PaymentEvent.objects.get().cart), (None, 'ref-1', cart))
+        self.assertEqual(self.client.get(reverse('cart_api')).json()['cart_items_count'], 0)
+        self.assertEqual(self.client.get(reverse('product_list')).context['cart_items_count'], 0)
+
+        self.assertEqual(self.process_events(), ['done'])
+        order = Order.objects.get()
+        self.assertEqual(PaymentEvent.objects.get().order, order)
+        self.assertEqual((order.user, order.reference, order.total_price), (self.user, 'ref-1', Decimal('306.00')))
+        self.assertEqual(
+            sorted(order.orderitem_set.values_list('product_id', 'quantity', 'unit_price')),
+            [(self.phone.pk, 2, Decimal('100.00')), (self.case.pk, 1, Decimal('101.00'))],
+        )
+        self.assertEqual(Product.objects.get(pk=self.phone.pk).sales, 2)
+        cart.refresh_from_db()
+        self.assertEqual((cart.is_paid, cart.items.count()), (True, 0))
+
+        # The callback delivered again, after something new went into the cart
+        self.client.post(reverse('cart_api_action', args=['add']), {'product_id': self.phone.pk, 'quantity': 1})
+        pay(self.client, 'ref-1')
+        self.assertEqual(self.process_events(), ['done'])
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.client.get(reverse('cart_api')).json()['cart_items_count'], 1)
+
+    @override_settings(CART_BACKEND='cache')
+    def test_cache_backend_checkout(self):
+        pay(self.client, 'ref-1')
+        self.assertEqual(self.client.get(reverse('cart_api')).json()['cart_items_count'], 0)
+        self.process_events()
+        self.assertEqual(Order.objects.get().orderitem_set.count(), 2)
+
+    def test_retried_with_another_reference(self):
+        cart = Cart.objects.get()
+        order, created = place_order(cart.pk, 'ref-1')
+        self.assertEqual(place_order(cart.pk, 'ref-2'), (order, False))
+
+    def test_bad_callbacks(self):
+        self.assertEqual(pay(self.client, '').status_code, 400)
+        self.client.logout()
+        self.assertEqual(pay(self.client, 'ref-1').status_code, 403)
+        self.assertFalse(PaymentEvent.objects.exists())
+
+        # Failed payments are only recorded; a cart that cannot be ordered is not retried
+        self.client.post(reverse('payment_status'), {'status': 'failed', 'reference': 'ref-2'})
+        PaymentEvent.objects.create(payload='{"status": "success"}', reference='ref-3', cart=Cart.objects.create())
+        self.assertEqual(sorted(self.process_events()), ['done', 'failed'])
+        self.assertEqual(PaymentEvent.objects.get(reference='ref-3').last_error, 'The cart has no user')
+        self.assertFalse(Order.objects.exists())
+
+    def test_abandoned_claims_are_taken_over(self):
+        pay(self.client, 'ref-1')
+        self.assertEqual(len(claim_events('crashed')), 1)
+        self.assertEqual(claim_events('other'), [])
+        PaymentEvent.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.process_events(), ['done'])
+
+
+class ConcurrentPaymentTests(TransactionTestCase):
+    # Duplicate deliveries of one callback racing each other
+    CALLBACKS = 16
+
+    def race_callbacks(self):
+        # Returns ([(order id, created)] of every callback, seconds taken)
+        phone, = create_catalog(1)
+        user = User.objects.create_user('ada')
+        cart = Cart.objects.get_or_create_active(user.pk)[0]
+        cart.items.add(CartItem.objects.create(user=user, product=phone, quantity=2))
+
+        def callback(_):
+            try:
+                order, created = place_order(cart.pk, 'ref-1')
+                return order.pk, created
+            finally:
+                connection.close()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(callback, range(self.CALLBACKS)))
+        return results, time.monotonic() - started
+
+    def test_duplicate_callbacks_in_parallel(self):
+        results, _ = self.race_callbacks()
+        self.assertEqual(len(results), self.CALLBACKS)
+        self.assertEqual({order_id for order_id, _ in results}, {Order.objects.get().pk})
+        # Only one callback claimed the cart
+        self.assertEqual([created for _, created in results].count(True), 1)
+        self.assertEqual(OrderItem.objects.get().quantity, 2)
+        self.assertEqual(Product.objects.get().sales, 2)
+
+    @benchmark
+    def test_duplicate_callbacks_rate(self):
+        _, seconds = self.race_callbacks()
+        rate = self.CALLBACKS / seconds
+        print(f"\n{rate:.0f} duplicate callbacks/s (target {TARGET_CALLBACKS_PER_SECOND})")
+        self.assertGreaterEqual(rate, TARGET_CALLBACKS_PER_SECOND)
+
+    def test_worker_end_to_end(self):
+        phone, = create_catalog(1)
+        clients = []
+        for i in range(4):
+            client = self.client_class()
+            client.force_login(User.objects.create_user(f'user-{i}'))
+            client.post(reverse('cart_api_action', args=['add']), {'product_id': phone.pk, 'quantity': 1})
+            clients.append(client)
+        # Every callback delivered three times
+        for i, client in enumerate(clients * 3):
+            pay(client, f'ref-{i % 4}')
+
+        out = io.StringIO()
+        call_command('process_payment_events', workers=4, batch_size=2, stdout=out)
+        self.assertIn('Processed 12 events: 12 done', out.getvalue())
+        self.assertEqual(sorted(Order.objects.values_list('reference', flat=True)), [f'ref-{i}' for i in range(4)])
+        self.assertEqual(Product.objects.get().sales, 4)
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class OrderHistoryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.products = create_catalog(4)
+        self.user = User.objects.create_user('ada')
+        self.client.force_login(self.user)
+
+    def order(self, reference, line_count):
+        cart = Cart.objects.create(user=self.user, is_active=None)
+        cart.items.add(*[CartItem.objects.create(user=self.user, product=product) for product in self.products[:line_count]])
+        return place_order(cart.pk, reference)[0]
+
+    def count_queries(self, url):
+        self.client.get(url)  # warm the header counters
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_summary_is_written_with_the_order(self):
+        order = self.order('ref-1', 3)
+        self.assertEqual(order.item_count, 3)
+        self.assertEqual(order.image.name, f'products/{self.products[0].pk}-0.png')
+
+    def test_history_pages(self):
+        orders = [self.order(f'ref-{i}', 1 + i % 4) for i in range(12)]
+        Order.objects.create(user=User.objects.create_user('bob'), total_price=1, reference='other')
+
+        response = self.client.get(reverse('order_history'))
+        page = response.context['orders']
+        self.assertEqual([order.reference for order in page], [f'ref-{i}' for i in range(11, 1, -1)])
+        self.assertContains(response, orders[11].get_absolute_url())
+        page = self.client.get(reverse('order_history'), {'cursor': page.next_cursor}).context['orders']
+        self.assertEqual([order.reference for order in page], ['ref-1', 'ref-0'])
+        self.assertFalse(page.has_next())
+
+    def test_detail_queries_do_not_grow_with_the_lines(self):
+        small, large = self.order('ref-1', 1), self.order('ref-2', 4)
+        self.assertEqual(self.count_queries(small.get_absolute_url()), self.count_queries(large.get_absolute_url()))
+        self.assertContains(self.client.get(large.get_absolute_url()), self.products[3].name)
+
+    def test_orders_are_private(self):
+        order = self.order('ref-1', 1)
+        self.client.force_login(User.objects.create_user('bob'))
+        self.assertEqual(self.client.get(order.get_absolute_url()).status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('order_history')).status_code, 302)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.laptops = Category.objects.create(name='Laptops')
+        self.laptop = Product.objects.create(
+            name='Gaming Laptop', price=900, description='A fast laptop', details='16GB of memory',
+        )
+        self.laptop.categories.add(self.laptops)
+        self.bag = Product.objects.create(
+            name='Travel Bag', price=40, description='Fits a laptop', details='Waterproof',
+        )
+
+    def search(self, query):
+        return list(search_products(Product.objects.all(), query))
+
+    def terms(self, product):
+        return dict(product.search_terms.values_list('term', 'weight'))
+
+    def test_index_weights_fields(self):
+        terms = self.terms(self.laptop)
+        # name 10 + description 2
+        self.assertEqual(terms['laptop'], 12)
+        self.assertEqual((terms['gaming'], terms['laptops'], terms['fast'], terms['16gb']), (10, 5, 2, 1))
+        self.assertNotIn('of', terms)
+
+    def test_index_follows_product_and_category_changes(self):
+        self.bag.name = 'Travel Backpack'
+        self.bag.save()
+        self.assertIn('backpack', self.terms(self.bag))
+        self.assertNotIn('bag', self.terms(self.bag))
+
+        self.bag.categories.add(self.laptops)
+        self.assertEqual(self.terms(self.bag)['laptops'], 5)
+        self.laptops.name = 'Notebooks'
+        self.laptops.save()
+        self.assertNotIn('laptops', self.terms(self.bag))
+        self.assertEqual(self.search('notebooks'), [self.bag, self.laptop])
+        self.laptops.delete()
+        self.assertEqual(self.search('notebooks'), [])
+
+    def test_ranking(self):
+        self.assertEqual(self.search('laptop'), [self.laptop, self.bag])
+        self.assertEqual(self.search('waterproof'), [self.bag])
+        # Prefixes of three letters or more
+        self.assertEqual(self.search('lap'), [self.laptop, self.bag])
+        self.assertEqual(self.search('nothing here'), [])
+
+    def test_accents_and_case_are_folded(self):
+        cafe = Product.objects.create(name='Café cafe CAFE', price=5, description='Crème brûlée', details='')
+        self.assertEqual(self.terms(cafe), {'cafe': 30, 'creme': 2, 'brulee': 2})
+        self.assertEqual(self.search('CAFÉ'), [cafe])
+        self.assertEqual(self.search('creme'), [cafe])
+
+    def test_queries_without_indexed_terms_match_names(self):
+        phone = Product.objects.create(name='Phone X', price=5, description='', details='', sales=3)
+        box = Product.objects.create(name='Xbox', price=5, description='', details='', sales=9)
+        self.assertEqual(self.search('x'), [box, phone])
+        self.assertEqual(self.search('The'), [])
+        self.assertEqual(self.search('  '), [])
+
+
+class RelatedProductsTests(TestCase):
+
+    def setUp(self):
+        self.phones = Category.objects.create(name='Phones')
+        self.accessories = Category.objects.create(name='Accessories')
+        self.phone, self.other_phone, self.case, self.charger = [
+            Product.objects.create(name=name, price=10, description='', details='')
+            for name in ('Phone', 'Other phone', 'Case', 'Charger')
+        ]
+        self.phone.categories.add(self.phones, self.accessories)
+        self.other_phone.categories.add(self.phones)
+        self.case.categories.add(self.phones, self.accessories)
+        self.charger.categories.add(self.accessories)
+
+    def related(self, product):
+        return list(RelatedProduct.objects.filter(product=product).order_by('-score', '-related').values_list(
+            'related', 'score',
+        ))
+
+    def test_compute_related(self):
+        # Two shared categories before one, a hand-picked relation above both
+        self.assertEqual(compute_related(self.phone.pk), [
+            (self.case.pk, 2), (self.charger.pk, 1), (self.other_phone.pk, 1),
+        ])
+        self.charger.related_products.add(self.phone)
+        self.assertEqual(compute_related(self.phone.pk)[0], (self.charger.pk, 1 + EXPLICIT_RELATION_WEIGHT))
+        self.assertEqual(compute_related(self.charger.pk)[0], (self.phone.pk, 1 + EXPLICIT_RELATION_WEIGHT))
+
+    def test_stored_lists_follow_category_changes(self):
+        self.assertEqual(self.related(self.other_phone), [(self.case.pk, 1), (self.phone.pk, 1)])
+        self.case.categories.remove(self.phones)
+        self.assertEqual(self.related(self.other_phone), [(self.phone.pk, 1)])
+        self.assertEqual(self.related(self.case), [(self.charger.pk, 1), (self.phone.pk, 1)])
+
+        # From the category side, and when a category goes away
+        self.phones.product_set.add(self.charger)
+        self.assertIn((self.charger.pk, 1), self.related(self.other_phone))
+        self.phones.delete()
+        self.assertEqual(self.related(self.other_phone), [])
+        self.assertNotIn(self.other_phone.pk, [related for related, _ in self.related(self.phone)])
+
+    def test_rebuild(self):
+        RelatedProduct.objects.all().delete()
+        RelatedProduct.objects.create(product=self.charger, related=self.other_phone, score=50)
+        expected = {product.pk: compute_related(product.pk) for product in Product.objects.all()}
+        updated_at = Product.objects.get(pk=self.phone.pk).updated_at
+
+        call_command('rebuild_related_products', batch_size=3, stdout=io.StringIO())
+        for product in Product.objects.all():
+            self.assertEqual(self.related(product), expected[product.pk])
+        # The related block is on the product page
+        self.assertGreater(Product.objects.get(pk=self.phone.pk).updated_at, updated_at)
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class SalesCountTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.products = create_catalog(3)
+        Product.objects.update(sales=0)
+        self.user = User.objects.create_user('ada')
+
+    def order(self, *lines):
+        order = Order.objects.create(user=self.user, total_price=1, reference=f'ref-{Order.objects.count()}')
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=product, quantity=quantity, unit_price=1) for product, quantity in lines
+        )
+        order.record_sales()
+        return order
+
+    def sales(self):
+        return list(Product.objects.order_by('pk').values_list('sales', flat=True))
+
+    def test_record_sales_adds_quantities(self):
+        first, second, third = self.products
+        self.order((first, 2), (second, 1), (first, 3))
+        self.order((second, 4))
+        self.assertEqual(self.sales(), [5, 5, 0])
+
+    def test_admin_edit_keeps_counted_sales(self):
+        model_admin = admin.site._registry[Product]
+        request = RequestFactory().post('/')
+        request.user = User.objects.create_superuser('admin')
+        product = model_admin.get_object(request, str(self.products[0].pk))
+        form = model_admin.get_form(request, product)({
+            'name': 'Renamed', 'price': '150.00', 'discount_value': 0, 'discount_price': '0',
+            'categories': [self.products[0].categories.get().pk], 'description': 'A product',
+            'details': 'Details', 'is_new': 'on', 'shipping_fee': 0, 'slug': product.slug,
+        }, instance=product)
+        self.assertTrue(form.is_valid(), form.errors)
+        # An order placed while the form is open
+        self.order((self.products[0], 2))
+        model_admin.save_model(request, form.save(commit=False), form, True)
+
+        product = Product.objects.get(pk=product.pk)
+        self.assertEqual((product.name, product.discount_price, product.sales), ('Renamed', Decimal('150.00'), 2))
+
+    def test_plain_saves(self):
+        # Copying a product, and saving one whose row is gone, insert a new row
+        product = Product.objects.get(pk=self.products[0].pk)
+        product.pk, product.slug = None, 'copy'
+        product.save()
+        self.assertEqual(Product.objects.get(slug='copy').name, 'Product 0')
+
+        Product.objects.filter(pk=product.pk).delete()
+        product.save()
+        self.assertTrue(Product.objects.filter(pk=product.pk, slug='copy').exists())
+
+    def test_rebuild_sales_counts(self):
+        first, second, third = self.products
+        self.order((first, 2), (third, 1))
+        Product.objects.filter(pk=first.pk).update(sales=40)
+        Product.objects.filter(pk=second.pk).update(sales=3)
+        call_command('rebuild_sales_counts', batch_size=2, stdout=io.StringIO())
+        self.assertEqual(self.sales(), [2, 0, 1])
+
+    def test_listing_ranks_by_sales(self):
+        first, second, third = self.products
+        self.order((second, 3), (third, 1))
+        self.order((third, 1))
+        products = self.client.get(reverse('product_list'), {'sort': 'popular'}).context['products']
+        self.assertEqual(list(products), [second, third, first])
+
+
+class HomepageBlocksCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_blocks_are_cached(self):
+        create_catalog(4)
+        get_homepage_blocks()
+        with self.assertNumQueries(0):
+            blocks = get_homepage_blocks()
+        self.assertEqual(len(blocks['top_selling']), 3)
+
+    def test_product_change_invalidates_blocks(self):
+        products = create_catalog(4)
+        self.assertEqual(get_homepage_blocks()['top_selling'][0], products[-1])
+
+        # sales itself is only written by Order.record_sales(), see SalesCountTests
+        with self.captureOnCommitCallbacks(execute=True):
+            products[-1].name = 'Renamed'
+            products[-1].save()
+        self.assertEqual(get_homepage_blocks()['top_selling'][0].name, 'Renamed')
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class ProductPageCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.product = create_catalog(3)[0]
+        self.url = self.product.get_absolute_url()
+
+    def test_repeat_visit_is_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_cached_page_is_filled_per_visitor(self):
+        self.client.get(self.url)
+        self.client.post(self.url, {'quantity': 3})
+        self.client.get(self.url)  # consumes the flash message
+
+        response = self.client.get(self.url)
+        content = response.content.decode()
+        self.assertNotIn('__STORE_', content)
+        self.assertIn('name="quantity" value="3"', content)
+        self.assertIn('<div class="qty" data-cart-count>1</div>', content)
+        self.assertNotIn('Last-Modified', response)
+
+    def test_product_change_retires_cached_page(self):
+        etag = self.client.get(self.url)['ETag']
+        ProductImage.objects.filter(product=self.product).first().delete()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_related_product_change_retires_cached_page(self):
+        related = RelatedProduct.objects.filter(product=self.product).first().related
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertIn(related.name, response.content.decode())
+
+        Product.objects.filter(pk=related.pk).update(name='Renamed', updated_at=timezone.now())
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Renamed', response.content.decode())
+
+    def test_new_static_files_retire_cached_page(self):
+        etag = self.client.get(self.url)['ETag']
+        with override_settings(STATIC_VERSION='next-deploy'):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('next-deploy', response.content.decode())
+
+
+def use_temporary_media_root(test):
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root)
+    settings_override = override_settings(MEDIA_ROOT=media_root)
+    settings_override.enable()
+    test.addCleanup(settings_override.disable)
+
+
+def jpeg_bytes(size):
+    buffer = io.BytesIO()
+    Image.effect_noise(size, 40).convert('RGB').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+@override_settings(**TEST_PAGE_SETTINGS)
+class ImageRenditionTests(TestCase):
+
+    def setUp(self):
+        use_temporary_media_root(self)
+        cache.clear()
+        self.product = create_catalog(1)[0]
+        ProductImage.objects.filter(product=self.product).delete()
+
+    def upload(self, size):
+        return ProductImage.objects.create(
+            product=self.product, image=SimpleUploadedFile('shoe.jpg', jpeg_bytes(size), 'image/jpeg'),
+        )
+
+    def test_upload_keeps_original_until_rendered(self):
+        image = self.upload((1600, 1200))
+        with Image.open(image.image.path) as original:
+            self.assertEqual(original.size, (1600, 1200))
+        self.assertEqual(list(ProductImage.objects.pending()), [image])
+        self.assertNotIn('srcset', self.client.get(self.product.get_absolute_url()).content.decode())
+
+    def test_renditions_in_every_size_and_format(self):
+        image = self.upload((1600, 1200))
+        totals, seconds = render_pending(processes=1)
+        self.assertEqual((totals['rendered'], totals['failed']), (1, 0))
+        self.assertFalse(ProductImage.objects.pending().exists())
+
+        image.refresh_from_db()
+        self.assertEqual(
+            {size: (rendition['width'], rendition['height']) for size, rendition in image.renditions.items()},
+            {'card': (300, 225), 'gallery': (600, 450), 'zoom': (1200, 900)},
+        )
+        for rendition in image.renditions.values():
+            with Image.open(default_storage.path(rendition['webp'])) as webp:
+                self.assertEqual((webp.format, webp.width), ('WEBP', rendition['width']))
+            with Image.open(default_storage.path(rendition['jpeg'])) as jpeg:
+                self.assertEqual((jpeg.format, jpeg.width), ('JPEG', rendition['width']))
+
+        content = self.client.get(self.product.get_absolute_url()).content.decode()
+        card = image.renditions['card']
+        self.assertIn(f'type="image/webp" srcset="{default_storage.url(card["webp"])} 300w, ', content)
+        self.assertIn(f'data-src="{default_storage.url(image.renditions["zoom"]["jpeg"])}"', content)
+
+    def test_placeholder_and_size_are_recorded(self):
+        image = self.upload((1600, 1200))
+        render_pending(processes=1)
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height), (1600, 1200))
+        self.assertTrue(image.placeholder.startswith('data:image/webp;base64,'))
+        self.assertLess(len(image.placeholder), 500)
+
+        content = self.client.get(self.product.get_absolute_url()).content.decode()
+        # The gallery's first image is not lazy, the thumbnails are
+        self.assertIn(f'width="600" height="450" data-src="{image.image.storage.url(image.renditions["zoom"]["jpeg"])}"', content)
+        self.assertIn('width="300" height="225"', content)
+        self.assertIn('loading="lazy"', content)
+        self.assertIn(f'style="background: url({image.placeholder}) center / cover no-repeat"', content)
+
+    def test_small_original_is_not_scaled_up(self):
+        image = self.upload((400, 200))
+        render_pending(processes=1)
+        image.refresh_from_db()
+        self.assertEqual(image.renditions['card']['width'], 300)
+        self.assertEqual(image.renditions['gallery'], image.renditions['zoom'])
+        self.assertEqual(image.renditions['zoom']['width'], 400)
+
+    def test_replaced_image_is_rendered_again(self):
+        image = self.upload((1600, 1200))
+        render_pending(processes=1)
+        image.refresh_from_db()
+        old_card = image.renditions['card']['jpeg']
+
+        image.image = self.upload((800, 800)).image
+        image.save()
+        self.assertIn(image, ProductImage.objects.pending())
+        render_pending(processes=1)
+        image.refresh_from_db()
+        self.assertEqual(image.renditions['zoom']['width'], 800)
+        self.assertFalse(default_storage.exists(old_card))
+
+    def test_rebuild_skips_unchanged_images(self):
+        self.upload((800, 600))
+        self.upload((700, 500))
+        render_pending(processes=1)
+
+        totals, seconds = rebuild_images(ProductImage.objects.all(), processes=1)
+        self.assertEqual((totals['rendered'], totals['skipped']), (0, 2))
+
+        # A lower quality changes every source hash, and the renditions shrink
+        with mock.patch.dict(RENDITION_FORMATS, webp=('WEBP', {'quality': 20, 'method': 6})):
+            totals, seconds = rebuild_images(ProductImage.objects.filter(product=self.product), processes=1)
+        self.assertEqual((totals['rendered'], totals['skipped']), (2, 0))
+        self.assertGreater(totals['saved'], 0)
+
+    def test_interrupted_rebuild_resumes(self):
+        first, second = self.upload((800, 600)), self.upload((800, 600))
+        checkpoint = os.path.join(settings.MEDIA_ROOT, 'checkpoint.json')
+
+        def interrupt(message):
+            raise KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            rebuild_images(ProductImage.objects.all(), processes=1, batch_size=1, checkpoint=checkpoint, log=interrupt)
+        self.assertEqual(ProductImage.objects.pending().get(), second)
+
+        totals, seconds = rebuild_images(ProductImage.objects.all(), processes=1, batch_size=1, checkpoint=checkpoint)
+        self.assertEqual((totals['rendered'], totals['skipped']), (1, 0))
+        self.assertFalse(ProductImage.objects.pending().exists())
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_unreadable_image_falls_back_to_original(self):
+        image = ProductImage.objects.create(
+            product=self.product, image=SimpleUploadedFile('broken.jpg', b'not an image', 'image/jpeg'),
+        )
+        self.assertEqual(render_pending(processes=1)[0]['failed'], 1)
+        self.assertFalse(ProductImage.objects.pending().exists())
+        self.assertIn(f'src="{image.image.url}"', self.client.get(self.product.get_absolute_url()).content.decode())
+
+
+class ContentAddressedImageTests(TestCase):
+
+    def setUp(self):
+        use_temporary_media_root(self)
+        self.product = create_catalog(1)[0]
+        ProductImage.objects.filter(product=self.product).delete()
+        self.data = jpeg_bytes((64, 48))
+
+    def upload(self, name):
+        return ProductImage.objects.create(product=self.product, image=SimpleUploadedFile(name, self.data, 'image/jpeg'))
+
+    def test_identical_uploads_are_stored_once(self):
+        first, second = self.upload('shoe.jpg'), self.upload('shoe-variant.JPG')
+        digest = hashlib.sha256(self.data).hexdigest()
+        self.assertEqual(first.image.name, f'products/{digest[:2]}/{digest}.jpg')
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertEqual(os.listdir(os.path.dirname(first.image.path)), [f'{digest}.jpg'])
+
+    def test_media_is_immutable(self):
+        image = self.upload('shoe.jpg')
+        middleware = ImmutableMediaMiddleware(lambda request: HttpResponse())
+        response = middleware(RequestFactory().get(image.image.url))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        response = middleware(RequestFactory().get(settings.MEDIA_URL + 'products/shoe.jpg'))
+        self.assertNotIn('Cache-Control', response)
+
+    def test_existing_images_are_moved(self):
+        default_storage.save('products/shoe.jpg', io.BytesIO(self.data))
+        default_storage.save('products/shoe-copy.jpg', io.BytesIO(self.data))
+        images = ProductImage.objects.bulk_create(
+            ProductImage(product=self.product, image=name) for name in ('products/shoe.jpg', 'products/shoe-copy.jpg')
+        )
+        order = Order.objects.create(
+            user=User.objects.create_user('buyer'), total_price=1, status='pending', image='products/shoe.jpg',
+        )
+
+        call_command('content_address_images', batch_size=1, stdout=io.StringIO())
+        names = set(ProductImage.objects.filter(pk__in=[image.pk for image in images]).values_list('image', flat=True))
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertTrue(is_content_addressed(name))
+        order.refresh_from_db()
+        self.assertEqual(order.image.name, name)
+        self.assertFalse(default_storage.exists('products/shoe.jpg'))
+        self.assertFalse(default_storage.exists('products/shoe-copy.jpg'))
+
+
+class PrecompressedStaticTests(TestCase):
+
+    def setUp(self):
+        parent = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, parent)
+        with open(os.path.join(parent, 'secret.txt'), 'w') as f:
+            f.write('not static')
+        self.root = os.path.join(parent, 'static')
+        os.makedirs(os.path.join(self.root, 'css'))
+        self.css = b'.product .product-img { position: relative; }\n' * 100
+        for name in ('css/style.0123456789ab.css', 'css/style.css'):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(self.css)
+        with open(os.path.join(self.root, 'css/tiny.css'), 'wb') as f:
+            f.write(b'a{}')
+
+    def get(self, path, **headers):
+        with override_settings(STATIC_ROOT=self.root, DEBUG=False):
+            middleware = PrecompressedStaticMiddleware(lambda request: HttpResponse(status=404))
+        return middleware(RequestFactory().get(settings.STATIC_URL + path, **headers))
+
+    def test_precompress_writes_variants_once(self):
+        files, written, saved = precompress(self.root)
+        self.assertEqual(files, 2)
+        self.assertEqual(written, 2 * (2 if brotli else 1))
+        self.assertGreater(saved, 0)
+        with open(os.path.join(self.root, 'css/style.0123456789ab.css.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), self.css)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'css/tiny.css.gz')))
+        self.assertEqual(precompress(self.root)[1], 0)
+
+    def test_serves_precompressed_variant_with_immutable_caching(self):
+        precompress(self.root)
+        response = self.get('css/style.0123456789ab.css', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.css)
+
+        response = self.get('css/style.0123456789ab.css', HTTP_IF_NONE_MATCH=response['ETag'], HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 304)
+
+    def test_serves_plain_file_to_other_clients(self):
+        precompress(self.root)
+        response = self.get('css/style.css', HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        self.assertEqual(b''.join(response.streaming_content), self.css)
+
+    def test_leaves_other_paths_alone(self):
+        self.assertEqual(self.get('css/missing.css').status_code, 404)
+        self.assertEqual(self.get('../secret.txt').status_code, 404)
+
+
+@override_settings(CATALOG_EXPORT_TOKENS=[])
+class CatalogExportTests(TestCase):
+
+    def setUp(self):
+        self.products = create_catalog(5)
+        self.products[0].discount, self.products[0].discount_value = True, 10
+        self.products[0].save()
+
+    def export(self, **params):
+        response = self.client.get(reverse('catalog_export'), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def ndjson(self, **params):
+        content = b''.join(self.export(**params).streaming_content).decode()
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_rows(self):
+        rows = self.ndjson()
+        # Oldest change first: the discounted product was saved last
+        self.assertEqual([row['id'] for row in rows], [product.pk for product in self.products[1:] + self.products[:1]])
+        row = rows[-1]
+        self.assertEqual(row['categories'], ['Laptops'])
+        self.assertEqual(len(row['images']), 2)
+        self.assertEqual((row['price'], row['effective_price'], row['discount_value']), ('100.00', '90.00', 10))
+        self.assertTrue(row['url'].endswith(self.products[0].get_absolute_url()))
+
+    def test_resume_from_cursor(self):
+        rows = self.ndjson()
+        self.assertEqual([row['id'] for row in self.ndjson(cursor=rows[1]['cursor'])], [row['id'] for row in rows[2:]])
+
+        response = self.export(format='json', limit=3)
+        first = json.loads(b''.join(response.streaming_content))
+        rest = json.loads(b''.join(self.export(format='json', cursor=first['next_cursor']).streaming_content))
+        self.assertEqual([row['id'] for row in first['products'] + rest['products']], [row['id'] for row in rows])
+        self.assertIsNone(rest['next_cursor'])
+
+    def test_bad_cursor(self):
+        listing_cursor = CursorPaginator(Product.objects.all(), 'updated_at', 2, descending=False).get_page().next_cursor
+        for cursor in ('nonsense', listing_cursor):
+            response = self.client.get(reverse('catalog_export'), {'cursor': cursor})
+            self.assertEqual(response.status_code, 400)
+
+    @override_settings(CATALOG_EXPORT_TOKENS=['partner-token'])
+    def test_token_required_when_configured(self):
+        self.assertEqual(self.client.get(reverse('catalog_export')).status_code, 401)
+        response = self.client.get(reverse('catalog_export'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get(reverse('catalog_export'), HTTP_AUTHORIZATION='Bearer partner-token')
+        self.assertEqual(response.status_code, 200)
+
+
+class CatalogImportTests(TestCase):
+
+    def write_jsonl(self, rows):
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(handle, 'w') as f:
+            for row in rows:
+                f.write((row if isinstance(row, str) else json.dumps(row)) + '\n')
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_upsert_by_slug(self):
+        phone = Product.objects.create(name='Phone', price=50, description='', details='', sales=7)
+        path = self.write_jsonl([
+            {'name': 'Phone', 'price': '80', 'discount': True, 'discount_value': 25, 'categories': ['Phones']},
+            {'name': 'Case', 'price': '5', 'categories': 'Phones|Accessories', 'related': ['phone']},
+            {'name': '', 'price': '1'},
+            'not json',
+        ])
+        importer = CatalogImporter()
+        stats = importer.run(read_rows(path))
+
+        self.assertEqual((stats['created'], stats['updated'], stats['skipped']), (1, 1, 2))
+        self.assertEqual([line for line, _ in importer.errors], [3, 4])
+        phone.refresh_from_db()
+        self.assertEqual((phone.price, phone.discount_price, phone.sales), (Decimal('80'), Decimal('60'), 7))
+        self.assertEqual(list(phone.categories.values_list('name', flat=True)), ['Phones'])
+        case = Product.objects.get(slug='case')
+        self.assertEqual(list(phone.related_products.all()), [case])
+        self.assertEqual(phone.search_terms.filter(term='phone').count(), 1)
+        self.assertEqual(list(Product.objects.filter(related_to__product=phone)), [case])
+
+    def test_dry_run_writes_nothing(self):
+        path = self.write_jsonl([{'name': 'Phone', 'price': '80'}])
+        call_command('import_catalog', path, dry_run=True, stdout=io.StringIO())
+        self.assertFalse(Product.objects.exists())
+
+    def count_import_queries(self, count):
+        path = self.write_jsonl(
+            {'name': f'Item {count}-{i}', 'price': '9.99', 'categories': [f'Category {count}-{i % 5}']}
+            for i in range(count)
+        )
+        with CaptureQueriesContext(connection) as queries:
+            stats = CatalogImporter(rebuild_related=False).run(read_rows(path))
+        self.assertEqual(stats['created'], count)
+        return len(queries)
+
+    def test_queries_do_not_grow_with_the_rows(self):
+        # One batch writes its rows in bulk, whatever its size (small enough that SQLite does not
+        # split the INSERTs for its bound parameter limit)
+        self.assertEqual(self.count_import_queries(10), self.count_import_queries(40))
+
+    @benchmark
+    def test_throughput(self):
+        path = self.write_jsonl(
+            {'name': f'Item {i}', 'price': '9.99', 'categories': [f'Category {i % 20}']}
+            for i in range(3000)
+        )
+        stats = CatalogImporter(rebuild_related=False).run(read_rows(path))
+        self.assertEqual(stats['created'], 3000)
+        print(f"\n{stats['rows_per_second']:.0f} rows/s imported (target {TARGET_ROWS_PER_SECOND})")
+        self.assertGreaterEqual(stats['rows_per_second'], TARGET_ROWS_PER_SECOND)
+
+    def test_reports_rows_not_imported_as_written(self):
+        path = self.write_jsonl([
+            {'name': 'Phone', 'price': '80'},
+            {'name': 'x' * 150, 'price': '1'},
+            {'name': 'PHONE!', 'price': '90'},
+        ])
+        importer = CatalogImporter()
+        stats = importer.run(read_rows(path))
+
+        self.assertEqual((stats['created'], stats['duplicates'], stats['truncated']), (2, 1, 1))
+        self.assertEqual(sorted(importer.warnings), [
+            (1, "replaced by line 3, which has the same slug 'phone'"),
+            (2, 'name cut to 100 characters'),
+        ])
+        self.assertEqual(Product.objects.get(slug='phone').price, Decimal('90'))
+        self.assertEqual(len(Product.objects.exclude(slug='phone').get().name), 100)
+
+
+class RepricingTests(TestCase):
+
+    def test_matches_product_save(self):
+        phones = Category.objects.create(name='Phones')
+        # Prices whose discounted value lands on half a cent
+        for i, price in enumerate(['10.05', '10.15', '0.50', '19.99', '33.33']):
+            product = Product.objects.create(name=f'Phone {i}', price=price, description='', details='')
+            product.categories.add(phones)
+        other = Product.objects.create(name='Laptop', price=500, description='', details='')
+
+        version = get_version(HOMEPAGE_NAMESPACE)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('reprice', discount=15, category=['Phones'], batch_size=2, stdout=io.StringIO())
+        # One invalidation per batch
+        self.assertEqual(get_version(HOMEPAGE_NAMESPACE), version + 3)
+
+        for product in phones.product_set.all():
+            self.assertTrue(product.discount)
+            discount_price = product.discount_price
+            product.save()
+            product.refresh_from_db()
+            self.assertEqual(discount_price, product.discount_price)
+        other.refresh_from_db()
+        self.assertEqual((other.discount, other.discount_price), (False, Decimal('500')))
+
+    def test_rounding_follows_the_backend(self):
+        # Half-even where Django quantizes before saving (SQLite here), half up where the column rounds
+        self.assertTrue(quantized_before_saving())
+        with mock.patch.object(connection.ops, 'adapt_decimalfield_value', lambda value, *args: value):
+            self.assertFalse(quantized_before_saving())
+
+    def test_change_price_recomputes_discount_price(self):
+        product = Product.objects.create(
+            name='Phone', price=Decimal('10.05'), discount=True, discount_value=10, description='', details='',
+        )
+        change_price(Product.objects.all(), 10)
+        product.refresh_from_db()
+        self.assertEqual((product.price, product.discount_price), (Decimal('11.06'), Decimal('9.95')))
@@ -9,6 +9,10 @@ urlpatterns = [
     path('cart/', CartPageView.as_view(), name='cart'),
     path('wishlist/', WishlistView.as_view(), name='wishlist'),
     path('profile/', ProfileView.as_view(), name='profile'),
+    path('profile/orders/', OrderHistoryView.as_view(), name='order_history'),
     path('api/payment/', PaymentStatusView.as_view(), name='payment_status'),
+    path('api/products/', CatalogExportView.as_view(), name='catalog_export'),
+    path('api/cart/', CartApiView.as_view(), name='cart_api'),
+    path('api/cart/<str:action>/', CartApiView.as_view(), name='cart_api_action'),
     path('order/<slug:slug>/', OrderDetailView.as_view(), name='order_detail'),
 ]
@@ -1,17 +1,28 @@
+import hashlib
+import json
+
 from django.views.generic import *
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from django.contrib.auth import logout
+from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import JsonResponse
-from django.db.models import Q
+from django.db.models import Max, Prefetch
 # from django.contrib.auth.decorators import login_required
-from django.db.models import Count
 from django.core.paginator import Paginator
-from django.db.models.functions import Coalesce
-from django.http import HttpResponseRedirect
-from django.views.decorators.csrf import csrf_exempt
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from .models import *
 from .forms import *
+from .export import check_cursor, is_authorized, iter_products, stream_json, stream_ndjson
+from .caching import PAGE_PLACEHOLDERS, fill_page, get_homepage_blocks, get_product_page, product_page_version
+from .cart import get_cart_store, summarize_lines
+from .context_processors import get_header_counters
+from .pagination import CursorPage, CursorPaginator, InvalidCursor
+from .search import search_products
 
 
 
@@ -20,6 +31,13 @@ class ProductListView(ListView):
     template_name = 'store/index.html'
     context_object_name = 'products'
     paginate_by = 20
+    show_options = (10, 20, 30, 40, 50)
+    # sort option -> (field, descending); the primary key breaks ties
+    sort_orderings = {
+        'popular': ('sales', True),
+        'position': ('timestamp', False),
+    }
+    default_sort_ordering = ('sales', True)
 
     # def dispatch(self, request, *args, **kwargs):
     #     if not request.user.is_authenticated:
@@ -28,23 +46,55 @@ class ProductListView(ListView):
     #     return super().dispatch(request, *args, **kwargs)
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset().for_cards()
         search_query = self.request.GET.get('search')
         if search_query:
-            queryset = queryset.filter(
-                Q(name__icontains=search_query) |
-                Q(description__icontains=search_query)
-            )
-            if not queryset.exists():
-                messages.success(self.request, "No item found")
-
-        sort_option = self.request.GET.get('sort')
-        if sort_option == 'popular':
-            queryset = queryset.order_by('-sales')
-        elif sort_option == 'position':
-            queryset = queryset.order_by('timestamp')
-
-        return queryset.annotate(sales_count=Coalesce(Count('cartitem'), 0)).order_by('-sales')
+            # Ranked lookup against the inverted index, best matches first
+            return search_products(queryset, search_query)
+
+        field, descending = self.get_sort_ordering()
+        prefix = '-' if descending else ''
+        queryset = queryset.order_by(prefix + field, prefix + 'pk')
+
+        return queryset
+
+    def get_sort_ordering(self):
+        return self.sort_orderings.get(self.request.GET.get('sort'), self.default_sort_ordering)
+
+    def get_paginate_by(self, queryset):
+        try:
+            show = int(self.request.GET.get('show', ''))
+        except ValueError:
+            return self.paginate_by
+        return show if show in self.show_options else self.paginate_by
+
+    def uses_cursor_pagination(self):
+        # Ranked search results and old ?page=N links keep the numbered paginator
+        if self.request.GET.get('search'):
+            return False
+        return 'cursor' in self.request.GET or 'page' not in self.request.GET
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.uses_cursor_pagination():
+            return super().paginate_queryset(queryset, page_size)
+
+        field, descending = self.get_sort_ordering()
+        paginator = CursorPaginator(queryset, field, page_size, descending=descending)
+        try:
+            page = paginator.get_page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            # E.g. kept from another sort order: start over
+            page = paginator.get_page()
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def get_cursor_query(self, cursor=None):
+        # Current query string with the cursor swapped, so sort/show survive paging
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        query.pop('cursor', None)
+        if cursor:
+            query['cursor'] = cursor
+        return query.urlencode()
     # def get_queryset(self):
     #     queryset = super().get_queryset()
     #     title = self.request.GET.get('title')
@@ -59,41 +109,34 @@ class ProductListView(ListView):
         # Retrieve the top selling products based on the count of times added to cart
         # top_selling = self.get_queryset()[:3]
 
-        recent_products = Product.objects.order_by('-timestamp')[:3]
-        new_products = Product.objects.filter(is_new=True)[:3]
-        top_selling = Product.objects.order_by('-sales')[:3]
-        context['recent_products'] = recent_products
-        context['new_products'] = new_products
+        # The product blocks are the same for every visitor, see store/caching.py
+        blocks = get_homepage_blocks()
+        context.update(blocks)
+        context['newitems'] = blocks['hot_deals']
 
-        # Retrieve the cart items count for the current user
-        cart = self.get_cart()
-        context['cart_items_count'] = cart.get_total_items() if cart else 0
-        context['top_selling'] = top_selling
-        context['wishlist_items_count'] = self.wishlist_items_count()
-        context['hot_deals'] = self.get_hot_deals()
-        context['newitems'] = self.get_new_items()
-        context['search_query'] = self.request.GET.get('title', '')
+        # cart_items_count and wishlist_items_count come from store.context_processors
+        context['search_query'] = self.request.GET.get('search', '')
+        if context['search_query'] and not context['paginator'].count:
+            messages.success(self.request, "No item found")
         context['sort_option'] = self.request.GET.get('sort')
         context['show_option'] = self.request.GET.get('show')
+
+        page = context['page_obj']
+        context['cursor_pagination'] = isinstance(page, CursorPage)
+        if context['cursor_pagination']:
+            context['first_page_query'] = self.get_cursor_query()
+            context['next_page_query'] = self.get_cursor_query(page.next_cursor)
+            context['previous_page_query'] = self.get_cursor_query(page.previous_cursor)
+        else:
+            page_query = self.get_cursor_query()
+            context['page_query'] = page_query + '&' if page_query else ''
         
     
         return context
     
     def get_cart(self):
-        # Retrieve the cart object based on user or session
-        if self.request.user.is_authenticated:
-            # If the user is logged in, retrieve their cart
-            cart, _ = Cart.objects.get_or_create(user=self.request.user)
-        else:
-            # If the user is anonymous, retrieve the cart from the session
-            cart_id = self.request.session.get('cart_id')
-            if cart_id:
-                cart = get_object_or_404(Cart, id=cart_id)
-            else:
-                cart = Cart.objects.create()
-                self.request.session['cart_id'] = cart.id
-
-        return cart
+        # The visitor's cart, stored by the CART_BACKEND (see store/cart.py)
+        return get_cart_store(self.request)
     
     def post(self, request, *args, **kwargs):
         # Handling the "Add to Cart" form submission
@@ -101,31 +144,8 @@ class ProductListView(ListView):
         quantity = int(request.POST.get('quantity', 1))
         product = get_object_or_404(Product, id=product_id)
 
-        user = self.request.user
-        cart = self.get_cart()
-
-        # Check if the item is already in the cart
-        if user.is_authenticated:
-            cart_item, item_created = CartItem.objects.get_or_create(cart=cart, user=user, product=product)
-        else:
-            cart_item, item_created = CartItem.objects.get_or_create(cart=cart, product=product)
-
-        # Update the quantity if the item already exists in the cart
-        if not item_created:
-            cart_item.quantity = quantity
-            cart_item.save()
-            messages.success(request, "Item added to cart successfully.")
-        else:
-            # Add the item to the cart if it's a new item
-            cart_item.quantity = quantity
-            cart_item.save()
-            if cart:
-                cart.items.add(cart_item)
-            messages.success(request, "Item added to cart successfully.")
-
-        # Store the quantity in the session
-        cart_id = cart.id
-        request.session[f'cart_{cart_id}_quantity'] = quantity
+        self.get_cart().set_quantity(product, quantity)
+        messages.success(request, "Item added to cart successfully.")
 
         # Subscribe to the newsletter
         newsletter_form = NewsletterSubscriberForm(request.POST)
@@ -135,30 +155,7 @@ class ProductListView(ListView):
 
         return redirect('product_list')
     
-    def wishlist_items_count(self):
-        # Logic to retrieve and return the count of items in the wishlist for the current user
-        wishlist_items_count = 0
-        user = self.request.user
-        if user.is_authenticated:
-            wishlist_items_count = WishlistItem.objects.filter(wishlist__user=user).count()
-        return wishlist_items_count
-
-    
 
-    def get_new_items(self):
-        # Logic to retrieve and return the items in the items that are new for the current user
-        newitems = Product.objects.filter(hot_deal=True)
-        return newitems
-
-    def get_hot_deals(self):
-        # Logic to retrieve and return the hot deal products
-        hot_deals = Product.objects.filter(hot_deal=True)
-        return hot_deals
-
-    def get_top_selling(self):
-        # Logic to retrieve and return the top selling products
-        top_selling = Product.objects.order_by('-sales')[:5]
-        return top_selling
 
 
 # from django.core.serializers import serialize
@@ -169,102 +166,95 @@ class ProductDetailView(TemplateView):
     template_name = 'store/product.html'
     related_products_per_page = 4
 
+    def get(self, request, *args, **kwargs):
+        products = Product.objects.only('pk', 'slug', 'updated_at')
+        # The related block shows other products: their changes are changes to this page too
+        products = products.annotate(related_updated_at=Max('related_entries__related__updated_at'))
+        product = get_object_or_404(products, slug=self.kwargs['slug'])
+        self.counters = self.get_counters(product)
+        if len(messages.get_messages(request)):
+            # Flash messages are one-off, such a page is neither cached nor revalidated
+            return super().get(request, *args, **kwargs)
+
+        etag = self.get_etag(product)
+        # Only the page of a visitor without a cart is the same for everyone
+        shared = not request.user.is_authenticated and not self.get_cart().has_cart()
+        updated_at = max(filter(None, [product.updated_at, product.related_updated_at]))
+        last_modified = int(updated_at.timestamp()) if shared else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            if request.user.is_authenticated:
+                response = super().get(request, *args, **kwargs)
+            else:
+                html = get_product_page(product, request.META.get('QUERY_STRING', ''), self.render_shared_page)
+                values = dict(self.counters, csrf_token=get_token(request))
+                response = HttpResponse(fill_page(html, values))
+
+        response.headers['ETag'] = etag
+        if last_modified is not None:
+            response.headers['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def render_shared_page(self):
+        # Render the anonymous page with placeholders for the per-visitor values
+        self.counters = {name: PAGE_PLACEHOLDERS[name] for name in self.counters}
+        context = self.get_context_data(**self.kwargs)
+        context['csrf_token'] = PAGE_PLACEHOLDERS['csrf_token']
+        response = self.render_to_response(context)
+        return response.render().content.decode()
+
+    def get_counters(self, product):
+        # The per-visitor values on the page: header counters and the quantity in the cart
+        quantity = self.get_cart().get_quantity(product)
+        return dict(get_header_counters(self.request), quantity=quantity or 1)
+
+    def get_etag(self, product):
+        parts = [
+            product.pk,
+            *product_page_version(product),
+            self.request.META.get('QUERY_STRING', ''),
+            self.request.user.pk,
+            *sorted(self.counters.items()),
+        ]
+        return quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         slug = self.kwargs['slug']
-        product = get_object_or_404(Product, slug=slug)
-        # quantity = CartItem.objects.filter(quantity)
-
-
-        # Retrieve the cart items count for the current user
-        cart = self.get_cart()
-        context['cart_items_count'] = cart.get_total_items() if cart else 0
+        product = get_object_or_404(Product.objects.for_cards(), slug=slug)
         context['product'] = product
-        context['wishlist_items_count'] = self.wishlist_items_count()
+        # Header counters and cart quantity, see get_counters()
+        context.update(self.counters)
         related_products = self.get_related_products(product)
         paginator = Paginator(related_products, self.related_products_per_page)
         page_number = self.request.GET.get('page', 1)
         page = paginator.get_page(page_number)
         context['related_products'] = page
-        # Retrieve the quantity from the cart if the item exists
-        cart = Cart.objects.filter(user=self.request.user).first() if self.request.user.is_authenticated else self.get_cart()
-        if cart:
-            cart_item = cart.items.filter(product=product).first()
-            if cart_item:
-                context['quantity'] = cart_item.quantity
-            else:
-                context['quantity'] = 0
-        else:
-            context['quantity'] = 0
 
         return context
     
     def get_related_products(self, product):
-        # Get related products from the same category
-        related_products = Product.objects.filter(categories__in=product.categories.all()).exclude(slug=product.slug)
-        related_products = related_products.order_by('-timestamp')
+        # Read the precomputed list (store/related.py), best match first
+        related_products = Product.objects.for_cards().filter(related_to__product=product)
+        related_products = related_products.order_by('-related_to__score', '-related_to__related')
         return related_products
     
-    def wishlist_items_count(self):
-        # Logic to retrieve and return the count of items in the wishlist for the current user
-        wishlist_items_count = 0
-        user = self.request.user
-        if user.is_authenticated:
-            wishlist_items_count = WishlistItem.objects.filter(wishlist__user=user).count()
-        return wishlist_items_count
 
 
     def get_cart(self):
-        if self.request.user.is_authenticated:
-            # If the user is logged in, retrieve their cart
-            cart = Cart.objects.filter(user=self.request.user).first()
-        else:
-            cart_id = self.request.session.get('cart_id')
-            if cart_id:
-                cart = Cart.objects.filter(id=cart_id).first()
-            else:
-                cart = Cart.objects.create()
-                self.request.session['cart_id'] = cart.id
-                # Assign the retrieved cart_id to the cart object
-                cart.id = cart_id
-
-        return cart
+        # The visitor's cart, stored by the CART_BACKEND (see store/cart.py)
+        return get_cart_store(self.request)
 
-
-
-        
     def post(self, request, *args, **kwargs):
         slug = self.kwargs['slug']
         product = get_object_or_404(Product, slug=slug)
         quantity = int(request.POST.get('quantity', 1))
 
-        user = self.request.user
-        cart = self.get_cart()
-
-        # Check if the item is already in the cart
-        if user.is_authenticated:
-            cart_item, item_created = CartItem.objects.get_or_create(cart=cart, user=user, product=product)
-        else:
-            cart_item, item_created = CartItem.objects.get_or_create(cart=cart, product=product)
-
-        # Update the quantity if the item already exists in the cart
-        if not item_created:
-            cart_item.quantity = quantity
-            cart_item.save()
-            # Display a success message for adding the item to the cart
-            messages.success(request, "Item added to cart successfully.")
-        else:
-            # Add the item to the cart if it's a new item
-            cart_item.quantity = quantity
-            cart_item.save()
-            if cart:
-                cart.items.add(cart_item)
-            # Display a success message for adding the item to the cart
-            messages.success(request, "Item added to cart successfully.")
-
-        # Store the quantity in the session
-        cart_id = cart.id
-        request.session[f'cart_{cart_id}_quantity'] = quantity
+        self.get_cart().set_quantity(product, quantity)
+        # Display a success message for adding the item to the cart
+        messages.success(request, "Item added to cart successfully.")
 
         # Subscribe to the newsletter
         newsletter_form = NewsletterSubscriberForm(request.POST)
@@ -282,44 +272,25 @@ class CartPageView(TemplateView):
     template_name = 'store/cart.html'
 
     def get_cart(self):
-        if self.request.user.is_authenticated:
-            # If the user is logged in, retrieve their cart
-            cart = Cart.objects.filter(user=self.request.user).first()
-        else:
-            cart_id = self.request.session.get('cart_id')
-            if cart_id:
-                cart = Cart.objects.filter(id=cart_id).first()
-            else:
-                cart = Cart.objects.create()
-                self.request.session['cart_id'] = cart.id
-
-        return cart
+        # The checkout page reads the rows, so pending cart changes are written first
+        return get_cart_store(self.request).flush()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        # Retrieve the cart items count for the current user
         cart = self.get_cart()
-        context['cart_items_count'] = cart.get_total_items() if cart else 0
-        context['wishlist_items_count'] = self.wishlist_items_count()
-        cart_items = CartItem.objects.filter(cart=cart)
+        cart_items = cart.items.select_related('product').prefetch_related(*card_prefetches('product__'))
         context['cart_items'] = cart_items
+        context['subtotal'] = cart.get_subtotal()
+        context['shipping'] = cart.summary['shipping']
         context['total_price'] = cart.get_total_price()
         return context
 
-    def wishlist_items_count(self):
-        # Logic to retrieve and return the count of items in the wishlist for the current user
-        wishlist_items_count = 0
-        user = self.request.user
-        if user.is_authenticated:
-            wishlist_items_count = WishlistItem.objects.filter(wishlist__user=user).count()
-        return wishlist_items_count
-
     def post(self, request, *args, **kwargs):
         cart_item_id = request.POST.get('item_id')
         cart_item = get_object_or_404(CartItem, id=cart_item_id)
 
         # Remove the cart item from the cart
-        cart_item.delete()
+        get_cart_store(request).remove(cart_item.product_id)
 
         messages.success(request, "Item removed from cart successfully.")
         return redirect('cart')
@@ -335,44 +306,22 @@ class WishlistView(TemplateView):
             # If the user is logged in, retrieve their wishlist
             wishlist, _ = Wishlist.objects.get_or_create(user=self.request.user)
         else:
-            # For anonymous users, retrieve the wishlist from the session
+            # For anonymous users, retrieve the wishlist from the session; None until they have one
+            # (looking at the page does not create one, and purge_stale deletes empty ones)
             wishlist_id = self.request.session.get('wishlist_id')
-            if wishlist_id:
-                wishlist = get_object_or_404(Wishlist, id=wishlist_id)
-            else:
-                # If the wishlist doesn't exist, create a new one
-                wishlist = Wishlist.objects.create()
-                self.request.session['wishlist_id'] = wishlist.id
+            wishlist = Wishlist.objects.filter(id=wishlist_id).first() if wishlist_id else None
 
         return wishlist
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         wishlist = self.get_wishlist()
-        context['wishlist_items_count'] = wishlist.items.count()
-        context['cart_items_count'] = self.cart_items_count()
-
-        wishlist_items = wishlist.items.all()
+        wishlist_items = wishlist.items.all() if wishlist else WishlistItem.objects.none()
+        wishlist_items = wishlist_items.select_related('product').prefetch_related(*card_prefetches('product__'))
         context['wishlist_items'] = wishlist_items
 
         return context
 
-    def cart_items_count(self):
-        # Logic to retrieve and return the cart items count for the current user
-        cart_items_count = 0
-        user = self.request.user
-        if user.is_authenticated:
-            cart = Cart.objects.filter(user=user).first()
-            if cart:
-                cart_items_count = cart.items.count()
-        else:
-            cart_id = self.request.session.get('cart_id')
-            if cart_id:
-                cart = Cart.objects.filter(id=cart_id).first()
-                if cart:
-                    cart_items_count = cart.items.count()
-        return cart_items_count
-
     def post(self, request, *args, **kwargs):
         wishlist = self.get_wishlist()
         context = self.get_context_data(**kwargs)
@@ -443,50 +392,161 @@ class ProfileView(View):
 # @csrf_exempt
 class PaymentStatusView(View):
     def post(self, request, *args, **kwargs):
-        if request.method == 'POST':
-            # Process the payment status from Paystack
+        # Process the payment status from Paystack; cart.html posts the callback's response as JSON
+        if request.content_type == 'application/json':
+            payload = request.body.decode('utf-8', 'replace')
+            try:
+                response_data = json.loads(payload)
+            except ValueError:
+                response_data = None
+            if not isinstance(response_data, dict):
+                return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+        else:
             response_data = request.POST
+            payload = json.dumps(response_data.dict())
 
-            # Check the 'status' field in the response_data to determine the payment status
-            status = response_data.get('status')
+        # Check the 'status' field in the response_data to determine the payment status
+        status = response_data.get('status')
 
-            if status == 'success':
-                # Payment is successful, perform the necessary actions
-                # For example, update the order status, create an order, etc.
+        reference = str(response_data.get('reference') or '')
+        cart = None
+        if status == 'success':
+            if not reference:
+                return JsonResponse({'status': 'error', 'message': 'Missing reference'}, status=400)
+            if not request.user.is_authenticated:
+                return JsonResponse({'status': 'error', 'message': 'Log in to pay'}, status=403)
+            # The cart set aside for this reference by an earlier delivery of the callback, or the live one
+            cart = Cart.objects.filter(user=request.user, reference=reference).first()
+            if cart is None:
+                cart = get_cart_store(request).checkout(reference)
 
-                # Get the cart items for the current user
-                user = request.user
-                cart = get_object_or_404(Cart, user=user)
+        # Stored as received; manage.py process_payment_events makes the order, see store/payments.py
+        PaymentEvent.objects.create(payload=payload, reference=reference, cart=cart)
 
-                # Create a new order with the purchased items
-                order = Order.objects.create(user=user, total_price=cart.get_subtotal(), status='pending')
+        # Return a response to Paystack right away
+        if status == 'success':
+            return JsonResponse({'status': 'success'})
+        return JsonResponse({'status': 'error', 'message': 'Payment failed'})
 
-                for cart_item in cart.items.all():
-                    OrderItem.objects.create(order=order, product=cart_item.product, quantity=cart_item.quantity, unit_price=cart_item.product.discount_price)
 
-                # Clear the cart (remove all items from the cart)
-                cart.items.clear()
-                cart.is_paid = True
-                cart.save()
+class OrderHistoryView(LoginRequiredMixin, TemplateView):
+    template_name = 'store/orders.html'
+    paginate_by = 10
 
-                # Return a success response to Paystack
-                return JsonResponse({'status': 'success'})
-            else:
-                # Payment failed, handle the failure scenario
-                # For example, log the failed payment or take other actions
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # Keyset pages, newest first, of the summaries written with each order; no items are read
+        paginator = CursorPaginator(Order.objects.filter(user=self.request.user), 'created_at', self.paginate_by)
+        try:
+            context['orders'] = paginator.get_page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            context['orders'] = paginator.get_page()
+        return context
 
-                # Return an error response to Paystack
-                return JsonResponse({'status': 'error', 'message': 'Payment failed'})
 
-        else:
-            # Return an error response for invalid request method
-            return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
+class OrderDetailView(LoginRequiredMixin, View):
+    template_name = 'store/order.html'
 
+    def get(self, request, *args, **kwargs):
+        order = get_object_or_404(Order, slug=kwargs.get('slug'), user=request.user)
+        # The same three queries however many lines: the order, its items with their products, the images
+        order_items = order.orderitem_set.order_by('pk').select_related('product').prefetch_related(
+            Prefetch('product__images', queryset=ProductImage.objects.order_by('pk')),
+        )
+        return render(request, self.template_name, {'order': order, 'order_items': order_items})
 
-class OrderDetailView(View):
-    template_name = 'store/order.html'
+
+class CatalogExportView(View):
+    # Machine-readable catalog for partners, streamed so memory stays flat
+
+    def get(self, request, *args, **kwargs):
+        if not is_authorized(request):
+            response = JsonResponse({'status': 'error', 'message': 'Invalid or missing token'}, status=401)
+            response['WWW-Authenticate'] = 'Bearer'
+            return response
+        output_format = request.GET.get('format', 'ndjson')
+        if output_format not in ('ndjson', 'json'):
+            return JsonResponse({'status': 'error', 'message': 'Unknown format'}, status=400)
+
+        updated_since = request.GET.get('updated_since')
+        if updated_since:
+            updated_since = parse_datetime(updated_since)
+            if updated_since is None:
+                return JsonResponse({'status': 'error', 'message': 'Invalid updated_since'}, status=400)
+            if timezone.is_naive(updated_since):
+                updated_since = timezone.make_aware(updated_since)
+
+        limit = request.GET.get('limit')
+        if limit:
+            if not limit.isdigit() or int(limit) < 1:
+                return JsonResponse({'status': 'error', 'message': 'Invalid limit'}, status=400)
+            limit = int(limit)
+
+        cursor = request.GET.get('cursor')
+        if cursor:
+            try:
+                check_cursor(cursor)
+            except InvalidCursor:
+                return JsonResponse({'status': 'error', 'message': 'Invalid cursor'}, status=400)
+
+        products = iter_products(updated_since=updated_since or None, cursor=cursor, limit=limit or None)
+        if output_format == 'json':
+            return StreamingHttpResponse(stream_json(request, products, limit=limit or None), content_type='application/json')
+        return StreamingHttpResponse(stream_ndjson(request, products), content_type='application/x-ndjson')
+
+
+class CartApiView(View):
+    # JSON cart for the add to cart and remove buttons, see static js/cart.js
+    actions = ('add', 'set', 'remove')
 
     def get(self, request, *args, **kwargs):
-        order_id = kwargs.get('order_id')
-        order = get_object_or_404(Order, id=order_id)
-        return render(request, self.template_name, {'order': order})
\ No newline at end of file
+        if kwargs.get('action'):
+            return JsonResponse({'status': 'error', 'message': 'Use POST'}, status=405)
+        return JsonResponse(self.get_payload())
+
+    def post(self, request, *args, **kwargs):
+        action = kwargs.get('action')
+        if action not in self.actions:
+            return JsonResponse({'status': 'error', 'message': 'Unknown action'}, status=404)
+
+        product_id = request.POST.get('product_id', '')
+        if not product_id.isdigit():
+            return JsonResponse({'status': 'error', 'message': 'Invalid product_id'}, status=400)
+        product_id = int(product_id)
+
+        store = get_cart_store(request)
+        if action == 'remove':
+            store.remove(product_id)
+            return JsonResponse(self.get_payload(product_id))
+
+        quantity = request.POST.get('quantity', '1')
+        if not quantity.isdigit() or (action == 'add' and int(quantity) < 1):
+            return JsonResponse({'status': 'error', 'message': 'Invalid quantity'}, status=400)
+        quantity = int(quantity)
+
+        product = Product.objects.filter(pk=product_id).only('pk').first()
+        if product is None:
+            return JsonResponse({'status': 'error', 'message': 'Unknown product'}, status=404)
+        if action == 'add':
+            store.add(product, quantity)
+        elif quantity:
+            store.set_quantity(product, quantity)
+        else:
+            store.remove(product_id)
+        return JsonResponse(self.get_payload(product_id))
+
+    def get_payload(self, product_id=None):
+        summary, lines = summarize_lines(get_cart_store(self.request).get_lines())
+        payload = {
+            'status': 'success',
+            'cart_items_count': summary['items'],
+            'wishlist_items_count': get_header_counters(self.request)['wishlist_items_count'],
+            'subtotal': summary['subtotal'],
+            'shipping': summary['shipping'],
+            'total_price': summary['subtotal'] + summary['shipping'],
+            'lines': lines,
+        }
+        if product_id is not None:
+            # The line that changed, None once it is removed
+            payload['line'] = next((line for line in lines if line['product_id'] == product_id), None)
+        return payload